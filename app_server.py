@@ -3,6 +3,7 @@ import pandas as pd
 import os
 import requests
 import time
+import json
 
 
 
@@ -229,15 +230,22 @@ with st.expander("Show Manual"):
     - All saved sequences are saved as .csv files in the `/instructions` folder.
 """)
     
-# Periodically fetch and update the last step information
+# Subscribe to the state stream, the server pushes the last step information when it changes
+def stream_state():
+    with requests.get(f"{API_URL}/state_stream", stream=True, timeout=(5, None)) as response:
+        response.raise_for_status()
+        for line in response.iter_lines(decode_unicode=True):
+            if line and line.startswith("data: "):
+                yield json.loads(line[len("data: "):])
+
 while True:
-    data = fetch_last_step()
-    if type(data) == str:
+    try:
+        for data in stream_state():
+            info_text, warning = fetch_last_step_info(data)
+            info_placeholder.markdown(info_text)  # Update the info box with the latest data  
+            if warning:
+                warning_msg = f"Step Number {data['step_number']} - {warning}"
+                warning_placeholder.error(warning_msg)
+    except requests.exceptions.RequestException:
         st.warning("fetch last step failed... server error")
-    else:
-        info_text, warning = fetch_last_step_info(data)
-        info_placeholder.markdown(info_text)  # Update the info box with the latest data  
-        if warning:
-            warning_msg = f"Step Number {data['step_number']} - {warning}"
-            warning_placeholder.error(warning_msg)
-        time.sleep(0.3)
+    time.sleep(1)  # Wait before reconnecting to the stream
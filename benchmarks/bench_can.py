@@ -0,0 +1,177 @@
+# bench_can.py
+"""Latency and throughput benchmark of the CAN command layer against the simulated servo.
+
+Usage:
+    python benchmarks/bench_can.py --iterations 500 --output bench_results.json
+
+Every command family (can_commands reads, can_motor moves, can_set writes) is sent to a
+SimulatedMksServo on a virtual bus. For each command it reports the p50/p99 round-trip
+latency, the commands per second and the CPU time per command. The CPU time is the one
+of the whole process, so it includes the simulated servo.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import can
+from core.mks_servo import MksServo
+from core.mks_simulator import SimulatedMksServo
+from core.mks_enums import MksCommands, Enable, Direction
+
+CHANNEL = 'bench'
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def measure(name, command, iterations, setup=None):
+    """Run a command iterations times and return its latency and throughput statistics."""
+    latencies = []
+    failures = 0
+    setup_cpu_time = setup_wall_time = 0
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    for _ in range(iterations):
+        if setup is not None:
+            # The setup (i.e. waiting for the previous motion) is not part of the measure
+            setup_cpu_start, setup_wall_start = time.process_time(), time.perf_counter()
+            setup()
+            setup_cpu_time += time.process_time() - setup_cpu_start
+            setup_wall_time += time.perf_counter() - setup_wall_start
+        start = time.perf_counter()
+        result = command()
+        latencies.append(time.perf_counter() - start)
+        if result is None:
+            failures += 1
+    wall_time = time.perf_counter() - wall_start - setup_wall_time
+    cpu_time = time.process_time() - cpu_start - setup_cpu_time
+
+    result = {
+        'iterations': iterations,
+        'failures': failures,
+        'p50_ms': percentile(latencies, 0.50) * 1e3,
+        'p99_ms': percentile(latencies, 0.99) * 1e3,
+        'mean_ms': statistics.fmean(latencies) * 1e3,
+        'commands_per_second': iterations / wall_time,
+        'cpu_us_per_command': cpu_time / iterations * 1e6,
+    }
+    print(f"{name:<45} p50 {result['p50_ms']:7.3f} ms  p99 {result['p99_ms']:7.3f} ms  "
+          f"{result['commands_per_second']:8.1f} cmd/s  {result['cpu_us_per_command']:8.1f} us CPU  {failures} failed", flush=True)
+    return result
+
+@contextmanager
+def telemetry_load(servo, threads=8):
+    """Keep the bus busy with reads from several threads, as the server and UI polling do."""
+    stop = threading.Event()
+    def poll():
+        while not stop.is_set():
+            servo.read_encoder_value_addition()
+            servo.read_motor_shaft_angle_error()
+            servo.query_motor_status()
+    workers = [threading.Thread(target=poll, daemon=True) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        for worker in workers:
+            worker.join()
+
+def benchmark(servo, iterations):
+    results = {}
+
+    # can_commands reads
+    for name in ('read_encoder_value_carry', 'read_encoder_value_addition', 'read_motor_speed',
+                 'read_num_pulses_received', 'read_io_port_status', 'read_motor_shaft_angle_error',
+                 'read_en_pins_status', 'read_go_back_to_zero_status_when_power_on',
+                 'read_motor_shaft_protection_state', 'query_motor_status'):
+        results[name] = measure(name, getattr(servo, name), iterations)
+
+    batch = [MksCommands.READ_ENCODED_VALUE_ADDITION, MksCommands.READ_MOTOR_SPEED,
+             MksCommands.READ_MOTOR_SHAFT_ANGLE_ERROR, MksCommands.READ_MOTOR_SHAFT_PROTECTION_STATE]
+    results['read_batch_4'] = measure('read_batch (4 reads)', lambda: servo.read_batch(batch), iterations)
+
+    # can_motor moves: round trip until the RunStarting response, the motion is waited outside the measure
+    def wait_idle():
+        servo.wait_for_motor_idle(5)
+    results['run_motor_relative_motion_by_axis'] = measure('run_motor_relative_motion_by_axis',
+        lambda: servo.run_motor_relative_motion_by_axis(3000, 0, 16), iterations, setup=wait_idle)
+    results['run_motor_absolute_motion_by_axis'] = measure('run_motor_absolute_motion_by_axis',
+        lambda: servo.run_motor_absolute_motion_by_axis(3000, 0, 0), iterations, setup=wait_idle)
+    results['run_motor_relative_motion_by_pulses'] = measure('run_motor_relative_motion_by_pulses',
+        lambda: servo.run_motor_relative_motion_by_pulses(Direction.CW, 3000, 0, 4), iterations, setup=wait_idle)
+    def move_and_wait():
+        result = servo.run_motor_relative_motion_by_axis(3000, 0, 16)
+        return result if not servo.wait_for_motor_idle(5) else None
+    wait_idle()
+    results['move_and_wait_idle'] = measure('move and wait for completion', move_and_wait, iterations)
+    results['emergency_stop_motor'] = measure('emergency_stop_motor', servo.emergency_stop_motor, iterations)
+    # Stop latency while other threads saturate the bus, the stop frame is sent ahead of the queued reads
+    safety_waits = servo.scheduler.snapshot()['SAFETY']
+    with telemetry_load(servo):
+        results['emergency_stop_under_load'] = measure('emergency_stop_motor (under telemetry load)',
+            servo.emergency_stop_motor, iterations)
+    waits = servo.scheduler.snapshot()
+    holds = waits['SAFETY']['holds'] - safety_waits['holds']
+    results['emergency_stop_under_load']['transmit_wait_mean_ms'] = (waits['SAFETY']['wait_sum'] - safety_waits['wait_sum']) / holds * 1e3
+    results['emergency_stop_under_load']['transmit_wait_max_ms'] = waits['SAFETY']['wait_max'] * 1e3
+    results['telemetry_transmit_wait_max_ms'] = waits['TELEMETRY']['wait_max'] * 1e3
+    print(f"{'  wait for the bus':<45} mean {results['emergency_stop_under_load']['transmit_wait_mean_ms']:7.3f} ms  "
+          f"max {results['emergency_stop_under_load']['transmit_wait_max_ms']:7.3f} ms  "
+          f"(telemetry max {results['telemetry_transmit_wait_max_ms']:.3f} ms)", flush=True)
+    results['enable_motor'] = measure('enable_motor', lambda: servo.enable_motor(Enable.Enable), iterations)
+
+    # can_set writes
+    results['set_working_current'] = measure('set_working_current', lambda: servo.set_working_current(1000), iterations)
+    results['set_subdivisions'] = measure('set_subdivisions', lambda: servo.set_subdivisions(16), iterations)
+    results['set_key_lock'] = measure('set_key_lock', lambda: servo.set_key_lock(Enable.Disable), iterations)
+    results['set_current_axis_to_zero'] = measure('set_current_axis_to_zero', servo.set_current_axis_to_zero, iterations)
+    return results
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=200, help='Number of calls of each command')
+    parser.add_argument('--output', default='bench_results.json', help='Path of the JSON results')
+    args = parser.parse_args()
+
+    with SimulatedMksServo(channel=CHANNEL, can_id=1):
+        bus = can.interface.Bus(interface='virtual', channel=CHANNEL)
+        notifier = can.Notifier(bus, [])
+        try:
+            servo = MksServo(bus, notifier, 1)
+            results = benchmark(servo, args.iterations)
+        finally:
+            notifier.stop()
+            bus.shutdown()
+
+    report = {
+        'revision': git_revision(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'iterations': args.iterations,
+        'results': results,
+    }
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f"Results saved to {args.output}")
+
+if __name__ == "__main__":
+    main()
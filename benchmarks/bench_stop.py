@@ -0,0 +1,104 @@
+# bench_stop.py
+"""Emergency stop latency check of the server against the simulated servo.
+
+Usage:
+    python benchmarks/bench_stop.py --trials 10 --output stop_results.json
+
+A sequence with 5 second steps is started with the /run_sequence handler, then /emergency_stop
+is called at a random time of a step. Each trial measures the time until the stop frame is seen
+on the bus and until the handler returns, and checks that no motion frame follows the stop
+frame. Half the trials run the sequence as a blended profile (blend_sequences).
+
+The exit status is 1 if a latency exceeds its bound or a motion frame follows a stop.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(ROOT)
+# The server loads config.json from the working directory and drives the simulated servo
+os.chdir(ROOT)
+os.environ['OWL_SIMULATOR'] = '1'
+
+import can
+import server
+from core.stop_check import STOP_CHECK_SEQUENCE, BusRecorder
+
+# The stop frame is sent ahead of the other traffic, it only waits for the frame being sent
+STOP_FRAME_BOUND = 0.05
+# The handler waits for the stop response and for the sequence thread, each within its timeout
+HANDLER_BOUND = 2 * server.servo_controller.servo.timeout + server.EMERGENCY_STOP_JOIN_TIMEOUT
+
+def trial(recorder, sequence_path, blend):
+    server.servo_controller.config['blend_sequences'] = blend
+    server.run_sequence(sequence_path)
+    time.sleep(random.uniform(0.5, 6))
+
+    recorder.clear()
+    start = time.perf_counter()
+    server.emergency_stop()
+    handler_latency = time.perf_counter() - start
+    recorder.stop_sent.wait(1)
+    stop_times = recorder.stop_times()
+    frame_latency = stop_times[0] - start if stop_times else None
+
+    # Let the sequence thread end, then look for motion frames sent after the stop
+    if server.execution_thread is not None:
+        server.execution_thread.join()
+    moves = recorder.moves_after(stop_times[0]) if stop_times else []
+    return {
+        'blend': blend,
+        'frame_latency_ms': frame_latency * 1e3 if frame_latency is not None else None,
+        'handler_latency_ms': handler_latency * 1e3,
+        'moves_after_stop': len(moves),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--trials', type=int, default=6, help='Number of emergency stops')
+    parser.add_argument('--output', default=None, help='Path of the JSON results')
+    args = parser.parse_args()
+
+    with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as file:
+        file.write(STOP_CHECK_SEQUENCE)
+    bus = can.interface.Bus(interface='virtual', channel='owl_simulator')
+    recorder = BusRecorder(server.servo_controller.servo.can_id)
+    notifier = can.Notifier(bus, [recorder])
+    results = []
+    try:
+        for i in range(args.trials):
+            result = trial(recorder, file.name, blend=bool(i % 2))
+            results.append(result)
+            frame_latency = result['frame_latency_ms']
+            print(f"trial {i:<3} {'blended' if result['blend'] else 'steps':<8} stop frame "
+                  f"{'missing' if frame_latency is None else f'{frame_latency:7.3f} ms'}  handler {result['handler_latency_ms']:8.3f} ms  "
+                  f"{result['moves_after_stop']} moves after the stop", flush=True)
+    finally:
+        notifier.stop()
+        bus.shutdown()
+        server.servo_controller.shutdown()
+        server.simulator.stop()
+        os.unlink(file.name)
+
+    failures = [result for result in results if result['frame_latency_ms'] is None
+        or result['frame_latency_ms'] > STOP_FRAME_BOUND * 1e3
+        or result['handler_latency_ms'] > HANDLER_BOUND * 1e3
+        or result['moves_after_stop']]
+    frame_latencies = [result['frame_latency_ms'] for result in results if result['frame_latency_ms'] is not None]
+    print(f"stop frame max {max(frame_latencies, default=float('nan')):.3f} ms (bound {STOP_FRAME_BOUND * 1e3:.0f} ms), "
+          f"handler max {max(result['handler_latency_ms'] for result in results):.3f} ms (bound {HANDLER_BOUND * 1e3:.0f} ms), "
+          f"{len(failures)} failed trials")
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({'stop_frame_bound_ms': STOP_FRAME_BOUND * 1e3, 'handler_bound_ms': HANDLER_BOUND * 1e3,
+                'trials': results}, output, indent=2)
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,160 @@
 # controller.py
-import can
 import time
 import os
-import pandas as pd
+import csv
+import threading
 import json
 from datetime import datetime
+from itertools import accumulate
+from typing import NamedTuple, Optional
+import can
 from core.mks_servo import MksServo
+from core.mks_group import MksServoGroup
+from core.mks_streamer import SpeedStreamer
+from core.cancellation import CancellationToken
+from planner import plan_profile, DEGREES_PER_SECOND_PER_RPM
+from core.mks_enums import MksCommands, RunMotorResult
 
 # Constants for conversion
 DEGREES_TO_UNITS = 16390 / 360
 
+# Maximum time to wait for the completion of a motion before checking the motor status again
+MOTOR_IDLE_TIMEOUT = 5
+
+# Receive timeout of the notifier thread, it bounds the time to stop it on shutdown
+NOTIFIER_TIMEOUT = 0.1
+
+# Rate of the speed setpoints streamed when executing a blended motion profile
+PROFILE_RATE_HZ = 100
+
+# Columns of the sequence files
+SEQUENCE_COLUMNS = ('Degrees', 'Speed', 'Acceleration', 'Duration', 'Label')
+
+class SequenceStep(NamedTuple):
+    """A row of a sequence file."""
+    row: int
+    degrees: float
+    speed: int
+    acceleration: int
+    duration: float
+    label: str
+
+def parse_number(text):
+    """Parse a numeric CSV field as an int when it has no fractional part, as a float otherwise."""
+    value = float(text)
+    return int(value) if value.is_integer() else value
+
+def load_sequence(file_path):
+    """Load the steps of a sequence file with the columns Degrees, Speed, Acceleration, Duration and Label.
+
+    Rows with missing values are skipped.
+    """
+    steps = []
+    with open(file_path, newline='') as file:
+        for i, row in enumerate(csv.DictReader(file)):
+            values = [row.get(column) for column in SEQUENCE_COLUMNS]
+            if any(value is None or value.strip() == '' for value in values):
+                print(f"One or more required fields are missing in row {i}. Skipping this row.")
+                continue
+            degrees, speed, acceleration, duration, label = values
+            steps.append(SequenceStep(i, parse_number(degrees), int(float(speed)), int(float(acceleration)), float(duration), label))
+    return steps
+
+class CompiledStep(NamedTuple):
+    """A sequence step with clamped values and its motion command already encoded."""
+    row: int
+    degrees: float
+    speed: int
+    acceleration: int
+    duration: float
+    label: str
+    frame: can.Message
+
+# Columns of each axis in the multi-axis sequence files, prefixed by the axis name, i.e. head_Degrees
+AXIS_COLUMNS = ('Degrees', 'Speed', 'Acceleration')
+
+class AxisTarget(NamedTuple):
+    """The target of an axis in a multi-axis sequence step."""
+    degrees: float
+    speed: int
+    acceleration: int
+
+class MultiAxisSequenceStep(NamedTuple):
+    """A row of a multi-axis sequence file. Axes without a target keep their position."""
+    row: int
+    targets: dict
+    duration: float
+    label: str
+
+def load_multi_axis_sequence(file_path, axes):
+    """Load the steps of a multi-axis sequence file.
+
+    Each axis has the columns <axis>_Degrees, <axis>_Speed and <axis>_Acceleration, and the
+    columns Duration and Label are shared. An axis whose columns are all empty in a row does not
+    move in that step. Rows with missing values are skipped.
+    """
+    steps = []
+    with open(file_path, newline='') as file:
+        for i, row in enumerate(csv.DictReader(file)):
+            duration, label = row.get('Duration'), row.get('Label')
+            if any(value is None or value.strip() == '' for value in (duration, label)):
+                print(f"One or more required fields are missing in row {i}. Skipping this row.")
+                continue
+
+            targets = {}
+            for axis in axes:
+                values = [row.get(f"{axis}_{column}") for column in AXIS_COLUMNS]
+                empty = [value is None or value.strip() == '' for value in values]
+                if all(empty):
+                    continue
+                if any(empty):
+                    print(f"One or more fields of the axis {axis} are missing in row {i}. Skipping this row.")
+                    break
+                degrees, speed, acceleration = values
+                targets[axis] = AxisTarget(parse_number(degrees), int(float(speed)), int(float(acceleration)))
+            else:
+                steps.append(MultiAxisSequenceStep(i, targets, float(duration), label))
+    return steps
+
+class AxisMove(NamedTuple):
+    """The clamped target of an axis with its motion command already encoded."""
+    axis: str
+    degrees: float
+    speed: int
+    acceleration: int
+    frame: can.Message
+
+class CompiledMultiAxisStep(NamedTuple):
+    """A multi-axis sequence step with the motion commands of its axes already encoded."""
+    row: int
+    moves: tuple
+    duration: float
+    label: str
+    # Single motion command addressed to the servo group when all the axes move to the same target
+    group_frame: Optional[can.Message] = None
+
 class ServoController:
     def __init__(self, config_path='config.json', can_interface='socketcan', channel='can0', bitrate=500000, device_id=1):
+        self._setup(config_path, can_interface, channel, bitrate)
+        self.servo = MksServo(self.bus, self.notifier, device_id)
+
+    def _setup(self, config_path, can_interface, channel, bitrate):
+        """Load the configuration and open the CAN bus, the state shared with MultiAxisController."""
         # Load configuration from JSON
         self.config = self.load_config(config_path)
-        
-        # Set up CAN bus and servo controller
+        # (modification time, compiled sequence) keyed by the absolute path of the sequence file, the
+        # entry of a file is replaced when it is modified
+        self._compiled_sequences = {}
+        # (modification time, clamped steps, profile) keyed by the absolute path of the sequence file
+        self._planned_sequences = {}
+        # Streamer of the blended profile being executed, halted by emergency_stop. The lock keeps a
+        # streamer from starting between the halt and the stop frame
+        self._streamer = None
+        self._streamer_lock = threading.Lock()
+
+        # Set up CAN bus
         self.bus = can.interface.Bus(interface=can_interface, channel=channel, bitrate=bitrate)
-        self.notifier = can.Notifier(self.bus, [])
-        self.servo = MksServo(self.bus, self.notifier, device_id)
+        self.notifier = can.Notifier(self.bus, [], timeout=NOTIFIER_TIMEOUT)
 
     def load_config(self, config_path):
         """Load the configuration file with limits for degrees, speed, and acceleration."""
@@ -33,59 +169,225 @@ class ServoController:
         self.notifier.stop()
         self.bus.shutdown()
 
-    def wait_for_motor_idle(self, timeout):
-        """Wait for the motor to finish its current operation or until the timeout is reached."""
-        start_time = time.perf_counter()
-        while (time.perf_counter() - start_time < timeout) and self.servo.is_motor_running():
-            time.sleep(0.1)  # Small sleep to prevent busy waiting
-        return self.servo.is_motor_running()
+    def wait_for_motor_idle(self, timeout, cancel=None):
+        """Wait for the motor to finish its current operation or until the timeout is reached.
+
+        The wait ends as soon as cancel, a CancellationToken, is set.
+        """
+        return self.servo.wait_for_motor_idle(timeout, cancel)
+
+    def emergency_stop(self):
+        """Stop the motor immediately, without waiting for the sequence being executed.
+
+        A blended profile being streamed is halted first, so no speed setpoint follows the stop frame.
+        Set the stop_event of execute_profile before calling it, so a profile about to start does not
+        start streaming after the stop.
+
+        Returns:
+            SuccessStatus: The result of the stop command, None if it was not acknowledged.
+        """
+        with self._streamer_lock:
+            if self._streamer is not None:
+                self._streamer.halt()
+            return self.servo.emergency_stop_motor()
+
+    def is_motor_busy(self):
+        """Return True if a motion is running, from the state tracked without querying the servo."""
+        return self.servo.is_motor_busy()
 
     def clamp_value(self, value, max_value):
         """Clamp the value to the specified maximum limit."""
         return min(value, max_value)
 
-    def execute_instruction(self, degrees, speed, acceleration, duration, label):
+    def compile_step(self, degrees, speed, acceleration, duration, label, row=None):
+        """Clamp the values of a step and encode its motion command."""
         # Clamp the values to the maximum limits from the config
         degrees = self.clamp_value(degrees, self.config['degrees_max'])
-        speed = self.clamp_value(speed, self.config['speed_max'])
-        acceleration = self.clamp_value(acceleration, self.config['acceleration_max'])
+        speed = int(self.clamp_value(speed, self.config['speed_max']))
+        acceleration = int(self.clamp_value(acceleration, self.config['acceleration_max']))
 
-        start_time_dt = datetime.now()
-        start_time = time.perf_counter()
-        print(f"**[{self.format_time(start_time_dt)}]** Starting {label}: Moving to {degrees} degrees at speed {speed} with acceleration {acceleration}")
+        frame = self.servo.encode_absolute_motion_by_axis(speed, acceleration, self.degrees_to_units(degrees))
+        return CompiledStep(row, degrees, speed, acceleration, float(duration), str(label), frame)
 
-        # Move the motor to the specified degrees with the given speed and acceleration
-        position_units = self.degrees_to_units(degrees)
-        self.servo.run_motor_absolute_motion_by_axis(speed, acceleration, position_units)
+    def compile_sequence(self, file_path):
+        """Compile a sequence file into a tuple of CompiledStep.
+
+        The result is cached until the file is modified, so looping over a sequence does not
+        parse rows or encode commands again. Only the last version of each file is kept, a file
+        rewritten before each run does not grow the cache.
+        """
+        if not os.path.exists(file_path):
+            raise FileNotFoundError(f"Sequence file '{file_path}' not found.")
+
+        path, mtime = os.path.abspath(file_path), os.path.getmtime(file_path)
+        entry = self._compiled_sequences.get(path)
+        if entry is None or entry[0] != mtime:
+            entry = self._compiled_sequences[path] = (mtime, self._compile_sequence_file(file_path))
+        return entry[1]
+
+    def _compile_sequence_file(self, file_path):
+        return tuple(self.compile_step(step.degrees, step.speed, step.acceleration, step.duration, step.label, row=step.row)
+            for step in load_sequence(file_path))
+
+    def execute_instruction(self, degrees, speed, acceleration, duration, label, deadline=None, cancel=None):
+        """Move to the position and wait until the end of the step."""
+        return self.execute_step(self.compile_step(degrees, speed, acceleration, duration, label), deadline, cancel)
+
+    def execute_step(self, step, deadline=None, cancel=None):
+        """Run a compiled step and wait until its end.
+
+        The step ends at deadline, a time.monotonic() timestamp, or step.duration seconds after
+        the start of the step if no deadline is given. When cancel, a CancellationToken, is set,
+        the waits end immediately and the motion started by the step keeps running.
+        """
+        start_time = time.monotonic()
+        if deadline is None:
+            deadline = start_time + step.duration
+
+        self._start_step(step)
 
         # Wait until the motor reaches the target position, ignoring the duration for now
-        while self.servo.is_motor_running():
-            time.sleep(0.1)  # Sleep briefly to prevent busy waiting
+        while self.wait_for_motor_idle(MOTOR_IDLE_TIMEOUT, cancel):
+            if cancel is not None and cancel.is_set():
+                break
 
         # Calculate the actual time taken to reach the target position
-        elapsed_time = time.perf_counter() - start_time
+        elapsed_time = time.monotonic() - start_time
 
         # If the motor took longer than the specified duration, generate a warning
-        if elapsed_time > duration:
-            warning_msg = f"Warning: {label} did not complete within the specified duration of {duration} seconds, the actual time taken was: {elapsed_time:.2f} seconds."
+        if elapsed_time > step.duration:
+            warning_msg = f"Warning: {step.label} did not complete within the specified duration of {step.duration} seconds, the actual time taken was: {elapsed_time:.2f} seconds."
             print(f"**[{self.format_time(datetime.now())}]** {warning_msg}")
             return elapsed_time, warning_msg
 
-        # If the motor completed within the specified duration, calculate the remaining time
-        remaining_time = duration - elapsed_time
+        # If the motor completed before the end of the step, sleep until its deadline
+        remaining_time = deadline - time.monotonic()
         if remaining_time > 0:
-            time.sleep(remaining_time)  # Sleep to complete the total duration
+            if cancel is not None:
+                cancel.wait(remaining_time)
+            else:
+                time.sleep(remaining_time)
 
         return elapsed_time, None  # No warning, operation completed in time
 
+    def _start_step(self, step):
+        start_time_dt = datetime.now()
+        print(f"**[{self.format_time(start_time_dt)}]** Starting {step.label}: Moving to {step.degrees} degrees at speed {step.speed} with acceleration {step.acceleration}")
+
+        # Move the motor to the specified degrees with the given speed and acceleration
+        self.servo.run_encoded_motion(step.frame)
+
+    def execute_timeline(self, steps, start_time=None, stop_event=None, on_step=None):
+        """Execute the steps on an absolute timeline computed up front.
+
+        Each step ends at start_time plus the durations of the steps up to it, so the delays
+        of a step are absorbed by the next ones instead of accumulating.
+
+        Args:
+            steps (tuple of CompiledStep): The steps, see compile_sequence.
+            start_time (float, optional): The time.monotonic() at which the timeline starts. Defaults to now.
+            stop_event (CancellationToken, optional): When set, the execution stops without waiting for the end of the step.
+            on_step (callable, optional): Called after each step with (index, step, elapsed_time, warning_msg, jitter),
+                where jitter is the delay in seconds between the scheduled and the actual start of the step.
+
+        Returns:
+            float: The time.monotonic() at which the timeline ends, to chain the next loop of a sequence.
+        """
+        if start_time is None:
+            start_time = time.monotonic()
+        deadlines = list(accumulate((step.duration for step in steps), initial=start_time))
+
+        for i, step in enumerate(steps):
+            if stop_event is not None and stop_event.is_set():
+                break
+            jitter = time.monotonic() - deadlines[i]
+            elapsed_time, warning_msg = self.execute_step(step, deadlines[i + 1], stop_event)
+            if on_step is not None:
+                on_step(i, step, elapsed_time, warning_msg, jitter)
+
+        return deadlines[-1]
+
+    def plan_sequence(self, file_path, start_degrees=None):
+        """Plan a blended motion profile through the steps of a sequence file, see planner.plan_profile.
+
+        The steps of the file are cached until it is modified, with the last profile planned
+        through them. A profile starting from another position is planned again from the cached
+        steps and replaces it, the first segment and the junction speeds depend on the start.
+
+        Args:
+            start_degrees (float, optional): The position at the start of the profile. Defaults to the current position.
+        """
+        if not os.path.exists(file_path):
+            raise FileNotFoundError(f"Sequence file '{file_path}' not found.")
+        if start_degrees is None:
+            start_degrees = self.get_motor_degrees()
+
+        path, mtime = os.path.abspath(file_path), os.path.getmtime(file_path)
+        entry = self._planned_sequences.get(path)
+        if entry is None or entry[0] != mtime:
+            steps = tuple(step._replace(degrees=self.clamp_value(step.degrees, self.config['degrees_max'])) for step in load_sequence(file_path))
+            entry = (mtime, steps, None)
+        mtime, steps, profile = entry
+        if profile is None or not profile.starts_at(start_degrees):
+            profile = plan_profile(steps, start_degrees, self.config['speed_max'], self.config['acceleration_max'])
+            self._planned_sequences[path] = (mtime, steps, profile)
+        return profile
+
+    def execute_profile(self, profile, stop_event=None, on_segment=None, rate_hz=PROFILE_RATE_HZ):
+        """Execute a blended motion profile as streamed speed mode setpoints.
+
+        The motor does not stop at the waypoints. Speed mode has no position feedback, so the
+        residual position error is corrected with an absolute move to the end of the profile.
+
+        Args:
+            profile (MotionProfile): The profile, see plan_sequence.
+            stop_event (CancellationToken, optional): When set, the motor is stopped and the execution ends.
+            on_segment (callable, optional): Called with (index, segment) when each segment starts.
+
+        Returns:
+            dict: The streaming counters, see SpeedStreamer.stats.
+        """
+        if stop_event is None:
+            stop_event = CancellationToken()
+
+        streamer = SpeedStreamer(self.servo, rate_hz, self.config['acceleration_max'], trajectory=profile.speed_at)
+        with self._streamer_lock:
+            # An emergency stop already sent must not be followed by setpoints
+            if stop_event.is_set():
+                return streamer.stats()
+            streamer.start()
+            self._streamer = streamer
+        start_time = time.monotonic()
+        try:
+            for i, segment in enumerate(profile.segments):
+                if stop_event.wait(max(0, start_time + segment.start_time - time.monotonic())):
+                    break
+                print(f"**[{self.format_time(datetime.now())}]** Starting {segment.label}: Blending to {segment.end_degrees} degrees at up to {segment.peak_speed / DEGREES_PER_SECOND_PER_RPM:.0f} RPM")
+                if on_segment is not None:
+                    on_segment(i, segment)
+            else:
+                stop_event.wait(max(0, start_time + profile.duration - time.monotonic()))
+        finally:
+            with self._streamer_lock:
+                self._streamer = None
+            streamer.stop()
+            streamer.wait_for_stop(MOTOR_IDLE_TIMEOUT)
+
+        if not stop_event.is_set() and profile.end_degrees is not None:
+            frame = self.servo.encode_absolute_motion_by_axis(int(self.config['speed_max']), int(self.config['acceleration_max']),
+                self.degrees_to_units(profile.end_degrees))
+            self.servo.run_encoded_motion(frame)
+            while self.wait_for_motor_idle(MOTOR_IDLE_TIMEOUT, stop_event) and not stop_event.is_set():
+                pass
+
+        stats = streamer.stats()
+        if stats['dropped']:
+            print(f"**[{self.format_time(datetime.now())}]** Warning: {stats['dropped']} of {stats['sent']} speed setpoints were not acknowledged.")
+        return stats
+
     def execute_sequence_from_csv(self, file_path):
         """Execute a sequence of instructions from a CSV file."""
-        if os.path.exists(file_path):
-            sequence_df = pd.read_csv(file_path)
-            for _, row in sequence_df.iterrows():
-                self.execute_instruction(row['Degrees'], row['Speed'], row['Acceleration'], row['Duration'], row['Label'])
-        else:
-            raise FileNotFoundError(f"Sequence file '{file_path}' not found.")
+        self.execute_timeline(self.compile_sequence(file_path))
 
     def format_time(self, dt):
         """Format the datetime object to a string with millisecond precision."""
@@ -103,6 +405,122 @@ class ServoController:
         """Get the current position of the motor in degrees."""
         return self.units_to_degrees(self.servo.read_encoder_value_addition())
     
+class MultiAxisController(ServoController):
+    """Controls several servos sharing one CAN bus and notifier, i.e. the head and wing axes of a rig.
+
+    The motion commands of a step are sent to all the axes back-to-back, and only then their
+    responses are collected, so the axes start within the time of a few frames on the bus.
+    With a group ID, the steps moving all the axes to the same target are sent as a single
+    frame addressed to the group, so the axes start at the same time.
+    """
+    def __init__(self, axes, config_path='config.json', can_interface='socketcan', channel='can0', bitrate=500000, group_id=None):
+        """
+        Args:
+            axes (dict): The CAN ID of each axis, keyed by the axis name, i.e. {'head': 1, 'wing': 2}.
+            group_id (int, optional): The group ID assigned to all the axes, see MksServoGroup.assign.
+        """
+        self._setup(config_path, can_interface, channel, bitrate)
+        self.servos = {axis: MksServo(self.bus, self.notifier, device_id) for axis, device_id in axes.items()}
+        self.group = MksServoGroup(group_id, self.servos.values()) if group_id is not None else None
+
+    def wait_for_motor_idle(self, timeout, cancel=None):
+        """Wait for all the axes to finish their current operation or until the timeout is reached.
+
+        Returns True if any axis is still running. The wait ends as soon as cancel is set.
+        """
+        deadline = time.monotonic() + timeout
+        running = False
+        for servo in self.servos.values():
+            running = servo.wait_for_motor_idle(max(0, deadline - time.monotonic()), cancel) or running
+        return running
+
+    def emergency_stop(self):
+        """Stop all the axes immediately, the stop frames are sent back-to-back before waiting for the responses.
+
+        Returns:
+            dict: The SuccessStatus of each axis, None if its stop was not acknowledged.
+        """
+        pending = [(axis, servo.send_request(MksCommands.EMERGENCY_STOP_COMMAND, MksServo.GENERIC_RESPONSE_LENGTH))
+            for axis, servo in self.servos.items()]
+        return {axis: self.servos[axis].wait_status(response) for axis, response in pending}
+
+    def is_motor_busy(self):
+        """Return True if the motion of any axis is running, from the state tracked without querying the servos."""
+        return any(servo.is_motor_busy() for servo in self.servos.values())
+
+    def plan_sequence(self, file_path, start_degrees=None):
+        """Blended profiles stream the speed of a single servo, the axes only run sequences step by step."""
+        raise NotImplementedError("Blended profiles are not supported with several axes, use execute_timeline")
+
+    def execute_profile(self, profile, stop_event=None, on_segment=None, rate_hz=PROFILE_RATE_HZ):
+        """Blended profiles stream the speed of a single servo, see plan_sequence."""
+        raise NotImplementedError("Blended profiles are not supported with several axes, use execute_timeline")
+
+    def compile_step(self, targets, duration, label, row=None):
+        """Clamp the targets of a step and encode the motion command of each axis.
+
+        Args:
+            targets (dict): The AxisTarget of each moving axis, keyed by the axis name.
+        """
+        moves = []
+        for axis, target in targets.items():
+            degrees = self.clamp_value(target.degrees, self.config['degrees_max'])
+            speed = int(self.clamp_value(target.speed, self.config['speed_max']))
+            acceleration = int(self.clamp_value(target.acceleration, self.config['acceleration_max']))
+            frame = self.servos[axis].encode_absolute_motion_by_axis(speed, acceleration, self.degrees_to_units(degrees))
+            moves.append(AxisMove(axis, degrees, speed, acceleration, frame))
+
+        group_frame = None
+        if self.group is not None and len(moves) == len(self.servos) and len({move[1:4] for move in moves}) == 1:
+            move = moves[0]
+            group_frame = self.group.encode_absolute_motion_by_axis(move.speed, move.acceleration, self.degrees_to_units(move.degrees))
+        return CompiledMultiAxisStep(row, tuple(moves), float(duration), str(label), group_frame)
+
+    def _compile_sequence_file(self, file_path):
+        return tuple(self.compile_step(step.targets, step.duration, step.label, row=step.row)
+            for step in load_multi_axis_sequence(file_path, self.servos))
+
+    def execute_instruction(self, targets, duration, label, deadline=None, cancel=None):
+        """Move the axes to their targets and wait until the end of the step."""
+        return self.execute_step(self.compile_step(targets, duration, label), deadline, cancel)
+
+    def run_burst(self, moves):
+        """Send the motion commands of several axes back-to-back, then collect their responses.
+
+        Args:
+            moves (tuple of AxisMove): The moves, see compile_step.
+
+        Returns:
+            dict: The RunMotorResult of each axis, None if its response was not received.
+        """
+        # Check every axis before sending anything, so a busy axis does not leave the others moving alone
+        for move in moves:
+            self.servos[move.axis].check_motor_idle()
+
+        pending = [(move.axis, self.servos[move.axis].start_encoded_motion(move.frame, check_idle=False)) for move in moves]
+
+        deadline = time.perf_counter() + max((servo.timeout for servo in self.servos.values()), default=0)
+        return {axis: self.servos[axis].wait_encoded_motion(response, max(0, deadline - time.perf_counter()))
+            for axis, response in pending}
+
+    def _start_step(self, step):
+        targets = ", ".join(f"{move.axis} to {move.degrees} degrees at speed {move.speed} with acceleration {move.acceleration}" for move in step.moves)
+        print(f"**[{self.format_time(datetime.now())}]** Starting {step.label}: Moving {targets or 'no axis'}")
+
+        if step.group_frame is not None:
+            axes = {servo.can_id: axis for axis, servo in self.servos.items()}
+            results = {axes[can_id]: result for can_id, result in self.group.run_encoded_motion(step.group_frame).items()}
+        else:
+            results = self.run_burst(step.moves)
+
+        for axis, result in results.items():
+            if result is None or result == RunMotorResult.RunFail:
+                print(f"**[{self.format_time(datetime.now())}]** Warning: the axis {axis} did not start its motion: {result}")
+
+    def get_motor_degrees(self) -> dict:
+        """Get the current position of each axis in degrees."""
+        return {axis: self.units_to_degrees(servo.read_encoder_value_addition()) for axis, servo in self.servos.items()}
+
 
 if __name__ == "__main__":
     # Create an instance of the ServoController with the default configuration
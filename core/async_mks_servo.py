@@ -0,0 +1,372 @@
+import asyncio
+
+from core.mks_enums import (MksCommands, Direction, Enable, SuccessStatus, RunMotorResult, MotorStatus, CalibrationResult, GoHomeResult, WorkMode,
+    HoldingStrength, EnPinEnable, CanBitrate, EndStopLevel, Mode0, SaveCleanState)
+from core.can_decoders import RESPONSE_DECODERS
+from core.can_commands import (motor_shaft_protection_status_error, success_status_error, go_back_to_zero_status_error,
+    enable_status_error)
+from core.can_motor import motor_status_error, motor_already_running_error, _speed_mode_payload, _position_payload
+from core.can_set import (gohome_status_error, calibration_error, calibration_not_running, calibration_timeout_error,
+    go_home_timeout_error)
+from core.mks_servo import InvalidResponseError
+
+def _resolve_future(future, data):
+    if not future.done():
+        future.set_result(data)
+
+class AsyncMksServo:
+    """Asyncio client for an MKS Servo.
+
+    The commands are awaitables resolved by the CAN receive path of the wrapped MksServo,
+    so waiting for a response does not block a thread. Only the send, which may wait for the
+    bus held by another thread, runs in the default executor of the loop. It shares the bus,
+    the dispatcher and the tracked state of the servo, so both clients can be used at the
+    same time.
+
+    Attributes:
+        servo (MksServo): The servo used to send the commands.
+    """
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, servo):
+        """Inits AsyncMksServo with the servo.
+
+        Args:
+            servo (MksServo): The servo used to send the commands.
+        """
+        self.servo = servo
+
+    async def set_generic(self, op_code, response_length, data = []):
+        """Sends a generic command via CAN bus and awaits the response.
+
+        Args:
+            op_code (int): Operation code of the command.
+            response_length (int): Expected length of the response message.
+            data (list of bytes, optional): Additional data for the command. Defaults to an empty list.
+
+        Returns:
+            bytearray: The response data, None if the response was not received within servo.timeout.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        # The bus is granted by priority to one thread at a time, the event loop must not wait for it
+        pending = await loop.run_in_executor(None, self.servo.send_request, op_code, response_length, data)
+        pending.add_done_callback(lambda p: loop.call_soon_threadsafe(_resolve_future, future, p.data))
+        try:
+            data = await asyncio.wait_for(future, self.servo.timeout)
+        except asyncio.TimeoutError:
+            await loop.run_in_executor(None, self.servo.abandon_request, pending)
+            return None
+        # The reads are always sent, but the writes still invalidate the cache of the servo
+        if self.servo.cache is not None:
+            self.servo.cache.write_completed(pending.op_code)
+        return data
+
+    async def set_generic_status(self, op_code, data = []):
+        """Sends a generic status command and processes the response.
+
+        Returns:
+            SuccessStatus: The success result of the command, None on timeout.
+        """
+        tmp = await self.set_generic(op_code, self.servo.GENERIC_RESPONSE_LENGTH, data)
+        if tmp is None:
+            return None
+        return self._decode(tmp, InvalidResponseError)
+
+    async def specialized_state(self, op_code, status_enum_exception):
+        """Sends a command answered with a single status byte and decodes it.
+
+        Raises:
+            status_enum_exception: If the status is not a member of the enum of the response.
+        """
+        response_length, _ = RESPONSE_DECODERS[op_code.value]
+        tmp = await self.set_generic(op_code, response_length, [op_code.value])
+        return self._decode(tmp, status_enum_exception)
+
+    async def _read(self, op_code):
+        response_length, decode = RESPONSE_DECODERS[op_code.value]
+        data = await self.set_generic(op_code, response_length, [op_code.value])
+        if data:
+            return decode(data)
+        return None
+
+    def _decode(self, data, status_enum_exception):
+        if data is None:
+            raise status_enum_exception("No response received")
+        try:
+            return RESPONSE_DECODERS[data[0]][1](data)
+        except ValueError:
+            raise status_enum_exception(f"No enum member with value {data[1]}")
+
+    # Read commands, same surface as core/can_commands.py
+
+    async def read_encoder_value_carry(self):
+        """Reads the encoder value. See MksServo.read_encoder_value_carry."""
+        return await self._read(MksCommands.READ_ENCODER_VALUE_CARRY)
+
+    async def read_encoder_value_addition(self):
+        """Reads the encoder value in addition mode. See MksServo.read_encoder_value_addition."""
+        return await self._read(MksCommands.READ_ENCODED_VALUE_ADDITION)
+
+    async def read_motor_speed(self):
+        """Reads the real-time speed of the motor (RPM). See MksServo.read_motor_speed."""
+        return await self._read(MksCommands.READ_MOTOR_SPEED)
+
+    async def read_num_pulses_received(self):
+        """Reads the number of pulses received. See MksServo.read_num_pulses_received."""
+        return await self._read(MksCommands.READ_NUM_PULSES_RECEIVED)
+
+    async def read_io_port_status(self):
+        """Reads the IO Ports status. See MksServo.read_io_port_status."""
+        return await self._read(MksCommands.READ_IO_PORT_STATUS)
+
+    async def read_motor_shaft_angle_error(self):
+        """Reads the error on the motor shaft angle. See MksServo.read_motor_shaft_angle_error."""
+        return await self._read(MksCommands.READ_MOTOR_SHAFT_ANGLE_ERROR)
+
+    async def read_en_pins_status(self):
+        """Reads the En pins status. See MksServo.read_en_pins_status."""
+        return await self.specialized_state(MksCommands.READ_EN_PINS_STATUS, enable_status_error)
+
+    async def read_go_back_to_zero_status_when_power_on(self):
+        """Reads the go back to zero status when power on. See MksServo.read_go_back_to_zero_status_when_power_on."""
+        return await self.specialized_state(MksCommands.READ_GO_BACK_TO_ZERO_STATUS_WHEN_POWER_ON, go_back_to_zero_status_error)
+
+    async def release_motor_shaft_locked_protection_state(self):
+        """Releases the motor shaft locked-rotor protection state. See MksServo.release_motor_shaft_locked_protection_state."""
+        return await self.specialized_state(MksCommands.RELEASE_MOTOR_SHAFT_LOCKED_PROTECTION_STATE, success_status_error)
+
+    async def read_motor_shaft_protection_state(self):
+        """Reads the motor shaft protection state. See MksServo.read_motor_shaft_protection_state."""
+        return await self.specialized_state(MksCommands.READ_MOTOR_SHAFT_PROTECTION_STATE, motor_shaft_protection_status_error)
+
+    # Motor commands, same surface as core/can_motor.py
+
+    async def query_motor_status(self):
+        """Queries the motor status. See MksServo.query_motor_status."""
+        return await self.specialized_state(MksCommands.QUERY_MOTOR_STATUS_COMMAND, motor_status_error)
+
+    async def enable_motor(self, enable: Enable):
+        """Enables or disables the motor. See MksServo.enable_motor."""
+        return await self.set_generic_status(MksCommands.ENABLE_MOTOR_COMMAND, enable.value)
+
+    async def emergency_stop_motor(self):
+        """Runs the emergency motor stop. See MksServo.emergency_stop_motor."""
+        return await self.set_generic_status(MksCommands.EMERGENCY_STOP_COMMAND)
+
+    async def run_motor_in_speed_mode(self, direction: Direction, speed, acceleration):
+        """Runs the motor in speed mode. See MksServo.run_motor_in_speed_mode."""
+        self.servo._validate_direction(direction)
+        self.servo._validate_speed(speed)
+        self.servo._validate_acceleration(acceleration)
+        status = await self.set_generic_status(MksCommands.RUN_MOTOR_SPEED_MODE_COMMAND,
+            _speed_mode_payload(direction, speed, acceleration))
+        if status == SuccessStatus.Success:
+            self.servo._set_speed_mode_speed(speed)
+        return status
+
+    async def save_clean_in_speed_mode(self, state: SaveCleanState):
+        """Sets the save/clean parameter state in speed mode. See MksServo.save_clean_in_speed_mode."""
+        return await self.set_generic_status(MksCommands.SAVE_CLEAN_IN_SPEED_MODE_COMMAND)
+
+    async def is_motor_running(self):
+        """Returns the current running state of the motor. See MksServo.is_motor_running."""
+        return await self.query_motor_status() != MotorStatus.MotorStop
+
+    async def wait_for_motor_idle(self, timeout):
+        """
+        Waits until the motor stops running or the timeout time is meet. See MksServo.wait_for_motor_idle.
+
+        Args:
+            timeout (double): Maximum number of seconds to wait for the motor to stop.
+
+        Returns:
+            boolean: The running state of the motor at the end of this method.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        remaining = timeout
+        while remaining > 0:
+            future = loop.create_future()
+            self.servo.add_motor_idle_callback(lambda: loop.call_soon_threadsafe(_resolve_future, future, True))
+            try:
+                await asyncio.wait_for(future, min(remaining, self.servo.MOTOR_IDLE_POLL_INTERVAL))
+                return False
+            except asyncio.TimeoutError:
+                if not await self.is_motor_running():
+                    return False
+            remaining = deadline - loop.time()
+        return await self.is_motor_running()
+
+    async def _run_motor(self, op_code, cmd):
+        running = await self.is_motor_running() if self.servo.strict_motion_guard else self.servo.is_motor_busy()
+        if running:
+            raise motor_already_running_error("")
+        tmp = await self.set_generic(op_code, self.servo.GENERIC_RESPONSE_LENGTH, cmd)
+        return self._decode(tmp, motor_status_error)
+
+    async def run_motor_relative_motion_by_pulses(self, direction: Direction, speed, acceleration, pulses):
+        """The motor runs to the relative position. See MksServo.run_motor_relative_motion_by_pulses."""
+        self.servo._validate_direction(direction)
+        self.servo._validate_speed(speed)
+        self.servo._validate_pulses(pulses)
+        direction_value = 0x80 if direction == Direction.CW else 0
+        return await self._run_motor(MksCommands.RUN_MOTOR_RELATIVE_MOTION_BY_PULSES_COMMAND,
+            _position_payload(direction_value + ((speed >> 8) & 0b1111), speed, acceleration, pulses))
+
+    async def run_motor_absolute_motion_by_pulses(self, speed, acceleration, absolute_pulses):
+        """The motor runs to the specified position. See MksServo.run_motor_absolute_motion_by_pulses."""
+        self.servo._validate_speed(speed)
+        self.servo._validate_pulses(absolute_pulses)
+        return await self._run_motor(MksCommands.RUN_MOTOR_ABSOLUTE_MOTION_BY_PULSES_COMMAND,
+            _position_payload((speed >> 8), speed, acceleration, absolute_pulses))
+
+    async def run_motor_relative_motion_by_axis(self, speed, acceleration, relative_axis):
+        """The motor runs relative to the axis. See MksServo.run_motor_relative_motion_by_axis."""
+        self.servo._validate_speed(speed)
+        self.servo._validate_acceleration(acceleration)
+        return await self._run_motor(MksCommands.RUN_MOTOR_RELATIVE_MOTION_BY_AXIS_COMMAND,
+            _position_payload(((speed >> 8) & 0b1111), speed, acceleration, relative_axis))
+
+    async def run_motor_absolute_motion_by_axis(self, speed, acceleration, absolute_axis):
+        """The motor runs to the specified axis. See MksServo.run_motor_absolute_motion_by_axis."""
+        self.servo._validate_speed(speed)
+        self.servo._validate_acceleration(acceleration)
+        return await self._run_motor(MksCommands.RUN_MOTOR_ABSOLUTE_MOTION_BY_AXIS_COMMAND,
+            _position_payload(((speed >> 8) & 0b1111), speed, acceleration, absolute_axis))
+
+    # Set commands, same surface as core/can_set.py
+
+    async def nb_calibrate_encoder(self):
+        """Initiates the calibration procedure of the encoder. See MksServo.nb_calibrate_encoder."""
+        tmp = await self.set_generic(MksCommands.MOTOR_CALIBRATION_COMMAND, self.servo.GENERIC_RESPONSE_LENGTH, 0x00)
+        rslt = self._decode(tmp, calibration_error)
+        self.servo._set_calibration_status(rslt)
+        return rslt
+
+    async def b_calibrate_encoder(self):
+        """Does the calibration procedure of the encoder. See MksServo.b_calibrate_encoder."""
+        await self.nb_calibrate_encoder()
+        return await self.wait_for_calibration()
+
+    async def wait_for_calibration(self):
+        """Waits until the calibration procedure completes. See MksServo.wait_for_calibration."""
+        if self.servo._calibration_status == CalibrationResult.Unkown:
+            raise calibration_not_running("")
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.servo.MAX_CALIBRATION_TIME
+        while loop.time() < deadline and self.servo._calibration_status == CalibrationResult.Calibrating:
+            await asyncio.sleep(self.POLL_INTERVAL)
+
+        if self.servo._calibration_status not in (CalibrationResult.CalibratedSuccess, CalibrationResult.CalibratingFail):
+            raise calibration_timeout_error("")
+        return self.servo._calibration_status
+
+    async def set_work_mode(self, mode: WorkMode):
+        """Sets the working mode of the servo. See MksServo.set_work_mode."""
+        return await self.set_generic_status(MksCommands.SET_WORK_MODE_COMMAND, mode.value)
+
+    async def set_working_current(self, current):
+        """Sets the working current. See MksServo.set_working_current."""
+        self.servo._validate_current(current)
+        return await self.set_generic_status(MksCommands.SET_WORKING_CURRENT_COMMAND, [(current >> 8) & 0xFF, current & 0xFF])
+
+    async def set_holding_current(self, strength: HoldingStrength):
+        """Sets the holding current. See MksServo.set_holding_current."""
+        return await self.set_generic_status(MksCommands.SET_HOLDING_CURRENT, strength.value)
+
+    async def set_subdivisions(self, mstep):
+        """Sets the subdivisions. See MksServo.set_subdivisions."""
+        return await self.set_generic_status(MksCommands.SET_SUBDIVISIONS_COMMAND, mstep)
+
+    async def set_en_pin_config(self, enable: EnPinEnable):
+        """Sets the active of the enable pins. See MksServo.set_en_pin_config."""
+        return await self.set_generic_status(MksCommands.SET_EN_PIN_CONFIG_COMMAND, enable.value)
+
+    async def set_motor_rotation_direction(self, direction: Direction):
+        """Sets the direction of motor rotation. See MksServo.set_motor_rotation_direction."""
+        return await self.set_generic_status(MksCommands.SET_MOTOR_ROTATION_DIRECTION, direction.value)
+
+    async def set_auto_turn_off_screen(self, enable: Enable):
+        """Sets the auto turn off function of the screen. See MksServo.set_auto_turn_off_screen."""
+        return await self.set_generic_status(MksCommands.SET_AUTO_TURN_OFF_SCREEN_COMMAND, enable.value)
+
+    async def set_motor_shaft_locked_rotor_protection(self, enable: Enable):
+        """Sets the motor shaft protection. See MksServo.set_motor_shaft_locked_rotor_protection."""
+        return await self.set_generic_status(MksCommands.SET_MOTOR_SHAFT_LOCKED_ROTOR_PROTECTION_COMMAND, enable.value)
+
+    async def set_subdivision_interpolation(self, enable: Enable):
+        """Sets the subdivision interpolation function. See MksServo.set_subdivision_interpolation."""
+        return await self.set_generic_status(MksCommands.SET_SUBDIVISION_INTERPOLATION_COMMAND, enable.value)
+
+    async def set_can_bitrate(self, bitrate: CanBitrate):
+        """Sets the can bitrate. See MksServo.set_can_bitrate."""
+        return await self.set_generic_status(MksCommands.SET_CAN_BITRATE_COMMAND, bitrate.value)
+
+    async def set_can_id(self, can_id):
+        """Sets the can id. See MksServo.set_can_id."""
+        return await self.set_generic_status(MksCommands.SET_CAN_ID_COMMAND, [(can_id >> 8) & 0xF, can_id & 0xFF])
+
+    async def set_slave_respond_active(self, respon, active):
+        """Sets the slave respond and active. Not implemented, see MksServo.set_slave_respond_active.
+
+        Raises:
+            NotImplementedError: Always.
+        """
+        raise NotImplementedError("set_slave_respond_active is not implemented")
+
+    async def set_key_lock(self, enable: Enable):
+        """Sets the key lock. See MksServo.set_key_lock."""
+        return await self.set_generic_status(MksCommands.SET_KEY_LOCK_ENABLE_COMMAND, enable.value)
+
+    async def set_group_id(self, group_id):
+        """Sets the group id. See MksServo.set_group_id."""
+        return await self.set_generic_status(MksCommands.SET_GROUP_ID_COMMAND, [(group_id >> 8) & 0xF, group_id & 0xFF])
+
+    async def set_home(self, homeTrig : EndStopLevel, homeDir: Direction, homeSpeed, endLimit: Enable):
+        """Sets the parameter of Home. See MksServo.set_home."""
+        return await self.set_generic_status(MksCommands.SET_HOME_COMMAND,
+            [homeTrig.value, homeDir.value, (homeSpeed >> 8) & 0xF, homeSpeed & 0xFF, endLimit.value])
+
+    async def nb_go_home(self):
+        """Goes home. See MksServo.nb_go_home."""
+        tmp = await self.set_generic(MksCommands.GO_HOME_COMMAND, self.servo.GENERIC_RESPONSE_LENGTH)
+        rslt = self._decode(tmp, gohome_status_error)
+        self.servo._set_homing_status(rslt)
+        return rslt
+
+    async def b_go_home(self):
+        """Goes home and blocks until the procedure completes. See MksServo.b_go_home."""
+        await self.nb_go_home()
+        return await self.wait_for_go_home()
+
+    async def wait_for_go_home(self):
+        """Waits until the go home procedure completes. See MksServo.wait_for_go_home."""
+        if self.servo._homing_status == GoHomeResult.Unkown:
+            raise calibration_not_running("")
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.servo.MAX_HOMING_TIME
+        while loop.time() < deadline and self.servo._homing_status == GoHomeResult.Start:
+            await asyncio.sleep(self.POLL_INTERVAL)
+
+        if self.servo._homing_status not in (GoHomeResult.Success, GoHomeResult.Fail):
+            raise go_home_timeout_error("")
+        return self.servo._homing_status
+
+    async def set_current_axis_to_zero(self):
+        """Sets current axis to zero. See MksServo.set_current_axis_to_zero."""
+        return await self.set_generic_status(MksCommands.SET_CURRENT_AXIS_TO_ZERO_COMMAND)
+
+    async def set_limit_port_remap(self, enable: Enable):
+        """Sets the limit port remap. See MksServo.set_limit_port_remap."""
+        return await self.set_generic_status(MksCommands.SET_LIMIT_PORT_REMAP_COMMAND, enable.value)
+
+    async def set_mode0(self, mode : Mode0, enable : Enable, speed, direction: Direction):
+        """Sets mode 0. See MksServo.set_mode0."""
+        return await self.set_generic_status(MksCommands.SET_MODE0_COMMAND, [mode.value, enable.value, speed, direction.value])
+
+    async def restore_default_parameters(self):
+        """Restores the default parameters. See MksServo.restore_default_parameters."""
+        return await self.set_generic_status(MksCommands.RESTORE_DEFAULT_PARAMETERS_COMMAND)
@@ -0,0 +1,91 @@
+import threading
+import time
+from enum import Enum
+
+from core.mks_enums import MksCommands
+
+# Suggested time to live, in seconds, of the reads of slow-changing state
+DEFAULT_CACHE_TTLS = {
+    MksCommands.READ_EN_PINS_STATUS: 1.0,
+    MksCommands.READ_GO_BACK_TO_ZERO_STATUS_WHEN_POWER_ON: 10.0,
+    MksCommands.READ_MOTOR_SHAFT_PROTECTION_STATE: 0.5,
+}
+
+# Write commands -> the reads whose cached responses they make stale. None clears all the cache.
+CACHE_INVALIDATIONS = {
+    MksCommands.ENABLE_MOTOR_COMMAND.value: (MksCommands.READ_EN_PINS_STATUS.value,),
+    MksCommands.SET_EN_PIN_CONFIG_COMMAND.value: (MksCommands.READ_EN_PINS_STATUS.value,),
+    MksCommands.SET_MODE0_COMMAND.value: (MksCommands.READ_GO_BACK_TO_ZERO_STATUS_WHEN_POWER_ON.value,),
+    MksCommands.SET_HOME_COMMAND.value: (MksCommands.READ_GO_BACK_TO_ZERO_STATUS_WHEN_POWER_ON.value,),
+    MksCommands.SET_MOTOR_SHAFT_LOCKED_ROTOR_PROTECTION_COMMAND.value: (MksCommands.READ_MOTOR_SHAFT_PROTECTION_STATE.value,),
+    MksCommands.RELEASE_MOTOR_SHAFT_LOCKED_PROTECTION_STATE.value: (MksCommands.READ_MOTOR_SHAFT_PROTECTION_STATE.value,),
+    MksCommands.RESTORE_DEFAULT_PARAMETERS_COMMAND.value: None,
+}
+
+def _op_value(op_code):
+    return op_code.value if isinstance(op_code, Enum) else op_code
+
+class ResponseCache:
+    """Responses of slow-changing reads, kept for a time to live per op code.
+
+    Each op code has a generation incremented when its entries are invalidated, so the response
+    of a read sent before a write is not cached after the write completes.
+    """
+    def __init__(self, ttls):
+        """
+        Args:
+            ttls (dict): The time to live in seconds of each cached read, keyed by its MksCommands.
+                The reads not in it are never cached.
+        """
+        self.ttls = {_op_value(op_code): ttl for op_code, ttl in ttls.items()}
+        self._entries = {}
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def caches(self, op_code):
+        """Returns True if the responses of op_code are cached."""
+        return op_code in self.ttls
+
+    def generation(self, op_code):
+        """Returns the generation of op_code, to pass to put."""
+        return self._generations.get(op_code, 0)
+
+    def get(self, op_code, key):
+        """
+        Returns the cached response of a read.
+
+        Args:
+            op_code (int): Operation code of the read.
+            key (tuple): The data of the read.
+
+        Returns:
+            bytes: The response data, None if it is not cached or expired.
+        """
+        entry = self._entries.get((op_code, key))
+        if entry is None or time.monotonic() >= entry[0]:
+            return None
+        return entry[1]
+
+    def put(self, op_code, key, data, generation):
+        """Caches the response of a read, unless op_code was invalidated since generation."""
+        with self._lock:
+            if self._generations.get(op_code, 0) == generation:
+                self._entries[(op_code, key)] = (time.monotonic() + self.ttls[op_code], bytes(data))
+
+    def invalidate(self, op_codes=None):
+        """
+        Removes the cached responses of some reads.
+
+        Args:
+            op_codes (list, optional): The op codes of the reads. Defaults to all of them.
+        """
+        with self._lock:
+            op_codes = list(self.ttls) if op_codes is None else [_op_value(op_code) for op_code in op_codes]
+            for op_code in op_codes:
+                self._generations[op_code] = self._generations.get(op_code, 0) + 1
+            self._entries = {entry_key: entry for entry_key, entry in self._entries.items() if entry_key[0] not in op_codes}
+
+    def write_completed(self, op_code):
+        """Invalidates the reads made stale by the write command op_code, see CACHE_INVALIDATIONS."""
+        if op_code in CACHE_INVALIDATIONS:
+            self.invalidate(CACHE_INVALIDATIONS[op_code])
@@ -44,7 +44,7 @@ def read_encoder_value_carry(self):
     op_code = MksCommands.READ_ENCODER_VALUE_CARRY
     response_length = 8
 
-    data = self.set_generic(op_code, response_length, [op_code])
+    data = self.set_generic(op_code, response_length, [op_code.value])
 
     if data:
         carry = int.from_bytes(data[1:5], byteorder='big', signed=True)
@@ -138,7 +138,7 @@ def read_io_port_status(self):
     Raises:
         can.CanError: If there is an error in sending the CAN message.
     """        
-    op_code = MksCommands.READ_NUM_PULSES_RECEIVED
+    op_code = MksCommands.READ_IO_PORT_STATUS
     response_length = 3
     data = self.set_generic(op_code, response_length, [op_code.value])
 
@@ -176,10 +176,14 @@ def read_motor_shaft_angle_error(self):
         return int.from_bytes(data[1:5], byteorder='big', signed=True)                                
     return None  
 
-def read_en_pins_status(self):
+def read_en_pins_status(self, use_cache = True):
     """
     Reads the En pins status
 
+    Args:
+        use_cache (bool, optional): If False, the status is read from the servo even when its
+            response is cached, see MksServo.cache.
+
     Returns:
         int: If successful, returns the enable pin status.
         None: if there's an error in sending the message, a self.timeout occurs, or the response is 
@@ -188,13 +192,17 @@ def read_en_pins_status(self):
     Raises:
         can.CanError: If there is an error in sending the CAN message.
     """     
-    return self.specialized_state(self.READ_EN_PINS_STATUS, 
-        EnableStatus, enable_status_error)                   
+    return self.specialized_state(MksCommands.READ_EN_PINS_STATUS, 
+        EnableStatus, enable_status_error, use_cache)                   
 
-def read_go_back_to_zero_status_when_power_on(self):
+def read_go_back_to_zero_status_when_power_on(self, use_cache = True):
     """
     Reads the go back to zero status when power on
 
+    Args:
+        use_cache (bool, optional): If False, the status is read from the servo even when its
+            response is cached, see MksServo.cache.
+
     Returns:
         int: If successful, returns the go back to zero status.
         None: if there's an error in sending the message, a self.timeout occurs, or the response is 
@@ -203,8 +211,8 @@ def read_go_back_to_zero_status_when_power_on(self):
     Raises:
         can.CanError: If there is an error in sending the CAN message.
     """    
-    return self.specialized_state(self.READ_GO_BACK_TO_ZERO_STATUS_WHEN_POWER_ON, 
-        GoBackToZeroStatus, go_back_to_zero_status_error) 
+    return self.specialized_state(MksCommands.READ_GO_BACK_TO_ZERO_STATUS_WHEN_POWER_ON, 
+        GoBackToZeroStatus, go_back_to_zero_status_error, use_cache) 
 
 def release_motor_shaft_locked_protection_state(self):
     """
@@ -218,13 +226,17 @@ def release_motor_shaft_locked_protection_state(self):
     Raises:
         can.CanError: If there is an error in sending the CAN message.
     """        
-    return self.specialized_state(self.RELEASE_MOTOR_SHAFT_LOCKED_PROTECTION_STATE, 
+    return self.specialized_state(MksCommands.RELEASE_MOTOR_SHAFT_LOCKED_PROTECTION_STATE, 
         SuccessStatus, success_status_error) 
 
-def read_motor_shaft_protection_state(self):
+def read_motor_shaft_protection_state(self, use_cache = True):
     """
     Read the motor shaft protection state.
 
+    Args:
+        use_cache (bool, optional): If False, the status is read from the servo even when its
+            response is cached, see MksServo.cache.
+
     Returns:
         int: If successful, returns the motor shaft protection state.
         None: if there's an error in sending the message, a self.timeout occurs, or the response is 
@@ -233,6 +245,6 @@ def read_motor_shaft_protection_state(self):
     Raises:
         can.CanError: If there is an error in sending the CAN message.
     """                 
-    return self.specialized_state(self.READ_MOTOR_SHAFT_PROTECTION_STATE, 
-        MotorShaftProtectionStatus, motor_shaft_protection_status_error)
+    return self.specialized_state(MksCommands.READ_MOTOR_SHAFT_PROTECTION_STATE, 
+        MotorShaftProtectionStatus, motor_shaft_protection_status_error, use_cache)
 
@@ -0,0 +1,89 @@
+from core.mks_enums import (MksCommands, SuccessStatus, EnableStatus, GoBackToZeroStatus, MotorShaftProtectionStatus,
+    MotorStatus, CalibrationResult, GoHomeResult, RunMotorResult)
+
+GENERIC_RESPONSE_LENGTH = 3
+
+def decode_encoder_value_carry(data):
+    """Decodes the READ_ENCODER_VALUE_CARRY response into a dictionary with 'carry' and 'value'."""
+    return {
+        'carry': int.from_bytes(data[1:5], byteorder='big', signed=True),
+        'value': int.from_bytes(data[5:7], byteorder='big', signed=True)
+    }
+
+def decode_encoder_value_addition(data):
+    """Decodes the READ_ENCODED_VALUE_ADDITION response into the encoder value."""
+    return int.from_bytes(data[1:7], byteorder='big', signed=True)
+
+def decode_motor_speed(data):
+    """Decodes the READ_MOTOR_SPEED response into the motor speed in RPM."""
+    return int.from_bytes(data[1:3], byteorder='big', signed=True)
+
+def decode_num_pulses_received(data):
+    """Decodes the READ_NUM_PULSES_RECEIVED response into the number of pulses."""
+    return int.from_bytes(data[1:5], byteorder='big', signed=True)
+
+def decode_io_port_status(data):
+    """Decodes the READ_IO_PORT_STATUS response into the port status bits."""
+    return data[1]
+
+def decode_motor_shaft_angle_error(data):
+    """Decodes the READ_MOTOR_SHAFT_ANGLE_ERROR response into the angle error."""
+    return int.from_bytes(data[1:5], byteorder='big', signed=True)
+
+def status_decoder(status_enum):
+    """
+    Creates a decoder for the responses carrying a single status byte.
+
+    Args:
+        status_enum (Enum): The enum of the status.
+
+    Returns:
+        callable: The decoder. It raises ValueError if the status is not a member of the enum.
+    """
+    def decode_status(data):
+        return status_enum(data[1])
+    return decode_status
+
+# Responses that are not a plain SuccessStatus: op code -> (response length, decoder)
+_SPECIALIZED_DECODERS = {
+    MksCommands.READ_ENCODER_VALUE_CARRY: (8, decode_encoder_value_carry),
+    MksCommands.READ_ENCODED_VALUE_ADDITION: (8, decode_encoder_value_addition),
+    MksCommands.READ_MOTOR_SPEED: (4, decode_motor_speed),
+    MksCommands.READ_NUM_PULSES_RECEIVED: (6, decode_num_pulses_received),
+    MksCommands.READ_IO_PORT_STATUS: (GENERIC_RESPONSE_LENGTH, decode_io_port_status),
+    MksCommands.READ_MOTOR_SHAFT_ANGLE_ERROR: (6, decode_motor_shaft_angle_error),
+    MksCommands.READ_EN_PINS_STATUS: (GENERIC_RESPONSE_LENGTH, status_decoder(EnableStatus)),
+    MksCommands.READ_GO_BACK_TO_ZERO_STATUS_WHEN_POWER_ON: (GENERIC_RESPONSE_LENGTH, status_decoder(GoBackToZeroStatus)),
+    MksCommands.READ_MOTOR_SHAFT_PROTECTION_STATE: (GENERIC_RESPONSE_LENGTH, status_decoder(MotorShaftProtectionStatus)),
+    MksCommands.QUERY_MOTOR_STATUS_COMMAND: (GENERIC_RESPONSE_LENGTH, status_decoder(MotorStatus)),
+    MksCommands.MOTOR_CALIBRATION_COMMAND: (GENERIC_RESPONSE_LENGTH, status_decoder(CalibrationResult)),
+    MksCommands.GO_HOME_COMMAND: (GENERIC_RESPONSE_LENGTH, status_decoder(GoHomeResult)),
+    MksCommands.RUN_MOTOR_RELATIVE_MOTION_BY_PULSES_COMMAND: (GENERIC_RESPONSE_LENGTH, status_decoder(RunMotorResult)),
+    MksCommands.RUN_MOTOR_ABSOLUTE_MOTION_BY_PULSES_COMMAND: (GENERIC_RESPONSE_LENGTH, status_decoder(RunMotorResult)),
+    MksCommands.RUN_MOTOR_RELATIVE_MOTION_BY_AXIS_COMMAND: (GENERIC_RESPONSE_LENGTH, status_decoder(RunMotorResult)),
+    MksCommands.RUN_MOTOR_ABSOLUTE_MOTION_BY_AXIS_COMMAND: (GENERIC_RESPONSE_LENGTH, status_decoder(RunMotorResult)),
+}
+
+_decode_success_status = status_decoder(SuccessStatus)
+
+# Built once from MksCommands: op code value -> (response length, decoder)
+RESPONSE_DECODERS = {
+    command.value: _SPECIALIZED_DECODERS.get(command, (GENERIC_RESPONSE_LENGTH, _decode_success_status))
+    for command in MksCommands
+}
+
+def decode_response(data):
+    """
+    Decodes a response using the decoder of its op code.
+
+    Args:
+        data (bytearray): The data of the response message, including the op code and the CRC.
+
+    Returns:
+        object: The decoded response.
+
+    Raises:
+        KeyError: If the op code is unknown.
+        ValueError: If the status is not a member of the enum of the response.
+    """
+    return RESPONSE_DECODERS[data[0]][1](data)
@@ -0,0 +1,187 @@
+import logging
+import threading
+import time
+import weakref
+from collections import deque
+
+class PendingResponse:
+    """A request waiting for its response.
+
+    The slot is resolved by the CanDispatcher, from the notifier thread, as soon as a
+    frame with the matching arbitration id and op code is received.
+
+    Attributes:
+        can_id (int): The CAN ID of the servo the request was sent to.
+        op_code (int): Operation code of the request.
+        response_length (int): Expected length of the response message.
+        data (bytearray): The response data, None until the response is received.
+        sent_at (float): time.perf_counter() when the request was sent.
+        abandoned (bool): Set by the first caller giving up on the response, so a request shared
+            by several callers is discarded and counted as a timeout once.
+    """
+    __slots__ = ('can_id', 'op_code', 'response_length', 'data', 'sent_at', 'abandoned', '_event', '_callbacks')
+
+    _callbacks_lock = threading.Lock()
+
+    def __init__(self, can_id, op_code, response_length):
+        self.can_id = can_id
+        self.op_code = op_code
+        self.response_length = response_length
+        self.data = None
+        self.sent_at = time.perf_counter()
+        self.abandoned = False
+        self._event = threading.Event()
+        self._callbacks = []
+
+    def set_result(self, data):
+        """Stores the response data and wakes up the waiting callers."""
+        self.data = data
+        with PendingResponse._callbacks_lock:
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, None
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        """
+        Adds a callback invoked with this slot when the response is received.
+
+        The callback runs on the notifier thread, or immediately if the response was
+        already received, so it must not block.
+
+        Args:
+            callback (callable): The function to call.
+        """
+        with PendingResponse._callbacks_lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def done(self):
+        """Returns True if the response has been received."""
+        return self._event.is_set()
+
+    def wait(self, timeout):
+        """
+        Waits for the response.
+
+        Args:
+            timeout (float): Maximum number of seconds to wait for the response.
+
+        Returns:
+            bytearray: The response data, None if the timeout expired.
+        """
+        self._event.wait(timeout)
+        return self.data
+
+class CanDispatcher:
+    """Routes the frames received on a bus to the servos and their pending requests.
+
+    A single dispatcher is registered as listener of the notifier, so sending a command
+    does not add or remove listeners. Frames are routed in O(1) by arbitration id to
+    the servo message handler and by (arbitration id, op code) to the oldest pending
+    request.
+    """
+    _instances = weakref.WeakKeyDictionary()
+    _instances_lock = threading.Lock()
+
+    @classmethod
+    def for_notifier(cls, notifier):
+        """
+        Returns the dispatcher attached to a notifier, creating it on first use.
+
+        Args:
+            notifier (can.Notifier): The notifier of the bus.
+
+        Returns:
+            CanDispatcher: The dispatcher shared by all the servos of the bus.
+        """
+        with cls._instances_lock:
+            dispatcher = cls._instances.get(notifier)
+            if dispatcher is None:
+                dispatcher = cls(notifier)
+                cls._instances[notifier] = dispatcher
+            return dispatcher
+
+    def __init__(self, notifier):
+        self._handlers = {}
+        self._metrics = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+        notifier.add_listener(self)
+
+    def register(self, can_id, handler, metrics=None):
+        """
+        Registers the message handler of a servo.
+
+        Args:
+            can_id (int): The CAN ID of the servo.
+            handler (callable): Called with every frame received from can_id. It returns
+                False if the frame is invalid and must not resolve a pending request.
+            metrics (ServoMetrics, optional): Records the responses and their latency.
+        """
+        self._handlers[can_id] = handler
+        if metrics is not None:
+            self._metrics[can_id] = metrics
+
+    def unregister(self, can_id):
+        """Removes the message handler of a servo."""
+        self._handlers.pop(can_id, None)
+        self._metrics.pop(can_id, None)
+
+    def expect(self, can_id, op_code, response_length):
+        """
+        Registers a pending request. It must be called before sending the request.
+
+        Args:
+            can_id (int): The CAN ID of the servo.
+            op_code (int): Operation code of the request.
+            response_length (int): Expected length of the response message.
+
+        Returns:
+            PendingResponse: The slot resolved when the response is received.
+        """
+        pending = PendingResponse(can_id, op_code, response_length)
+        with self._lock:
+            self._pending.setdefault((can_id, op_code), deque()).append(pending)
+        return pending
+
+    def discard(self, pending):
+        """Removes a pending request that will not be waited anymore (i.e. timeout)."""
+        key = (pending.can_id, pending.op_code)
+        with self._lock:
+            waiting = self._pending.get(key)
+            if waiting is None:
+                return
+            try:
+                waiting.remove(pending)
+            except ValueError:
+                pass
+            if not waiting:
+                del self._pending[key]
+
+    def __call__(self, message):
+        if message.is_error_frame or not message.data:
+            return
+
+        handler = self._handlers.get(message.arbitration_id)
+        if handler is None or handler(message) is False:
+            return
+
+        key = (message.arbitration_id, message.data[0])
+        with self._lock:
+            waiting = self._pending.get(key)
+            if not waiting:
+                return
+            pending = waiting.popleft()
+            if not waiting:
+                del self._pending[key]
+
+        length_ok = len(message.data) == pending.response_length
+        if not length_ok:
+            logging.error(f"Unexpected response length or opcode.")
+        metrics = self._metrics.get(message.arbitration_id)
+        if metrics is not None:
+            metrics.record_response(pending.op_code, time.perf_counter() - pending.sent_at, length_ok)
+        pending.set_result(message.data)
@@ -0,0 +1,183 @@
+import threading
+from bisect import bisect_left
+
+from core.mks_enums import MksCommands
+
+# Upper bounds of the response latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+class OpcodeMetrics:
+    """Counters and response latency histogram of a single op code.
+
+    Attributes:
+        sent (int): Requests sent waiting for a response, so sent = received + timeouts once none is pending.
+        sent_without_response (int): Fire-and-forget requests sent, whose response is not waited for.
+        received (int): Responses received for a pending request.
+        timeouts (int): Requests whose response was not received in time.
+        crc_failures (int): Frames with this op code dropped because of an invalid CRC.
+        unexpected_lengths (int): Responses whose length is not the expected one.
+        coalesced (int): Reads not sent because an identical one was already waiting for its response.
+        latency_counts (list of int): Responses per latency bucket, the last one is +Inf.
+        latency_sum (float): Sum of the response latencies in seconds.
+    """
+    __slots__ = ('sent', 'sent_without_response', 'received', 'timeouts', 'crc_failures', 'unexpected_lengths', 'coalesced', 'latency_counts', 'latency_sum')
+
+    def __init__(self):
+        self.sent = 0
+        self.sent_without_response = 0
+        self.received = 0
+        self.timeouts = 0
+        self.crc_failures = 0
+        self.unexpected_lengths = 0
+        self.coalesced = 0
+        self.latency_counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+
+    def as_dict(self):
+        return {
+            'sent': self.sent,
+            'sent_without_response': self.sent_without_response,
+            'received': self.received,
+            'timeouts': self.timeouts,
+            'crc_failures': self.crc_failures,
+            'unexpected_lengths': self.unexpected_lengths,
+            'coalesced': self.coalesced,
+            'latency_buckets': dict(zip(LATENCY_BUCKETS + (float('inf'),), self.latency_counts)),
+            'latency_sum': self.latency_sum,
+        }
+
+class ServoMetrics:
+    """Always-on request counters of a servo, per op code.
+
+    Recording only increments counters under a lock, so it is cheap enough to be done
+    on every frame, from the caller threads and from the notifier thread.
+
+    Attributes:
+        unknown_frames (int): Received frames whose op code is unknown.
+    """
+    def __init__(self):
+        self._opcodes = {}
+        self._lock = threading.Lock()
+        self.unknown_frames = 0
+
+    def _get(self, op_code):
+        metrics = self._opcodes.get(op_code)
+        if metrics is None:
+            metrics = self._opcodes[op_code] = OpcodeMetrics()
+        return metrics
+
+    def record_sent(self, op_code, expects_response=True):
+        with self._lock:
+            metrics = self._get(op_code)
+            if expects_response:
+                metrics.sent += 1
+            else:
+                metrics.sent_without_response += 1
+
+    def record_response(self, op_code, latency, length_ok=True):
+        bucket = bisect_left(LATENCY_BUCKETS, latency)
+        with self._lock:
+            metrics = self._get(op_code)
+            metrics.received += 1
+            metrics.latency_counts[bucket] += 1
+            metrics.latency_sum += latency
+            if not length_ok:
+                metrics.unexpected_lengths += 1
+
+    def record_timeout(self, op_code):
+        with self._lock:
+            self._get(op_code).timeouts += 1
+
+    def record_crc_failure(self, op_code):
+        with self._lock:
+            self._get(op_code).crc_failures += 1
+
+    def record_coalesced(self, op_code):
+        with self._lock:
+            self._get(op_code).coalesced += 1
+
+    def record_unknown_frame(self):
+        with self._lock:
+            self.unknown_frames += 1
+
+    def snapshot(self):
+        """
+        Returns a copy of the counters.
+
+        Returns:
+            dict: The counters of each op code, keyed by the op code value.
+        """
+        with self._lock:
+            return {op_code: metrics.as_dict() for op_code, metrics in sorted(self._opcodes.items())}
+
+def _command_name(op_code):
+    try:
+        return MksCommands(op_code).name
+    except ValueError:
+        return f"0x{op_code:02X}"
+
+def format_prometheus(servos):
+    """
+    Formats the metrics of several servos in the Prometheus text exposition format.
+
+    Args:
+        servos (list of MksServo): The servos, each one is labelled with its CAN ID.
+
+    Returns:
+        str: The metrics text.
+    """
+    counters = (
+        ('sent', 'mks_servo_requests_sent_total', 'Requests sent to the servo waiting for a response, fire-and-forget requests are not included.'),
+        ('sent_without_response', 'mks_servo_requests_sent_without_response_total', 'Fire-and-forget requests sent to the servo, their response is not waited for.'),
+        ('received', 'mks_servo_responses_received_total', 'Responses received for a pending request.'),
+        ('timeouts', 'mks_servo_response_timeouts_total', 'Requests whose response was not received in time.'),
+        ('crc_failures', 'mks_servo_crc_failures_total', 'Frames dropped because of an invalid CRC.'),
+        ('unexpected_lengths', 'mks_servo_unexpected_length_responses_total', 'Responses with an unexpected length.'),
+        ('coalesced', 'mks_servo_coalesced_reads_total', 'Reads sharing the response of an identical read already in flight.'),
+    )
+    snapshots = [(servo.can_id, servo.metrics.snapshot(), servo.metrics.unknown_frames) for servo in servos]
+    lines = []
+    for key, name, help_text in counters:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} counter")
+        for can_id, snapshot, _ in snapshots:
+            for op_code, metrics in snapshot.items():
+                lines.append(f'{name}{{can_id="{can_id}",command="{_command_name(op_code)}"}} {metrics[key]}')
+
+    name = 'mks_servo_response_latency_seconds'
+    lines.append(f"# HELP {name} Round-trip latency from sending a request to receiving its response.")
+    lines.append(f"# TYPE {name} histogram")
+    for can_id, snapshot, _ in snapshots:
+        for op_code, metrics in snapshot.items():
+            labels = f'can_id="{can_id}",command="{_command_name(op_code)}"'
+            cumulative = 0
+            for bound, count in metrics['latency_buckets'].items():
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{name}_bucket{{{labels},le="{le}"}} {cumulative}')
+            lines.append(f'{name}_sum{{{labels}}} {metrics["latency_sum"]}')
+            lines.append(f'{name}_count{{{labels}}} {cumulative}')
+
+    name = 'mks_servo_unknown_frames_total'
+    lines.append(f"# HELP {name} Received frames with an unknown op code.")
+    lines.append(f"# TYPE {name} counter")
+    for can_id, _, unknown_frames in snapshots:
+        lines.append(f'{name}{{can_id="{can_id}"}} {unknown_frames}')
+
+    # The servos of a bus share its scheduler, each bus is reported once
+    schedulers = list({id(servo.scheduler): servo.scheduler for servo in servos}.values())
+    waits = [(bus, scheduler.snapshot()) for bus, scheduler in enumerate(schedulers)]
+    name = 'mks_bus_transmit_wait_seconds'
+    lines.append(f"# HELP {name} Wait for the bus before sending a frame, per priority class.")
+    lines.append(f"# TYPE {name} summary")
+    for bus, snapshot in waits:
+        for priority, wait in snapshot.items():
+            lines.append(f'{name}_sum{{bus="{bus}",priority="{priority}"}} {wait["wait_sum"]}')
+            lines.append(f'{name}_count{{bus="{bus}",priority="{priority}"}} {wait["holds"]}')
+    name = 'mks_bus_transmit_wait_max_seconds'
+    lines.append(f"# HELP {name} Longest wait for the bus before sending a frame, per priority class.")
+    lines.append(f"# TYPE {name} gauge")
+    for bus, snapshot in waits:
+        for priority, wait in snapshot.items():
+            lines.append(f'{name}{{bus="{bus}",priority="{priority}"}} {wait["wait_max"]}')
+    return "\n".join(lines) + "\n"
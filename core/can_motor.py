@@ -1,5 +1,7 @@
-from core.mks_enums import Direction, Enable, SaveCleanState, RunMotorResult, MotorStatus, MksCommands
+from core.mks_enums import Direction, Enable, SaveCleanState, RunMotorResult, MotorStatus, MksCommands, SuccessStatus, GoHomeResult, CalibrationResult
 import time
+import threading
+import struct
 
 # constants
 MAX_SPEED = 3000
@@ -30,6 +32,15 @@ class motor_already_running_error(Exception):
     """Exception raised for motor already running."""
     pass
 
+def acceleration_to_rpm_per_second(acceleration):
+    """
+    Converts the acceleration parameter of the commands to RPM per second. Each 1 RPM speed
+    change takes (256 - acceleration) * 50 us, 0 means no acceleration ramp.
+    """
+    if acceleration == 0:
+        return float('inf')
+    return 1 / ((256 - acceleration) * 50e-6)
+
 def _validate_direction(self, direction):
     if direction not in [Direction.CW, Direction.CCW]:
         raise invalid_direction_error("Direction must be CW or CCW")
@@ -46,6 +57,37 @@ def _validate_pulses(self, pulses):
     if pulses < 0 or pulses > MAX_PULSES:
         raise invalid_pulses_error("Pulses must be between 0 and 16777215")
 
+# Layouts of the motion commands sent with send_packed: op code, speed (the direction is its highest bit),
+# acceleration and, for the position commands, the 24 bits position as its high byte and low word
+_SPEED_MODE_LAYOUT = struct.Struct('>BHB')
+_POSITION_LAYOUT = struct.Struct('>BHBBH')
+
+def _speed_field(direction, speed):
+    return (0x8000 if direction == Direction.CW else 0) | (speed & 0xFFF)
+
+def _send_position_motion(self, op_code, speed_field, acceleration, position):
+    pending = self.send_packed(_POSITION_LAYOUT, self.GENERIC_RESPONSE_LENGTH,
+        op_code.value, speed_field, acceleration, (position >> 16) & 0xFF, position & 0xFFFF)
+    return self.wait_encoded_motion(pending)
+
+def _speed_mode_payload(direction, speed, acceleration):
+    direction_value = 0x80 if direction == Direction.CW else 0
+    return [
+        direction_value + ((speed >> 8) & 0b1111),
+        speed & 0xFF,
+        acceleration
+    ]
+
+def _position_payload(speed_high, speed, acceleration, position):
+    return [
+        speed_high,
+        speed & 0xFF,
+        acceleration,
+        (position >> 16) & 0xFF,
+        (position >> 8) & 0xFF,
+        (position >> 0) & 0xFF,
+    ]
+
 def query_motor_status(self): 
     """
     Runs the emergency motor stop
@@ -60,7 +102,7 @@ def query_motor_status(self):
         MotorStatus, motor_status_error)                   
 
 def enable_motor(self, enable: Enable):
-    return self.set_generic_status(MksCommands.ENABLE_MOTOR_COMMAND, enable)   
+    return self.set_generic_status(MksCommands.ENABLE_MOTOR_COMMAND, enable.value)
 
 def emergency_stop_motor(self):
     """
@@ -93,14 +135,12 @@ def run_motor_in_speed_mode(self, direction: Direction, speed, acceleration):
     self._validate_speed(speed)
     self._validate_acceleration(acceleration)
 
-    direction_value = 0x80 if direction == Direction.CW else 0
-
-    cmd = [
-        direction_value + ((speed >> 8) & 0b1111),
-        speed & 0xFF,
-        acceleration
-    ]
-    return self.set_generic_status(MksCommands.RUN_MOTOR_SPEED_MODE_COMMAND, cmd)       
+    status = self.wait_status(self.send_packed(_SPEED_MODE_LAYOUT, self.GENERIC_RESPONSE_LENGTH,
+        MksCommands.RUN_MOTOR_SPEED_MODE_COMMAND.value, _speed_field(direction, speed), acceleration))
+    if status == SuccessStatus.Success:
+        # Speed mode has no completion frame, the state is cleared by a status query or a stop
+        self._set_speed_mode_speed(speed)
+    return status
 
 def save_clean_in_speed_mode(self, state: SaveCleanState):
     """
@@ -125,23 +165,146 @@ def is_motor_running(self):
     """       
     return self.query_motor_status() != MotorStatus.MotorStop
 
-def wait_for_motor_idle(self, timeout):    
+def is_motor_busy(self):
+    """
+    Returns the running state of the motor tracked from the responses of the servo. Unlike
+    is_motor_running, it does not send any command.
+
+    Returns:
+        boolean: True if a motion, a go home or a calibration was started and its completion has
+        not been received yet, or if the motor runs in speed mode.
+    """
+    return (self._motor_run_status == RunMotorResult.RunStarting
+        or self._homing_status == GoHomeResult.Start
+        or self._calibration_status == CalibrationResult.Calibrating
+        or self._speed_mode_speed != 0)
+
+def check_motor_idle(self):
+    """
+    Checks that no motion is running before starting a new one. With strict_motion_guard the
+    motor status is queried, otherwise the run state tracked from the responses is used.
+
+    Raises:
+        motor_already_running_error: If the motor is running.
+    """
+    running = self.is_motor_running() if self.strict_motion_guard else self.is_motor_busy()
+    if running:
+        raise motor_already_running_error("")
+
+def _update_tracked_state(self, **state):
+    # Sets tracked state attributes, then wakes up the idle waiters if nothing runs anymore
+    with self._motor_idle_lock:
+        for name, value in state.items():
+            setattr(self, name, value)
+        if self.is_motor_busy():
+            self._motor_idle.clear()
+            return
+        self._motor_idle.set()
+        callbacks, self._motor_idle_callbacks = self._motor_idle_callbacks, []
+    for callback in callbacks:
+        callback()
+
+def _set_motor_run_status(self, status: RunMotorResult):
+    if status == RunMotorResult.RunStarting:
+        self._update_tracked_state(_motor_run_status=status)
+    else:
+        # A completion, a stop or a stopped status also ends speed mode
+        self._update_tracked_state(_motor_run_status=status, _speed_mode_speed=0)
+
+def _set_speed_mode_speed(self, speed):
+    if speed:
+        self._update_tracked_state(_speed_mode_speed=speed, _motor_run_status=RunMotorResult.RunStarting)
+    else:
+        # The motor decelerates, it is busy until a stopped status is received
+        self._update_tracked_state(_speed_mode_speed=0)
+
+def _set_homing_status(self, status):
+    self._update_tracked_state(_homing_status=status)
+
+def _set_calibration_status(self, status):
+    self._update_tracked_state(_calibration_status=status)
+
+def add_motor_idle_callback(self, callback):
+    """
+    Adds a callback invoked when the completion of the current motion is received.
+
+    The callback runs on the notifier thread, or immediately if the motor is not busy,
+    so it must not block.
+
+    Args:
+        callback (callable): The function to call, without arguments.
+    """
+    with self._motor_idle_lock:
+        if self.is_motor_busy():
+            self._motor_idle_callbacks.append(callback)
+            return
+    callback()
+
+def _track_motor_status(self, status: MotorStatus):
+    if status == MotorStatus.MotorStop and self.is_motor_busy():
+        self._set_motor_run_status(RunMotorResult.RunComplete)
+
+def _track_emergency_stop(self, status: SuccessStatus):
+    if status == SuccessStatus.Success:
+        self._set_motor_run_status(RunMotorResult.RunComplete)
+
+def _track_speed_mode_ack(self, status: SuccessStatus):
+    listener = self._speed_mode_ack_listener
+    if listener is not None:
+        listener(status)
+
+def set_speed_mode_ack_listener(self, listener):
+    """
+    Sets the function called with the SuccessStatus of every speed mode response, i.e. to check
+    the acknowledgements of the setpoints sent without waiting for them.
+
+    The listener runs on the notifier thread, so it must not block.
+
+    Args:
+        listener (callable): The function to call, None to remove it.
+    """
+    self._speed_mode_ack_listener = listener
+
+def wait_for_motor_idle(self, timeout, cancel = None):    
     """
     Waits until the motor stops running or the timeout time is meet.
 
+    The wait is woken up by the completion frame of the motion. The motor status is only
+    queried every MOTOR_IDLE_POLL_INTERVAL seconds as a fallback, i.e. for speed mode
+    which has no completion frame.
+
     Args:        
         timeout (double): Maximum number of seconds to wait for the motor to stop.        
+        cancel (CancellationToken, optional): Ends the wait as soon as it is set, the motor
+            keeps running.
 
     Returns:
-        boolean: The running state of the motor at the end of this method.
+        boolean: The running state of the motor at the end of this method. When cancelled, it
+        is the state tracked from the servo responses, without querying the motor status.
 
     Raises:
         can.CanError: If there is an error in sending the CAN message.    
     """     
-    start_time = time.perf_counter()
-    while (time.perf_counter() - start_time < timeout) and self.is_motor_running():
-        time.sleep(0.1)  # Small sleep to prevent busy waiting
-    return self.is_motor_running()
+    idle = self._motor_idle
+    if cancel is not None:
+        # Woken up by the completion of the motion or by the cancellation, whichever comes first
+        idle = threading.Event()
+        self.add_motor_idle_callback(idle.set)
+        cancel.add_callback(idle.set)
+
+    try:
+        deadline = time.perf_counter() + timeout
+        remaining = timeout
+        while remaining > 0:
+            if idle.wait(min(remaining, self.MOTOR_IDLE_POLL_INTERVAL)):
+                return cancel is not None and cancel.is_set() and self.is_motor_busy()
+            if not self.is_motor_running():
+                return False
+            remaining = deadline - time.perf_counter()
+        return self.is_motor_running()
+    finally:
+        if cancel is not None:
+            cancel.remove_callback(idle.set)
 
 def run_motor_relative_motion_by_pulses(self, direction: Direction, speed, acceleration, pulses):
     """
@@ -163,28 +326,13 @@ def run_motor_relative_motion_by_pulses(self, direction: Direction, speed, accel
     
     Note: If the motor is rotating more than 1000 RPM, it is not a good idea to stop the motor inmediately.
     """        
-    if self.is_motor_running():
-        raise motor_already_running_error("")    
+    self.check_motor_idle()
     self._validate_direction(direction)
     self._validate_speed(speed)
     self._validate_pulses(pulses)
   
-    direction_value = 0x80 if direction == Direction.CW else 0
-
-    cmd = [
-        direction_value + ((speed >> 8) & 0b1111),
-        speed & 0xFF,
-        acceleration,
-        (pulses >> 16) & 0xFF,
-        (pulses >> 8) & 0xFF,
-        (pulses >> 0) & 0xFF,
-    ]
-    tmp = self.set_generic(MksCommands.RUN_MOTOR_RELATIVE_MOTION_BY_PULSES_COMMAND, self.GENERIC_RESPONSE_LENGTH, cmd)  
-    status_int = int.from_bytes(tmp[1:2], byteorder='big')  
-    try:
-        return RunMotorResult(status_int)
-    except ValueError:
-        raise motor_status_error(f"No enum member with value {status_int}")                     
+    return self._send_position_motion(MksCommands.RUN_MOTOR_RELATIVE_MOTION_BY_PULSES_COMMAND,
+        _speed_field(direction, speed), acceleration, pulses)
 
 def run_motor_absolute_motion_by_pulses(self, speed, acceleration, absolute_pulses):
     """
@@ -205,25 +353,12 @@ def run_motor_absolute_motion_by_pulses(self, speed, acceleration, absolute_puls
     
     Note: If the motor is rotating more than 1000 RPM, it is not a good idea to stop the motor inmediately.
     """        
-    if self.is_motor_running():
-        raise motor_already_running_error("")    
+    self.check_motor_idle()
     self._validate_speed(speed)
     self._validate_pulses(absolute_pulses)
   
-    cmd = [
-        (speed >> 8),
-        speed & 0xFF,
-        acceleration,
-        (absolute_pulses >> 16) & 0xFF,
-        (absolute_pulses >> 8) & 0xFF,
-        (absolute_pulses >> 0) & 0xFF,
-    ]
-    tmp = self.set_generic(MksCommands.RUN_MOTOR_ABSOLUTE_MOTION_BY_PULSES_COMMAND, self.GENERIC_RESPONSE_LENGTH, cmd)  
-    status_int = int.from_bytes(tmp[1:2], byteorder='big')  
-    try:
-        return RunMotorResult(status_int)
-    except ValueError:
-        raise motor_status_error(f"No enum member with value {status_int}")                               
+    return self._send_position_motion(MksCommands.RUN_MOTOR_ABSOLUTE_MOTION_BY_PULSES_COMMAND,
+        speed & 0xFFF, acceleration, absolute_pulses)
 
 
 
@@ -248,26 +383,13 @@ def run_motor_relative_motion_by_axis(self, speed, acceleration, relative_axis):
     Note: In this mode, the axis error is about +-15. It is suggested running with 64 subdivisions.    
     Note: If the motor is rotating more than 1000 RPM, it is not a good idea to stop the motor inmediately.
     """    
-    if self.is_motor_running():
-        raise motor_already_running_error("")    
+    self.check_motor_idle()
     self._validate_speed(speed)
     self._validate_acceleration(acceleration)
 
     # TODO: Should we add a check to avoid stopping the motor inmediately when running at more than 1000 RPMs?
-    cmd = [
-        ((speed >> 8) & 0b1111),
-        speed & 0xFF,
-        acceleration,        
-        (relative_axis >> 16) & 0xFF,
-        (relative_axis >> 8) & 0xFF,
-        (relative_axis >> 0) & 0xFF,
-    ]
-    tmp = self.set_generic(MksCommands.RUN_MOTOR_RELATIVE_MOTION_BY_AXIS_COMMAND, self.GENERIC_RESPONSE_LENGTH, cmd)  
-    status_int = int.from_bytes(tmp[1:2], byteorder='big')   
-    try:
-        return RunMotorResult(status_int)
-    except ValueError:
-        raise motor_status_error(f"No enum member with value {status_int}")                                       
+    return self._send_position_motion(MksCommands.RUN_MOTOR_RELATIVE_MOTION_BY_AXIS_COMMAND,
+        speed & 0xFFF, acceleration, relative_axis)
 
 def run_motor_absolute_motion_by_axis(self, speed, acceleration, absolute_axis):
     """
@@ -290,24 +412,84 @@ def run_motor_absolute_motion_by_axis(self, speed, acceleration, absolute_axis):
     Note: In this mode, the axis error is about +-15. It is suggested running with 64 subdivisions.    
     Note: If the motor is rotating more than 1000 RPM, it is not a good idea to stop the motor inmediately.
     """
-    if self.is_motor_running():
-        raise motor_already_running_error("")    
+    self.check_motor_idle()
     self._validate_speed(speed)
     self._validate_acceleration(acceleration)
   
     # TODO: Should we add a check to avoid stopping the motor inmediately when running at more than 1000 RPMs?
-    cmd = [
-        ((speed >> 8) & 0b1111),
-        speed & 0xFF,
-        acceleration,        
-        (absolute_axis >> 16) & 0xFF,
-        (absolute_axis >> 8) & 0xFF,
-        (absolute_axis >> 0) & 0xFF,
-    ]
-    tmp = self.set_generic(MksCommands.RUN_MOTOR_ABSOLUTE_MOTION_BY_AXIS_COMMAND, self.GENERIC_RESPONSE_LENGTH, cmd)  
-    status_int = int.from_bytes(tmp[1:2], byteorder='big')      
+    return self._send_position_motion(MksCommands.RUN_MOTOR_ABSOLUTE_MOTION_BY_AXIS_COMMAND,
+        speed & 0xFFF, acceleration, absolute_axis)
+
+def encode_absolute_motion_by_axis(self, speed, acceleration, absolute_axis):
+    """
+    Validates and encodes the absolute motion by axis command, so it can be sent later, and
+    as many times as needed, with run_encoded_motion.
+
+    Args:
+        speed (int): The speed in the range of 0 to 3000 RPMs.
+        acceleration (int): The acceleration in the range of 0 to 255.
+        absolute_axis (int): The relative axis, the value range is -8388607 to +8388607.
+
+    Returns:
+        can.Message: The encoded command, including the CRC byte.
+    """
+    self._validate_speed(speed)
+    self._validate_acceleration(acceleration)
+
+    cmd = _position_payload(((speed >> 8) & 0b1111), speed, acceleration, absolute_axis)
+    return self.create_can_msg([MksCommands.RUN_MOTOR_ABSOLUTE_MOTION_BY_AXIS_COMMAND.value] + cmd)
+
+def start_encoded_motion(self, msg, check_idle=True):
+    """
+    Sends a motion command encoded with encode_absolute_motion_by_axis without waiting for
+    its response, so the commands of several servos can be sent back-to-back.
+
+    Args:
+        msg (can.Message): The encoded motion command.
+        check_idle (bool, optional): Checks that the motor is idle first. The callers that
+            already called check_motor_idle, i.e. before a burst, can skip it.
+
+    Returns:
+        PendingResponse: The pending response, see wait_encoded_motion.
+
+    Raises:
+        can.CanError: If there is an error in sending the CAN message.
+    """
+    if check_idle:
+        self.check_motor_idle()
+    return self.send_can_msg(msg, self.GENERIC_RESPONSE_LENGTH)
+
+def wait_encoded_motion(self, pending, timeout = None):
+    """
+    Waits for the response of a motion command sent with start_encoded_motion.
+
+    Args:
+        pending (PendingResponse): The pending response of the command.
+        timeout (float, optional): Maximum number of seconds to wait. Defaults to self.timeout.
+
+    Returns:
+        RunMotorResult: The status of the motor, None if the response was not received.
+    """
+    tmp = self.wait_response(pending, timeout)
+    if tmp is None:
+        return None
+    status_int = int.from_bytes(tmp[1:2], byteorder='big')
     try:
         return RunMotorResult(status_int)
     except ValueError:
-        raise motor_status_error(f"No enum member with value {status_int}")                                             
+        raise motor_status_error(f"No enum member with value {status_int}")
 
+def run_encoded_motion(self, msg):
+    """
+    Runs a motion command encoded with encode_absolute_motion_by_axis.
+
+    Args:
+        msg (can.Message): The encoded motion command.
+
+    Returns:
+        RunMotorResult: The status of the motor, at the end of the command execution.
+
+    Raises:
+        can.CanError: If there is an error in sending the CAN message.
+    """
+    return self.wait_encoded_motion(self.start_encoded_motion(msg))
@@ -0,0 +1,155 @@
+import heapq
+import itertools
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from enum import IntEnum
+
+from core.mks_enums import MksCommands
+
+class TransmitPriority(IntEnum):
+    """Priority classes of the frames sent on a bus, the lowest value is sent first."""
+    SAFETY = 0
+    MOTION = 1
+    TELEMETRY = 2
+    CONFIGURATION = 3
+
+# Priority class of each op code, the commands not listed are CONFIGURATION
+COMMAND_PRIORITIES = {
+    MksCommands.EMERGENCY_STOP_COMMAND.value: TransmitPriority.SAFETY,
+    MksCommands.RUN_MOTOR_SPEED_MODE_COMMAND.value: TransmitPriority.MOTION,
+    MksCommands.RUN_MOTOR_RELATIVE_MOTION_BY_PULSES_COMMAND.value: TransmitPriority.MOTION,
+    MksCommands.RUN_MOTOR_ABSOLUTE_MOTION_BY_PULSES_COMMAND.value: TransmitPriority.MOTION,
+    MksCommands.RUN_MOTOR_RELATIVE_MOTION_BY_AXIS_COMMAND.value: TransmitPriority.MOTION,
+    MksCommands.RUN_MOTOR_ABSOLUTE_MOTION_BY_AXIS_COMMAND.value: TransmitPriority.MOTION,
+    MksCommands.GO_HOME_COMMAND.value: TransmitPriority.MOTION,
+    MksCommands.READ_ENCODER_VALUE_CARRY.value: TransmitPriority.TELEMETRY,
+    MksCommands.READ_ENCODED_VALUE_ADDITION.value: TransmitPriority.TELEMETRY,
+    MksCommands.READ_MOTOR_SPEED.value: TransmitPriority.TELEMETRY,
+    MksCommands.READ_NUM_PULSES_RECEIVED.value: TransmitPriority.TELEMETRY,
+    MksCommands.READ_IO_PORT_STATUS.value: TransmitPriority.TELEMETRY,
+    MksCommands.READ_MOTOR_SHAFT_ANGLE_ERROR.value: TransmitPriority.TELEMETRY,
+    MksCommands.READ_EN_PINS_STATUS.value: TransmitPriority.TELEMETRY,
+    MksCommands.READ_GO_BACK_TO_ZERO_STATUS_WHEN_POWER_ON.value: TransmitPriority.TELEMETRY,
+    MksCommands.READ_MOTOR_SHAFT_PROTECTION_STATE.value: TransmitPriority.TELEMETRY,
+    MksCommands.QUERY_MOTOR_STATUS_COMMAND.value: TransmitPriority.TELEMETRY,
+}
+
+def command_priority(op_code):
+    """
+    Returns the priority class of a command.
+
+    Args:
+        op_code (int): Operation code of the command.
+
+    Returns:
+        TransmitPriority: The priority class.
+    """
+    return COMMAND_PRIORITIES.get(op_code, TransmitPriority.CONFIGURATION)
+
+class BusScheduler:
+    """Grants the transmission on a bus to one thread at a time, by priority class.
+
+    A thread sending a frame holds the bus from encoding the frame until it is sent. When it
+    releases it, the bus is handed to the waiting thread with the highest priority class, in
+    arrival order within a class. An emergency stop is thus sent ahead of every frame queued by
+    the other threads, it only waits for the frame being sent. The bus is reentrant, the priority
+    of a thread is the one of its outermost hold.
+
+    The wait of each hold is recorded per class, see snapshot.
+    """
+    _instances = weakref.WeakKeyDictionary()
+    _instances_lock = threading.Lock()
+
+    @classmethod
+    def for_bus(cls, bus):
+        """
+        Returns the scheduler of a bus, creating it on first use.
+
+        Args:
+            bus (can.interface.Bus): The CAN bus.
+
+        Returns:
+            BusScheduler: The scheduler shared by all the servos of the bus.
+        """
+        with cls._instances_lock:
+            scheduler = cls._instances.get(bus)
+            if scheduler is None:
+                scheduler = cls._instances[bus] = cls()
+            return scheduler
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._owner = None
+        self._depth = 0
+        # (priority, arrival, thread id, event) of the threads waiting for the bus
+        self._waiting = []
+        self._arrivals = itertools.count()
+        # [holds, wait sum, wait max] per priority class
+        self._waits = {priority: [0, 0.0, 0.0] for priority in TransmitPriority}
+
+    def acquire(self, priority):
+        """
+        Waits until the bus is granted to the calling thread.
+
+        Args:
+            priority (TransmitPriority): The priority class of the frames to send.
+        """
+        thread_id = threading.get_ident()
+        start = time.perf_counter()
+        with self._lock:
+            if self._owner == thread_id:
+                self._depth += 1
+                return
+            if self._owner is None:
+                self._owner = thread_id
+                self._depth = 1
+                self._record_wait(priority, 0.0)
+                return
+            granted = threading.Event()
+            heapq.heappush(self._waiting, (priority, next(self._arrivals), thread_id, granted))
+
+        # The releasing thread makes this one the owner before setting the event
+        granted.wait()
+        with self._lock:
+            self._record_wait(priority, time.perf_counter() - start)
+
+    def release(self):
+        """Releases the bus, it is granted to the waiting thread with the highest priority."""
+        with self._lock:
+            self._depth -= 1
+            if self._depth:
+                return
+            if self._waiting:
+                _, _, self._owner, granted = heapq.heappop(self._waiting)
+                self._depth = 1
+                granted.set()
+            else:
+                self._owner = None
+
+    @contextmanager
+    def hold(self, priority):
+        """Holds the bus for the duration of the with block, see acquire."""
+        self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def _record_wait(self, priority, wait):
+        waits = self._waits[priority]
+        waits[0] += 1
+        waits[1] += wait
+        waits[2] = max(waits[2], wait)
+
+    def snapshot(self):
+        """
+        Returns the wait for the bus of each priority class.
+
+        Returns:
+            dict: holds, wait_sum and wait_max (seconds) of each class, keyed by its name.
+        """
+        with self._lock:
+            return {priority.name: {'holds': holds, 'wait_sum': wait_sum, 'wait_max': wait_max}
+                for priority, (holds, wait_sum, wait_max) in self._waits.items()}
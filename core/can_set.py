@@ -48,7 +48,7 @@ def nb_calibrate_encoder(self):
     status_int = int.from_bytes(tmp[1:2], byteorder='big')      
     try:
         rslt = CalibrationResult(status_int)
-        self._calibration_status = rslt
+        self._set_calibration_status(rslt)
         return rslt
     except ValueError:
         raise calibration_error(f"No enum member with value {status_int}")                     
@@ -362,7 +362,7 @@ def nb_go_home(self):
     status_int = int.from_bytes(tmp[1:2], byteorder='big')  
     try:
         rslt = GoHomeResult(status_int)
-        self._homing_status = rslt
+        self._set_homing_status(rslt)
     except ValueError:
         raise gohome_status_error(f"No enum member with value {status_int}")                     
     return rslt   
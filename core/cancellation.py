@@ -0,0 +1,41 @@
+import threading
+
+class CancellationToken(threading.Event):
+    """An Event also calling callbacks when it is set.
+
+    Waits on other events, i.e. the completion of a motion, register a callback to be woken up
+    as soon as the token is set instead of polling it.
+    """
+    def __init__(self):
+        super().__init__()
+        self._callbacks = []
+        self._callbacks_lock = threading.Lock()
+
+    def set(self):
+        """Sets the token and calls the callbacks, from the calling thread."""
+        with self._callbacks_lock:
+            super().set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def add_callback(self, callback):
+        """
+        Adds a callback invoked when the token is set, or immediately if it is already set.
+
+        Args:
+            callback (callable): The function to call, without arguments. It must not block.
+        """
+        with self._callbacks_lock:
+            if not self.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def remove_callback(self, callback):
+        """Removes a callback that was not called yet."""
+        with self._callbacks_lock:
+            try:
+                self._callbacks.remove(callback)
+            except ValueError:
+                pass
@@ -0,0 +1,210 @@
+import can
+import time
+
+from core.mks_enums import MksCommands
+from core.mks_servo import CanMessageError, MksServo
+from core.can_motor import _position_payload
+from core.can_scheduler import BusScheduler, command_priority
+
+class group_member_error(Exception):
+    """Exception raised for servos that can not be members of the group."""
+    pass
+
+class MksServoGroup:
+    from core.can_motor import (
+        _validate_speed,
+        _validate_acceleration
+    )
+
+    """Controls several MKS Servos sharing a group ID with single CAN messages.
+
+    A message addressed to the group ID is received by all the members at the same time, so
+    they start their motion without the skew of sending a message to each one. Every member
+    replies with its own CAN ID, so the responses and the completion of the motion are tracked
+    per member, by its MksServo instance.
+
+    Attributes:
+        group_id (int): The group ID shared by the servos.
+        servos (tuple of MksServo): The members of the group.
+        bus (can.interface.Bus): The CAN bus shared by the servos.
+        timeout (int): Timeout for waiting for the responses in seconds.
+    """
+    def __init__(self, group_id, servos):
+        """Inits MksServoGroup with its group ID and members.
+
+        Args:
+            group_id (int): The group ID. It must not be the CAN ID of any servo of the bus.
+            servos (list of MksServo): The members of the group, sharing the same bus and notifier.
+
+        Raises:
+            group_member_error: If the group is empty, its members do not share the bus or
+                the group ID is the CAN ID of a member.
+        """
+        self.group_id = group_id
+        self.servos = tuple(servos)
+        if not self.servos:
+            raise group_member_error("A group needs at least one servo")
+        self.bus = self.servos[0].bus
+        if any(servo.bus is not self.bus for servo in self.servos):
+            raise group_member_error("The servos of a group must share the same bus")
+        if any(servo.can_id == group_id for servo in self.servos):
+            raise group_member_error(f"The group ID {group_id} is the CAN ID of a member")
+        self.timeout = max(servo.timeout for servo in self.servos)
+        self.scheduler = BusScheduler.for_bus(self.bus)
+
+    def assign(self):
+        """
+        Sets the group ID of every member. It is stored by the servos, so it is only needed
+        once per rig.
+
+        Returns:
+            dict: The SuccessStatus of each member, keyed by its CAN ID.
+        """
+        return {servo.can_id: servo.set_group_id(self.group_id) for servo in self.servos}
+
+    def create_can_msg(self, msg):
+        """Creates a CAN message addressed to the group, the CRC byte is computed with the group ID.
+
+        Args:
+            msg (bytearray or list of bytes): The message data to which the CRC byte will be appended.
+
+        Returns:
+            can.Message: A CAN message object with the group ID and data including the CRC byte.
+        """
+        crc = (self.group_id + sum(msg)) & 0xFF
+        return can.Message(arbitration_id=self.group_id, data=bytearray(msg) + bytes([crc]), is_extended_id=False)
+
+    def _encode_motion_by_axis(self, op_code, speed, acceleration, axis):
+        self._validate_speed(speed)
+        self._validate_acceleration(acceleration)
+        cmd = _position_payload(((speed >> 8) & 0b1111), speed, acceleration, axis)
+        return self.create_can_msg([op_code.value] + cmd)
+
+    def encode_absolute_motion_by_axis(self, speed, acceleration, absolute_axis):
+        """
+        Validates and encodes the absolute motion by axis command of the group, see
+        MksServo.encode_absolute_motion_by_axis.
+
+        Returns:
+            can.Message: The encoded command, addressed to the group.
+        """
+        return self._encode_motion_by_axis(MksCommands.RUN_MOTOR_ABSOLUTE_MOTION_BY_AXIS_COMMAND, speed, acceleration, absolute_axis)
+
+    def encode_relative_motion_by_axis(self, speed, acceleration, relative_axis):
+        """
+        Validates and encodes the relative motion by axis command of the group, see
+        MksServo.run_motor_relative_motion_by_axis.
+
+        Returns:
+            can.Message: The encoded command, addressed to the group.
+        """
+        return self._encode_motion_by_axis(MksCommands.RUN_MOTOR_RELATIVE_MOTION_BY_AXIS_COMMAND, speed, acceleration, relative_axis)
+
+    def start_encoded_motion(self, msg, check_idle=True):
+        """
+        Sends a motion command encoded for the group without waiting for the responses.
+
+        Args:
+            msg (can.Message): The encoded motion command, see encode_absolute_motion_by_axis.
+            check_idle (bool, optional): Checks that every member is idle first.
+
+        Returns:
+            dict: The PendingResponse of each member, keyed by its CAN ID.
+
+        Raises:
+            motor_already_running_error: If a member is running.
+            CanMessageError: If there is an error in sending the CAN message.
+        """
+        if check_idle:
+            for servo in self.servos:
+                servo.check_motor_idle()
+
+        # Every member replies with its own CAN ID, so a response is expected from each one
+        op_code = msg.data[0]
+        with self.scheduler.hold(command_priority(op_code)):
+            pending = {servo.can_id: servo.dispatcher.expect(servo.can_id, op_code, MksServo.GENERIC_RESPONSE_LENGTH)
+                for servo in self.servos}
+            try:
+                self.bus.send(msg)
+            except can.CanError as e:
+                for servo in self.servos:
+                    servo.dispatcher.discard(pending[servo.can_id])
+                raise CanMessageError(f"Error sending message: {e}")
+
+        for servo in self.servos:
+            servo.metrics.record_sent(op_code)
+        return pending
+
+    def wait_encoded_motion(self, pending, timeout = None):
+        """
+        Waits for the responses of a motion command sent with start_encoded_motion.
+
+        Args:
+            pending (dict): The PendingResponse of each member, keyed by its CAN ID.
+            timeout (float, optional): Maximum number of seconds to wait. Defaults to self.timeout.
+
+        Returns:
+            dict: The RunMotorResult of each member, keyed by its CAN ID. None for the members
+            whose response was not received.
+        """
+        deadline = time.perf_counter() + (self.timeout if timeout is None else timeout)
+        return {servo.can_id: servo.wait_encoded_motion(pending[servo.can_id], max(0, deadline - time.perf_counter()))
+            for servo in self.servos}
+
+    def run_encoded_motion(self, msg):
+        """
+        Runs a motion command encoded for the group.
+
+        Args:
+            msg (can.Message): The encoded motion command, see encode_absolute_motion_by_axis.
+
+        Returns:
+            dict: The RunMotorResult of each member, keyed by its CAN ID.
+        """
+        return self.wait_encoded_motion(self.start_encoded_motion(msg))
+
+    def run_motor_absolute_motion_by_axis(self, speed, acceleration, absolute_axis):
+        """
+        Moves all the members to the same absolute axis with a single message.
+
+        Args:
+            speed (int): The speed in the range of 0 to 3000 RPMs.
+            acceleration (int): The acceleration in the range of 0 to 255.
+            absolute_axis (int): The absolute axis, the value range is -8388607 to +8388607.
+
+        Returns:
+            dict: The RunMotorResult of each member, keyed by its CAN ID.
+        """
+        return self.run_encoded_motion(self.encode_absolute_motion_by_axis(speed, acceleration, absolute_axis))
+
+    def run_motor_relative_motion_by_axis(self, speed, acceleration, relative_axis):
+        """
+        Moves all the members by the same relative axis with a single message.
+
+        Args:
+            speed (int): The speed in the range of 0 to 3000 RPMs.
+            acceleration (int): The acceleration in the range of 0 to 255.
+            relative_axis (int): The relative axis, the value range is -8388607 to +8388607.
+
+        Returns:
+            dict: The RunMotorResult of each member, keyed by its CAN ID.
+        """
+        return self.run_encoded_motion(self.encode_relative_motion_by_axis(speed, acceleration, relative_axis))
+
+    def is_motor_busy(self):
+        """Returns True if the motion of any member has not completed yet."""
+        return any(servo.is_motor_busy() for servo in self.servos)
+
+    def wait_for_motor_idle(self, timeout, cancel = None):
+        """
+        Waits until the motion of every member completes or the timeout time is meet.
+
+        Args:
+            timeout (float): Maximum number of seconds to wait for the members to stop.
+            cancel (CancellationToken, optional): Ends the wait as soon as it is set.
+
+        Returns:
+            dict: The running state of each member at the end of this method, keyed by its CAN ID.
+        """
+        deadline = time.perf_counter() + timeout
+        return {servo.can_id: servo.wait_for_motor_idle(max(0, deadline - time.perf_counter()), cancel) for servo in self.servos}
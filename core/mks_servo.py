@@ -2,10 +2,17 @@
 
 import can
 import time
+import struct
 import logging
+import threading
 from enum import Enum
 
 from core.mks_enums import Enable, SuccessStatus, MksCommands
+from core.can_dispatcher import CanDispatcher
+from core.can_decoders import RESPONSE_DECODERS
+from core.can_metrics import ServoMetrics
+from core.can_cache import ResponseCache
+from core.can_scheduler import BusScheduler, command_priority
 
 class CanMessageError(Exception):
     """Raised for errors related to CAN messaging."""
@@ -50,6 +57,7 @@ class MksServo:
         invalid_aceleration_error,
         invalid_pulses_error,
         motor_status_error,
+        motor_already_running_error,
         _validate_direction,
         _validate_speed,
         _validate_acceleration,
@@ -60,11 +68,28 @@ class MksServo:
         run_motor_in_speed_mode,
         save_clean_in_speed_mode,
         is_motor_running,
+        is_motor_busy,
+        check_motor_idle,
+        _set_motor_run_status,
+        _set_speed_mode_speed,
+        _set_homing_status,
+        _set_calibration_status,
+        _update_tracked_state,
+        add_motor_idle_callback,
+        _track_motor_status,
+        _track_emergency_stop,
+        _track_speed_mode_ack,
+        set_speed_mode_ack_listener,
         wait_for_motor_idle,        
         run_motor_relative_motion_by_pulses,
         run_motor_absolute_motion_by_pulses,
         run_motor_relative_motion_by_axis,
-        run_motor_absolute_motion_by_axis
+        run_motor_absolute_motion_by_axis,
+        _send_position_motion,
+        encode_absolute_motion_by_axis,
+        start_encoded_motion,
+        wait_encoded_motion,
+        run_encoded_motion
     )
     from core.can_set import (
         _validate_current,
@@ -125,79 +150,110 @@ class MksServo:
         can_id (int): The CAN ID for this servo.
         bus (can.interface.Bus): The CAN bus instance to be used.
         timeout (int): Timeout for waiting for a response in seconds.
+        metrics (ServoMetrics): Request counters and response latency histogram per op code.
     """
     GENERIC_RESPONSE_LENGTH = 3
     DEFAULT_TIMEOUT = 1
     MAX_CALIBRATION_TIME = 20
     MAX_HOMING_TIME = 20
+    MOTOR_IDLE_POLL_INTERVAL = 1
+
+    # Idempotent reads: identical concurrent requests share one bus transaction and its response
+    COALESCED_READS = frozenset(op_code.value for op_code in (
+        MksCommands.READ_ENCODER_VALUE_CARRY,
+        MksCommands.READ_ENCODED_VALUE_ADDITION,
+        MksCommands.READ_MOTOR_SPEED,
+        MksCommands.READ_NUM_PULSES_RECEIVED,
+        MksCommands.READ_IO_PORT_STATUS,
+        MksCommands.READ_MOTOR_SHAFT_ANGLE_ERROR,
+        MksCommands.READ_EN_PINS_STATUS,
+        MksCommands.READ_GO_BACK_TO_ZERO_STATUS_WHEN_POWER_ON,
+        MksCommands.READ_MOTOR_SHAFT_PROTECTION_STATE,
+        MksCommands.QUERY_MOTOR_STATUS_COMMAND,
+    ))
 
     _calibration_status = CalibrationResult.Unkown
     _homing_status = GoHomeResult.Unkown
     _motor_run_status = RunMotorResult.RunComplete
-
-    def __init__ (self, bus, notifier, id):
+    _speed_mode_speed = 0
+    _speed_mode_ack_listener = None
+
+    # Op codes whose responses update the tracked servo state: op code -> name of the update method
+    _STATUS_HANDLERS = {
+        MksCommands.MOTOR_CALIBRATION_COMMAND.value: '_set_calibration_status',
+        MksCommands.GO_HOME_COMMAND.value: '_set_homing_status',
+        MksCommands.RUN_MOTOR_RELATIVE_MOTION_BY_PULSES_COMMAND.value: '_set_motor_run_status',
+        MksCommands.RUN_MOTOR_ABSOLUTE_MOTION_BY_PULSES_COMMAND.value: '_set_motor_run_status',
+        MksCommands.RUN_MOTOR_RELATIVE_MOTION_BY_AXIS_COMMAND.value: '_set_motor_run_status',
+        MksCommands.RUN_MOTOR_ABSOLUTE_MOTION_BY_AXIS_COMMAND.value: '_set_motor_run_status',
+        MksCommands.QUERY_MOTOR_STATUS_COMMAND.value: '_track_motor_status',
+        MksCommands.EMERGENCY_STOP_COMMAND.value: '_track_emergency_stop',
+        MksCommands.RUN_MOTOR_SPEED_MODE_COMMAND.value: '_track_speed_mode_ack',
+    }
+
+    def __init__ (self, bus, notifier, id, strict_motion_guard = False, cache_ttls = None):
         """Inits MksServo with the CAN bus and servo ID.
 
         Args:
             bus (can.interface.Bus): The CAN bus instance to be used.
             can_id (int): The CAN ID for this servo.
+            strict_motion_guard (bool, optional): If True, motion commands query the motor status
+                before moving instead of using the run state tracked from the servo responses.
+            cache_ttls (dict, optional): The time to live in seconds of the cached reads, keyed by their
+                MksCommands, i.e. can_cache.DEFAULT_CACHE_TTLS. Defaults to no cache.
         """     
 
-        def monitor_incomming_messages(message):
-            try:                                  
-                if message.arbitration_id == self.can_id:
-                    self.check_msg_crc(message)
-                    if (message.data[0] == MksCommands.MOTOR_CALIBRATION_COMMAND.value and len(message.data) == self.GENERIC_RESPONSE_LENGTH):
-                        status_int = int.from_bytes(message.data[1:2], byteorder='big')  
-                        try:
-                            self._calibration_status = self.CalibrationResult(status_int)                            
-                        except ValueError:
-                            logging.warning(f"No enum member with value {status_int}")    
-                    elif (message.data[0] == MksCommands.RUN_MOTOR_RELATIVE_MOTION_BY_PULSES_COMMAND.value and len(message.data) == self.GENERIC_RESPONSE_LENGTH):
-                        status_int = int.from_bytes(message.data[1:2], byteorder='big')  
-                        try:
-                            self._motor_run_status = self.RunMotorResult(status_int)                            
-                        except ValueError:
-                            logging.warning(f"No enum member with value {status_int}")      
-                    elif (message.data[0] == MksCommands.RUN_MOTOR_ABSOLUTE_MOTION_BY_PULSES_COMMAND.value and len(message.data) == self.GENERIC_RESPONSE_LENGTH):
-                        status_int = int.from_bytes(message.data[1:2], byteorder='big')  
-                        try:
-                            self._motor_run_status = self.RunMotorResult(status_int)                            
-                        except ValueError:
-                            logging.warning(f"No enum member with value {status_int}")  
-                    elif (message.data[0] == MksCommands.RUN_MOTOR_RELATIVE_MOTION_BY_AXIS_COMMAND.value and len(message.data) == self.GENERIC_RESPONSE_LENGTH):
-                        status_int = int.from_bytes(message.data[1:2], byteorder='big')  
-                        try:
-                            self._motor_run_status = self.RunMotorResult(status_int)                            
-                        except ValueError:
-                            logging.warning(f"No enum member with value {status_int}")                                                                                                                                      
-                    elif (message.data[0] == MksCommands.RUN_MOTOR_ABSOLUTE_MOTION_BY_AXIS_COMMAND.value and len(message.data) == self.GENERIC_RESPONSE_LENGTH):
-                        status_int = int.from_bytes(message.data[1:2], byteorder='big')  
-                        try:
-                            self._motor_run_status = self.RunMotorResult(status_int)                            
-                        except ValueError:
-                            logging.warning(f"No enum member with value {status_int}")                                                       
-                    elif (message.data[0] == MksCommands.GO_HOME_COMMAND.value and len(message.data) == self.GENERIC_RESPONSE_LENGTH):
-                        status_int = int.from_bytes(message.data[1:2], byteorder='big')  
-                        try:
-                            self._homing_status = self.GoHomeResult(status_int)                            
-                        except ValueError:
-                            logging.warning(f"No enum member with value {status_int}")                          
-                    elif message.data[0] == MksCommands.QUERY_MOTOR_STATUS_COMMAND.value:
-                        a = 1
-                    elif message.data[0] == MksCommands.READ_ENCODED_VALUE_ADDITION.value:
-                        a = 1                       
-                    else:           
-                        print(message, flush=True)                                       
-            except InvalidCRCError:
-                logging.error(f"CRC check failed for the message")                    
-            return True
-                   
         self.can_id = id
         self.bus = bus
         self.notifier = notifier
         self.timeout = MksServo.DEFAULT_TIMEOUT
-        self.notifier.add_listener(monitor_incomming_messages)
+        self.strict_motion_guard = strict_motion_guard
+        # Set while no motion is running, so waiters are woken up by the completion frame
+        self._motor_idle = threading.Event()
+        self._motor_idle.set()
+        self._motor_idle_lock = threading.Lock()
+        self._motor_idle_callbacks = []
+        # Preallocated frames indexed by their length, reused by every command so sending does not allocate.
+        # The bus is held from encoding a frame until it is sent, so it is not overwritten before.
+        self.scheduler = BusScheduler.for_bus(bus)
+        self._tx_frames = [can.Message(arbitration_id=self.can_id, data=bytearray(length), is_extended_id=False) for length in range(9)]
+        # Pending COALESCED_READS requests, keyed by (op code, data)
+        self._in_flight_reads = {}
+        self.dispatcher = CanDispatcher.for_notifier(notifier)
+        self.metrics = ServoMetrics()
+        # Responses of slow-changing reads, invalidated by the write commands changing them
+        self.cache = ResponseCache(cache_ttls) if cache_ttls else None
+        self.dispatcher.register(self.can_id, self.monitor_incomming_messages, self.metrics)
+
+    def monitor_incomming_messages(self, message):
+        """Tracks the asynchronous status frames of the servo. Called from the notifier thread.
+
+        Args:
+            message (can.Message): A message received from this servo.
+
+        Returns:
+            bool: False if the CRC check failed, True otherwise.
+        """
+        try:
+            self.check_msg_crc(message)
+        except InvalidCRCError:
+            logging.error(f"CRC check failed for the message")
+            self.metrics.record_crc_failure(message.data[0])
+            return False
+
+        decoder = RESPONSE_DECODERS.get(message.data[0])
+        if decoder is None:
+            self.metrics.record_unknown_frame()
+            return True
+
+        status_handler = self._STATUS_HANDLERS.get(message.data[0])
+        response_length, decode = decoder
+        if status_handler and len(message.data) == response_length:
+            try:
+                getattr(self, status_handler)(decode(message.data))
+            except ValueError:
+                logging.warning(f"No enum member with value {message.data[1]}")
+        return True
 
     def _bool_to_int(self, value):
         """
@@ -232,7 +288,7 @@ class MksServo:
         write_data = bytearray(msg) + bytes([crc])
         
         can_message = can.Message(arbitration_id=self.can_id, data=write_data, is_extended_id=False)            
-        logging.debug(f"CAN Message Created: {can_message}")
+        logging.debug("CAN Message Created: %s", can_message)
 
         return can_message
 
@@ -246,7 +302,7 @@ class MksServo:
             bool: True if the last byte of the message data matches the calculated CRC, False otherwise.
         """
 
-        logging.debug(f"Checking CRC for message: {msg}")
+        logging.debug("Checking CRC for message: %s", msg)
 
         # Calculate expected CRC and compare with the last byte of the message data
         crc = (msg.arbitration_id + sum(msg.data[:-1])) & 0xFF
@@ -255,16 +311,25 @@ class MksServo:
             
         return True
     
-    def set_generic(self, op_code, response_length, data = []):
-        """Sends a generic command via CAN bus and waits for a response.
+    def send_request(self, op_code, response_length, data = []):
+        """Sends a generic command via CAN bus without waiting for the response.
+
+        Several requests with different op codes can be outstanding at the same time,
+        their responses are matched by op code. A read of COALESCED_READS identical to one
+        still waiting for its response is not sent again, the caller gets the pending response
+        of the first one.
 
         Args:
             op_code (int): Operation code of the command.
+            response_length (int): Expected length of the response message.
             data (list of bytes, optional): Additional data for the command. Defaults to an empty list.
 
         Returns:
-            dict: A dictionary with 'status' key if successful, None otherwise.
-        """      
+            PendingResponse: The pending response of the command.
+
+        Raises:
+            CanMessageError: If there is an error in sending the CAN message.
+        """
         if isinstance(op_code, Enum):
             op_code = op_code.value
 
@@ -274,36 +339,194 @@ class MksServo:
         elif isinstance(data, bool):
             # Assuming _bool_to_int is a method that converts a boolean to an integer
             data = self._bool_to_int(data)
-                    
-        msg = self.create_can_msg([op_code] + data)
-        # Flag to indicate whether the response has been received
-        status = None
-
-        def receive_message(message):
-            nonlocal status
-            if not status:
-                try:
-                    self.check_msg_crc(message)
-                    if message.arbitration_id == self.can_id:
-                        if not (message.data[0] == op_code and len(message.data) == response_length):
-                            logging.error(f"Unexpected response length or opcode.")                        
-                        status = message.data                                                                
-                except InvalidCRCError as e:
-                    logging.error(f"CRC check failed for the message: {e}")            
-
-        try:        
-            self.notifier.add_listener(receive_message)
-            self.bus.send(msg)
-        except can.CanError as e:
-            raise CanMessageError(f"Error sending message: {e}")            
-
-        # Wait for response (with a timeout)
-        start_time = time.perf_counter()
-        while (time.perf_counter() - start_time < self.timeout) and status == None:
-            time.sleep(0.1)  # Small sleep to prevent busy waiting
-        self.notifier.remove_listener(receive_message)
-
-        return status
+
+        with self.scheduler.hold(command_priority(op_code)):
+            if op_code in self.COALESCED_READS:
+                key = (op_code, tuple(data))
+                pending = self._in_flight_reads.get(key)
+                if pending is not None and not pending.done():
+                    self.metrics.record_coalesced(op_code)
+                    return pending
+
+            frame = self._tx_frames[len(data) + 2]
+            frame_data = frame.data
+            frame_data[0] = op_code
+            frame_data[1:-1] = data
+            frame_data[-1] = (self.can_id + sum(frame_data) - frame_data[-1]) & 0xFF
+            pending = self.send_can_msg(frame, response_length)
+
+            if op_code in self.COALESCED_READS:
+                self._in_flight_reads[key] = pending
+            return pending
+
+    def send_packed(self, layout, response_length, *values):
+        """Encodes a command with a struct layout into a preallocated frame and sends it without waiting for the response.
+
+        Nothing is allocated to encode the command, so it is suited to the commands sent at a high rate.
+
+        Args:
+            layout (struct.Struct): The layout of the command data, starting with the op code, without the CRC byte.
+            response_length (int): Expected length of the response message, None to not expect it.
+            *values: The values of the layout fields.
+
+        Returns:
+            PendingResponse: The pending response of the command.
+
+        Raises:
+            CanMessageError: If there is an error in sending the CAN message.
+        """
+        with self.scheduler.hold(command_priority(values[0])):
+            frame = self._tx_frames[layout.size + 1]
+            frame_data = frame.data
+            try:
+                layout.pack_into(frame_data, 0, *values)
+            except struct.error as e:
+                raise CanMessageError(f"Invalid command data: {e}")
+            frame_data[-1] = (self.can_id + sum(frame_data) - frame_data[-1]) & 0xFF
+            return self.send_can_msg(frame, response_length)
+
+    def send_can_msg(self, msg, response_length):
+        """Sends a CAN message created with create_can_msg without waiting for the response.
+
+        The message can be created once and sent several times.
+
+        Args:
+            msg (can.Message): The message, its first data byte is the operation code.
+            response_length (int): Expected length of the response message. None to send the message
+                without expecting a response (fire-and-forget), the response is then only seen by the
+                message handlers and the request is counted in the sent_without_response metric.
+
+        Returns:
+            PendingResponse: The pending response of the command, None if no response is expected.
+
+        Raises:
+            CanMessageError: If there is an error in sending the CAN message.
+        """
+        op_code = msg.data[0]
+        with self.scheduler.hold(command_priority(op_code)):
+            # The dispatcher resolves the request as soon as the matching (can_id, op_code) response arrives
+            pending = self.dispatcher.expect(self.can_id, op_code, response_length) if response_length is not None else None
+
+            try:        
+                self.bus.send(msg)
+            except can.CanError as e:
+                if pending is not None:
+                    self.dispatcher.discard(pending)
+                raise CanMessageError(f"Error sending message: {e}")            
+
+        # Counted apart, a fire-and-forget request never gets a response nor a timeout recorded
+        self.metrics.record_sent(op_code, expects_response=pending is not None)
+        return pending
+
+    def wait_response(self, pending, timeout = None):
+        """Waits for the response of a request sent with send_request.
+
+        Args:
+            pending (PendingResponse): The pending response of the command.
+            timeout (float, optional): Maximum number of seconds to wait. Defaults to self.timeout.
+
+        Returns:
+            bytearray: The response data, None if the timeout expired.
+        """
+        response = pending.wait(self.timeout if timeout is None else timeout)
+        if response is None:
+            self.abandon_request(pending)
+        elif self.cache is not None:
+            self.cache.write_completed(pending.op_code)
+        return response
+
+    def abandon_request(self, pending):
+        """Stops waiting for the response of a request whose timeout expired.
+
+        A request shared by several callers is discarded and counted as a timeout once.
+
+        Args:
+            pending (PendingResponse): The pending response of the command.
+        """
+        with self.scheduler.hold(command_priority(pending.op_code)):
+            # The callers sharing a coalesced read all time out, only the first one abandons it
+            if pending.abandoned:
+                return
+            pending.abandoned = True
+            # A late response must not be shared with the next identical reads
+            for key, in_flight in self._in_flight_reads.items():
+                if in_flight is pending:
+                    del self._in_flight_reads[key]
+                    break
+        self.dispatcher.discard(pending)
+        self.metrics.record_timeout(pending.op_code)
+
+    def get_metrics(self):
+        """Returns the request counters and latency histogram of each op code.
+
+        Returns:
+            dict: The counters of each op code (sent, received, timeouts, crc_failures,
+            unexpected_lengths, coalesced, latency_buckets, latency_sum), keyed by the op code value.
+        """
+        return self.metrics.snapshot()
+
+    def invalidate_cache(self, op_codes = None):
+        """Removes cached read responses, i.e. after changing the servo settings from elsewhere.
+
+        Args:
+            op_codes (list of MksCommands, optional): The reads to invalidate. Defaults to all of them.
+        """
+        if self.cache is not None:
+            self.cache.invalidate(op_codes)
+
+    def set_generic(self, op_code, response_length, data = [], use_cache = True):
+        """Sends a generic command via CAN bus and waits for a response.
+
+        Args:
+            op_code (int): Operation code of the command.
+            data (list of bytes, optional): Additional data for the command. Defaults to an empty list.
+            use_cache (bool, optional): If False, the read is sent even when its response is cached.
+
+        Returns:
+            dict: A dictionary with 'status' key if successful, None otherwise.
+        """      
+        cache = self.cache if use_cache else None
+        op_value = op_code.value if isinstance(op_code, Enum) else op_code
+        if cache is None or not cache.caches(op_value):
+            return self.wait_response(self.send_request(op_code, response_length, data))
+
+        key = tuple(data) if isinstance(data, (list, tuple, bytes, bytearray)) else data
+        response = cache.get(op_value, key)
+        if response is None:
+            generation = cache.generation(op_value)
+            response = self.wait_response(self.send_request(op_code, response_length, data))
+            if response is not None:
+                cache.put(op_value, key, response, generation)
+        return response
+
+    def read_batch(self, op_codes):
+        """Sends several read commands back-to-back and collects all the responses.
+
+        Args:
+            op_codes (list of MksCommands): The read commands, i.e. READ_ENCODED_VALUE_ADDITION, READ_MOTOR_SPEED.
+
+        Returns:
+            dict: The decoded response of each command, keyed by the command. None for the commands
+            whose response was not received within self.timeout.
+
+        Raises:
+            CanMessageError: If there is an error in sending the CAN message.
+            InvalidResponseError: If a response can not be decoded.
+        """
+        requests = []
+        for op_code in op_codes:
+            response_length, decode = RESPONSE_DECODERS[op_code.value]
+            requests.append((op_code, decode, self.send_request(op_code, response_length, [op_code.value])))
+
+        deadline = time.perf_counter() + self.timeout
+        results = {}
+        for op_code, decode, pending in requests:
+            data = self.wait_response(pending, max(0, deadline - time.perf_counter()))
+            try:
+                results[op_code] = decode(data) if data else None
+            except ValueError:
+                raise InvalidResponseError(f"No enum member with value {data[1]}")
+        return results
                       
     def set_generic_status(self, op_code, data = []):
         """Sends a generic status command and processes the response.
@@ -315,7 +538,19 @@ class MksServo:
         Returns:
             dict: Modified result dictionary with 'status' key, None on error.
         """        
-        tmp = self.set_generic(op_code, MksServo.GENERIC_RESPONSE_LENGTH, data)
+        return self.wait_status(self.send_request(op_code, MksServo.GENERIC_RESPONSE_LENGTH, data))
+
+    def wait_status(self, pending, timeout = None):
+        """Waits for the response of a generic status command and processes it.
+
+        Args:
+            pending (PendingResponse): The pending response of the command.
+            timeout (float, optional): Maximum number of seconds to wait. Defaults to self.timeout.
+
+        Returns:
+            SuccessStatus: The success result of the command, None on timeout.
+        """
+        tmp = self.wait_response(pending, timeout)
         if not tmp == None:
             status_int = int.from_bytes(tmp[1:2], byteorder='big')  
 
@@ -326,8 +561,8 @@ class MksServo:
                 
         return None
     
-    def specialized_state(self, op_code, status_enum, status_enum_exception):
-        tmp = self.set_generic(op_code, self.GENERIC_RESPONSE_LENGTH, [op_code.value])  
+    def specialized_state(self, op_code, status_enum, status_enum_exception, use_cache = True):
+        tmp = self.set_generic(op_code, self.GENERIC_RESPONSE_LENGTH, [op_code.value], use_cache)  
         status_int = int.from_bytes(tmp[1:2], byteorder='big')  
         try:
             return status_enum(status_int)
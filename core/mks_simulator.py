@@ -0,0 +1,347 @@
+import can
+import logging
+import threading
+import time
+
+from core.mks_enums import MksCommands, MotorStatus, RunMotorResult, CalibrationResult, GoHomeResult, SuccessStatus
+from core.can_motor import acceleration_to_rpm_per_second
+
+def _status_reply(value):
+    """Creates the handler of a read command answered with a single status byte."""
+    def read(self, op_code, payload):
+        self._send_status(op_code, value(self) if callable(value) else value)
+    return read
+
+class SimulatedMksServo:
+    """Software model of an MKS Servo on the python-can virtual interface.
+
+    It answers the commands of MksCommands with the same frames and CRC as the real servo,
+    moves with a trapezoidal speed profile given the speed and acceleration of the commands,
+    and sends the asynchronous completion frames of the motion, calibration and go home
+    commands. It allows to run the whole stack without hardware:
+
+        simulator = SimulatedMksServo(channel='sim', can_id=1)
+        simulator.start()
+        bus = can.interface.Bus(interface='virtual', channel='sim')
+
+    Attributes:
+        can_id (int): The CAN ID of the simulated servo.
+        group_id (int): The group ID of the simulated servo, None if it is not in a group.
+        position (float): The current axis (encoder value in addition mode).
+        speed (float): The current speed in RPM, CCW is positive.
+    """
+    AXIS_PER_TURN = 0x4000
+    FULL_STEPS_PER_TURN = 200
+    TICK = 0.001
+    CALIBRATION_TIME = 0.5
+
+    def __init__(self, channel='mks_sim', can_id=1, group_id=None):
+        """Inits the simulated servo.
+
+        Args:
+            channel (str): The channel of the virtual bus.
+            can_id (int): The CAN ID of the simulated servo.
+            group_id (int, optional): The group ID of the simulated servo.
+        """
+        self.channel = channel
+        self.can_id = can_id
+        self.group_id = group_id
+        self.subdivisions = 16
+        self.enabled = True
+        self.position = 0.0
+        self.speed = 0.0
+        self.pulses_received = 0
+
+        # Motion state: None when idle, 'position' or 'speed'
+        self._mode = None
+        self._target = 0.0
+        self._max_speed = 0.0
+        self._acceleration = 0.0
+        self._motion_op_code = None
+        self._accelerating = False
+        self._homing = False
+        self._calibration_end = None
+
+        self._lock = threading.Lock()
+        self._running = threading.Event()
+        self._threads = []
+        self.bus = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        """Connects to the virtual bus and starts answering commands."""
+        self.bus = can.interface.Bus(interface='virtual', channel=self.channel)
+        self._running.set()
+        self._threads = [
+            threading.Thread(target=self._receive_loop, name=f"mks_sim_{self.can_id}_rx", daemon=True),
+            threading.Thread(target=self._motion_loop, name=f"mks_sim_{self.can_id}_motion", daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        """Stops the simulation and disconnects from the virtual bus."""
+        self._running.clear()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        if self.bus is not None:
+            self.bus.shutdown()
+            self.bus = None
+
+    def is_moving(self):
+        """Returns True while a motion is running."""
+        return self._mode is not None
+
+    acceleration_to_rpm_per_second = staticmethod(acceleration_to_rpm_per_second)
+
+    def _send(self, data):
+        crc = (self.can_id + sum(data)) & 0xFF
+        try:
+            self.bus.send(can.Message(arbitration_id=self.can_id, data=bytes(data) + bytes([crc]), is_extended_id=False))
+        except can.CanError as e:
+            logging.error(f"Simulated servo failed to send: {e}")
+
+    def _send_status(self, op_code, status):
+        self._send([op_code, status])
+
+    def _receive_loop(self):
+        while self._running.is_set():
+            message = self.bus.recv(0.05)
+            if message is None or message.is_error_frame or len(message.data) < 2:
+                continue
+            if message.arbitration_id != self.can_id and (self.group_id is None or message.arbitration_id != self.group_id):
+                continue
+            # The CRC of a request is computed with the ID it was addressed to
+            if message.data[-1] != (message.arbitration_id + sum(message.data[:-1])) & 0xFF:
+                logging.warning(f"Simulated servo {self.can_id} received a frame with an invalid CRC")
+                continue
+            with self._lock:
+                self._handle_command(message.data[0], bytes(message.data[1:-1]))
+
+    def _handle_command(self, op_code, payload):
+        handler = self._HANDLERS.get(op_code)
+        if handler is None:
+            # Remaining configuration commands: accepted without changing the simulation
+            self._send_status(op_code, SuccessStatus.Success.value)
+            return
+        handler(self, op_code, payload)
+
+    # Read commands
+
+    def _read_encoder_value_carry(self, op_code, payload):
+        position = int(round(self.position))
+        carry, value = divmod(position, self.AXIS_PER_TURN)
+        self._send([op_code] + list(carry.to_bytes(4, 'big', signed=True)) + list(value.to_bytes(2, 'big', signed=True)))
+
+    def _read_encoder_value_addition(self, op_code, payload):
+        self._send([op_code] + list(int(round(self.position)).to_bytes(6, 'big', signed=True)))
+
+    def _read_motor_speed(self, op_code, payload):
+        self._send([op_code] + list(int(round(self.speed)).to_bytes(2, 'big', signed=True)))
+
+    def _read_num_pulses_received(self, op_code, payload):
+        self._send([op_code] + list(self.pulses_received.to_bytes(4, 'big', signed=True)))
+
+    def _read_motor_shaft_angle_error(self, op_code, payload):
+        self._send([op_code] + list((0).to_bytes(4, 'big', signed=True)))
+
+    def _query_motor_status(self, op_code, payload):
+        if self._calibration_end is not None:
+            status = MotorStatus.MotorIsCalibrating
+        elif self._homing:
+            status = MotorStatus.MotorHoming
+        elif self._mode is None:
+            status = MotorStatus.MotorStop
+        elif self._accelerating:
+            status = MotorStatus.MotorSpeedUp
+        elif abs(self.speed) < self._max_speed:
+            status = MotorStatus.MotorSpeedDown
+        else:
+            status = MotorStatus.MotorFullSpeed
+        self._send_status(op_code, status.value)
+
+    # Motor commands
+
+    def _enable_motor(self, op_code, payload):
+        self.enabled = bool(payload[0]) if payload else True
+        if not self.enabled:
+            self._stop_motion()
+        self._send_status(op_code, SuccessStatus.Success.value)
+
+    def _emergency_stop(self, op_code, payload):
+        self._stop_motion()
+        self._send_status(op_code, SuccessStatus.Success.value)
+
+    def _run_speed_mode(self, op_code, payload):
+        if not self.enabled:
+            self._send_status(op_code, SuccessStatus.Fail.value)
+            return
+        speed = ((payload[0] & 0x0F) << 8) | payload[1]
+        self._mode = 'speed'
+        self._max_speed = speed
+        self._target = -speed if payload[0] & 0x80 else speed
+        self._acceleration = self.acceleration_to_rpm_per_second(payload[2])
+        self._motion_op_code = None
+        self._send_status(op_code, SuccessStatus.Success.value)
+
+    def _run_position(self, op_code, payload):
+        if not self.enabled or self._mode == 'position':
+            self._send_status(op_code, RunMotorResult.RunFail.value)
+            return
+
+        axis_per_pulse = self.AXIS_PER_TURN / (self.FULL_STEPS_PER_TURN * self.subdivisions)
+        value = int.from_bytes(payload[3:6], 'big', signed=True)
+        if op_code == MksCommands.RUN_MOTOR_RELATIVE_MOTION_BY_PULSES_COMMAND.value:
+            value = int.from_bytes(payload[3:6], 'big')
+            target = self.position + (-value if payload[0] & 0x80 else value) * axis_per_pulse
+        elif op_code == MksCommands.RUN_MOTOR_ABSOLUTE_MOTION_BY_PULSES_COMMAND.value:
+            target = value * axis_per_pulse
+        elif op_code == MksCommands.RUN_MOTOR_RELATIVE_MOTION_BY_AXIS_COMMAND.value:
+            target = self.position + value
+        else:
+            target = value
+
+        self._start_position_motion(op_code, target, ((payload[0] & 0x0F) << 8) | payload[1], payload[2])
+        self._send_status(op_code, RunMotorResult.RunStarting.value)
+
+    # Set commands
+
+    def _calibrate(self, op_code, payload):
+        self._calibration_end = time.perf_counter() + self.CALIBRATION_TIME
+        self._send_status(op_code, CalibrationResult.Calibrating.value)
+
+    def _go_home(self, op_code, payload):
+        self._homing = True
+        self._start_position_motion(op_code, 0, 60, 0)
+        self._send_status(op_code, GoHomeResult.Start.value)
+
+    def _set_current_axis_to_zero(self, op_code, payload):
+        self.position = 0.0
+        self._send_status(op_code, SuccessStatus.Success.value)
+
+    def _set_subdivisions(self, op_code, payload):
+        self.subdivisions = payload[0] or 256
+        self._send_status(op_code, SuccessStatus.Success.value)
+
+    def _set_can_id(self, op_code, payload):
+        self._send_status(op_code, SuccessStatus.Success.value)
+        self.can_id = ((payload[0] & 0x0F) << 8) | payload[1]
+
+    def _set_group_id(self, op_code, payload):
+        self.group_id = ((payload[0] & 0x0F) << 8) | payload[1]
+        self._send_status(op_code, SuccessStatus.Success.value)
+
+    # Motion model
+
+    def _start_position_motion(self, op_code, target, speed, acceleration):
+        self._mode = 'position'
+        self._target = float(target)
+        self._max_speed = speed
+        self._acceleration = self.acceleration_to_rpm_per_second(acceleration)
+        self._motion_op_code = op_code
+
+    def _stop_motion(self):
+        self._mode = None
+        self._homing = False
+        self._motion_op_code = None
+        self.speed = 0.0
+
+    def _motion_loop(self):
+        last = time.perf_counter()
+        while self._running.is_set():
+            time.sleep(self.TICK)
+            now = time.perf_counter()
+            with self._lock:
+                self._step(now - last, now)
+            last = now
+
+    def _step(self, dt, now):
+        if self._calibration_end is not None and now >= self._calibration_end:
+            self._calibration_end = None
+            self._send_status(MksCommands.MOTOR_CALIBRATION_COMMAND.value, CalibrationResult.CalibratedSuccess.value)
+
+        if self._mode == 'speed':
+            self._accelerating = abs(self._target) > abs(self.speed)
+            self.speed = self._approach(self.speed, self._target, self._acceleration * dt)
+            self.position += self.speed * self.AXIS_PER_TURN / 60 * dt
+            if self._target == 0 and self.speed == 0:
+                self._mode = None
+        elif self._mode == 'position':
+            self._step_position(dt)
+
+    def _step_position(self, dt):
+        axis_per_second_per_rpm = self.AXIS_PER_TURN / 60
+        remaining = self._target - self.position
+        direction = 1 if remaining >= 0 else -1
+        current = self.speed * direction
+
+        # Decelerate when the braking distance reaches the remaining distance
+        braking_distance = current * current / (2 * self._acceleration) * axis_per_second_per_rpm if current > 0 else 0
+        if braking_distance >= abs(remaining):
+            desired = 0.0
+        else:
+            desired = float(self._max_speed)
+        self._accelerating = desired > current
+        current = self._approach(current, desired, self._acceleration * dt)
+        # Keep a minimal speed so the motion always converges
+        current = max(current, 1.0)
+
+        step = current * axis_per_second_per_rpm * dt
+        if step >= abs(remaining):
+            self.position = self._target
+            self._complete_position_motion()
+        else:
+            self.position += step * direction
+            self.speed = current * direction
+
+    def _complete_position_motion(self):
+        op_code = self._motion_op_code
+        homing = self._homing
+        self._stop_motion()
+        if homing:
+            self._send_status(op_code, GoHomeResult.Success.value)
+        else:
+            self._send_status(op_code, RunMotorResult.RunComplete.value)
+
+    @staticmethod
+    def _approach(value, target, max_change):
+        if max_change == float('inf'):
+            return target
+        if value < target:
+            return min(value + max_change, target)
+        return max(value - max_change, target)
+
+    # op code -> command handler
+    _HANDLERS = {
+        MksCommands.READ_ENCODER_VALUE_CARRY.value: _read_encoder_value_carry,
+        MksCommands.READ_ENCODED_VALUE_ADDITION.value: _read_encoder_value_addition,
+        MksCommands.READ_MOTOR_SPEED.value: _read_motor_speed,
+        MksCommands.READ_NUM_PULSES_RECEIVED.value: _read_num_pulses_received,
+        MksCommands.READ_IO_PORT_STATUS.value: _status_reply(0),
+        MksCommands.READ_MOTOR_SHAFT_ANGLE_ERROR.value: _read_motor_shaft_angle_error,
+        MksCommands.READ_EN_PINS_STATUS.value: _status_reply(lambda self: int(self.enabled)),
+        MksCommands.READ_GO_BACK_TO_ZERO_STATUS_WHEN_POWER_ON.value: _status_reply(1),
+        MksCommands.RELEASE_MOTOR_SHAFT_LOCKED_PROTECTION_STATE.value: _status_reply(SuccessStatus.Success.value),
+        MksCommands.READ_MOTOR_SHAFT_PROTECTION_STATE.value: _status_reply(0),
+        MksCommands.QUERY_MOTOR_STATUS_COMMAND.value: _query_motor_status,
+        MksCommands.ENABLE_MOTOR_COMMAND.value: _enable_motor,
+        MksCommands.EMERGENCY_STOP_COMMAND.value: _emergency_stop,
+        MksCommands.RUN_MOTOR_SPEED_MODE_COMMAND.value: _run_speed_mode,
+        MksCommands.RUN_MOTOR_RELATIVE_MOTION_BY_PULSES_COMMAND.value: _run_position,
+        MksCommands.RUN_MOTOR_ABSOLUTE_MOTION_BY_PULSES_COMMAND.value: _run_position,
+        MksCommands.RUN_MOTOR_RELATIVE_MOTION_BY_AXIS_COMMAND.value: _run_position,
+        MksCommands.RUN_MOTOR_ABSOLUTE_MOTION_BY_AXIS_COMMAND.value: _run_position,
+        MksCommands.MOTOR_CALIBRATION_COMMAND.value: _calibrate,
+        MksCommands.GO_HOME_COMMAND.value: _go_home,
+        MksCommands.SET_CURRENT_AXIS_TO_ZERO_COMMAND.value: _set_current_axis_to_zero,
+        MksCommands.SET_SUBDIVISIONS_COMMAND.value: _set_subdivisions,
+        MksCommands.SET_CAN_ID_COMMAND.value: _set_can_id,
+        MksCommands.SET_GROUP_ID_COMMAND.value: _set_group_id,
+    }
@@ -0,0 +1,198 @@
+import logging
+import threading
+import time
+from collections import deque
+
+from core.mks_enums import Direction, MksCommands, RunMotorResult, SuccessStatus
+from core.can_motor import MAX_SPEED, _SPEED_MODE_LAYOUT, _speed_field
+from core.mks_servo import CanMessageError
+from core.can_scheduler import TransmitPriority
+
+class SpeedStreamer:
+    """Streams speed mode setpoints to a servo at a fixed rate, for continuous motions such as
+    breathing or head tracking that absolute moves can not produce.
+
+    The setpoints are sent without waiting for their responses. The acknowledgements are
+    checked asynchronously, from the notifier thread: they are matched in order with the sent
+    setpoints, and a setpoint whose acknowledgement is not received within ack_timeout is
+    counted as dropped.
+
+    The setpoint of each tick is the value returned by the trajectory, called with the number of
+    seconds since the start, or else the last value given to set_speed. Setpoints are signed
+    speeds in RPM: positive runs CCW and negative runs CW.
+
+    Attributes:
+        servo (MksServo): The servo, it must not run other motions while streaming.
+        period (float): Number of seconds between setpoints.
+        acceleration (int): The acceleration of the speed mode, in the range of 0 to 255.
+        ack_timeout (float): Number of seconds after which a missing acknowledgement is dropped.
+    """
+    def __init__(self, servo, rate_hz=200, acceleration=0, trajectory=None, ack_timeout=0.1):
+        self.servo = servo
+        self.period = 1 / rate_hz
+        self.acceleration = acceleration
+        self.trajectory = trajectory
+        self.ack_timeout = ack_timeout
+        self.speed = 0
+
+        self._stop_event = threading.Event()
+        self._thread = None
+        # Send time of the setpoints whose acknowledgement has not been received yet
+        self._in_flight = deque()
+        self._stats_lock = threading.Lock()
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self.sent = 0
+        self.acked = 0
+        self.failed = 0
+        self.dropped = 0
+        self.late = 0
+        self.overruns = 0
+        self._in_flight.clear()
+
+    def set_speed(self, speed):
+        """
+        Sets the setpoint sent from the next tick, when there is no trajectory.
+
+        Args:
+            speed (int): Signed speed in RPM, positive runs CCW and negative runs CW.
+        """
+        self.speed = speed
+
+    def start(self):
+        """
+        Starts streaming in a background thread.
+
+        Raises:
+            motor_already_running_error: If a motion is running.
+        """
+        self.servo.check_motor_idle()
+        self._stop_event.clear()
+        with self._stats_lock:
+            self._reset_stats()
+        self.servo.set_speed_mode_ack_listener(self._on_ack)
+        # Streaming keeps the motor busy, so the motion commands are refused until it stops
+        self.servo._set_motor_run_status(RunMotorResult.RunStarting)
+        self._thread = threading.Thread(target=self._run, name="speed-streamer", daemon=True)
+        self._thread.start()
+
+    def stop(self, acceleration=None):
+        """
+        Stops streaming and decelerates the motor to a stop.
+
+        Args:
+            acceleration (int, optional): The acceleration of the stop. Defaults to self.acceleration.
+
+        Returns:
+            SuccessStatus: The result of the stop command, None if it was not acknowledged.
+        """
+        self._stop_event.set()
+        if self._thread and self._thread.is_alive():
+            self._thread.join()
+        self.servo.set_speed_mode_ack_listener(None)
+        with self._stats_lock:
+            self.dropped += len(self._in_flight)
+            self._in_flight.clear()
+        return self.servo.run_motor_in_speed_mode(Direction.CCW, 0, self.acceleration if acceleration is None else acceleration)
+
+    def halt(self):
+        """
+        Stops sending setpoints, without waiting for the streaming thread nor stopping the motor.
+
+        The setpoints are sent while holding the bus, so no setpoint follows a frame sent after halt
+        returns, i.e. an emergency stop. stop must still be called to end the streaming.
+        """
+        self._stop_event.set()
+
+    def wait_for_stop(self, timeout):
+        """
+        Waits until the motor stops after stop, querying its status at the streaming rate.
+
+        Args:
+            timeout (float): Maximum number of seconds to wait.
+
+        Returns:
+            boolean: The running state of the motor at the end of this method.
+        """
+        deadline = time.monotonic() + timeout
+        while self.servo.is_motor_running():
+            if time.monotonic() >= deadline:
+                return True
+            time.sleep(self.period)
+        return False
+
+    def stats(self):
+        """
+        Returns the streaming counters.
+
+        Returns:
+            dict: sent setpoints, acked setpoints, failed (acknowledged with a failure status),
+            dropped (not acknowledged in time), late (acknowledged after being dropped), overruns
+            (ticks skipped because the previous one was late) and in_flight setpoints.
+        """
+        with self._stats_lock:
+            return {
+                'sent': self.sent,
+                'acked': self.acked,
+                'failed': self.failed,
+                'dropped': self.dropped,
+                'late': self.late,
+                'overruns': self.overruns,
+                'in_flight': len(self._in_flight),
+            }
+
+    def _on_ack(self, status):
+        # Called from the notifier thread with the status of each speed mode response
+        with self._stats_lock:
+            if not self._in_flight:
+                self.late += 1
+                return
+            self._in_flight.popleft()
+            self.acked += 1
+            if status != SuccessStatus.Success:
+                self.failed += 1
+
+    def _send_setpoint(self, speed):
+        speed = max(-MAX_SPEED, min(MAX_SPEED, int(speed)))
+        direction = Direction.CW if speed < 0 else Direction.CCW
+        # Checked while holding the bus, so no setpoint follows a frame sent after halt
+        with self.servo.scheduler.hold(TransmitPriority.MOTION):
+            if self._stop_event.is_set():
+                return
+            now = time.monotonic()
+            with self._stats_lock:
+                # Acknowledgements are received in order, the ones still missing after ack_timeout are dropped
+                while self._in_flight and now - self._in_flight[0] > self.ack_timeout:
+                    self._in_flight.popleft()
+                    self.dropped += 1
+                # Registered before sending, the acknowledgement can be received before send_packed returns
+                self._in_flight.append(now)
+                self.sent += 1
+            try:
+                self.servo.send_packed(_SPEED_MODE_LAYOUT, None, MksCommands.RUN_MOTOR_SPEED_MODE_COMMAND.value,
+                    _speed_field(direction, abs(speed)), self.acceleration)
+            except CanMessageError:
+                with self._stats_lock:
+                    if self._in_flight and self._in_flight[-1] == now:
+                        self._in_flight.pop()
+                    self.sent -= 1
+                raise
+
+    def _run(self):
+        start = next_tick = time.monotonic()
+        while not self._stop_event.is_set():
+            try:
+                speed = self.trajectory(next_tick - start) if self.trajectory is not None else self.speed
+                self._send_setpoint(speed)
+            except Exception as e:
+                logging.warning(f"Speed setpoint failed: {e}")
+            next_tick += self.period
+            now = time.monotonic()
+            if next_tick < now:
+                # Skip the ticks that are already late instead of bursting to catch up
+                skipped = int((now - next_tick) / self.period) + 1
+                with self._stats_lock:
+                    self.overruns += skipped
+                next_tick += skipped * self.period
+            self._stop_event.wait(next_tick - now)
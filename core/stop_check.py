@@ -0,0 +1,65 @@
+import threading
+import time
+
+import can
+
+from core.can_decoders import GENERIC_RESPONSE_LENGTH
+from core.mks_enums import MksCommands
+
+# Frames recording shared by the emergency stop tests and benchmarks/bench_stop.py
+
+# A sequence with 5 second steps, the first two ones blend into a single move
+STOP_CHECK_SEQUENCE = """Degrees,Speed,Acceleration,Duration,Label
+90,100,5,5,out
+90,100,5,5,hold
+0,100,5,5,back
+"""
+
+MOTION_COMMANDS = {command.value for command in (
+    MksCommands.RUN_MOTOR_RELATIVE_MOTION_BY_PULSES_COMMAND,
+    MksCommands.RUN_MOTOR_ABSOLUTE_MOTION_BY_PULSES_COMMAND,
+    MksCommands.RUN_MOTOR_RELATIVE_MOTION_BY_AXIS_COMMAND,
+    MksCommands.RUN_MOTOR_ABSOLUTE_MOTION_BY_AXIS_COMMAND,
+)}
+
+class BusRecorder(can.Listener):
+    """Records the time.perf_counter() and data of the frames sent to a servo.
+
+    The responses of the servo have the same arbitration id, they are told apart by their length.
+
+    Attributes:
+        frames (list of tuple): The (timestamp, data) of each frame sent to the servo.
+        stop_sent (threading.Event): Set when an emergency stop frame is recorded.
+    """
+    def __init__(self, can_id):
+        self.can_id = can_id
+        self.frames = []
+        self.stop_sent = threading.Event()
+
+    def on_message_received(self, msg):
+        if msg.arbitration_id != self.can_id or not msg.data or len(msg.data) == GENERIC_RESPONSE_LENGTH:
+            return
+        self.frames.append((time.perf_counter(), bytes(msg.data)))
+        if msg.data[0] == MksCommands.EMERGENCY_STOP_COMMAND.value:
+            self.stop_sent.set()
+
+    def clear(self):
+        """Forgets the recorded frames."""
+        self.frames.clear()
+        self.stop_sent.clear()
+
+    def stop_times(self):
+        """Returns the timestamps of the emergency stop frames."""
+        return [timestamp for timestamp, data in self.frames if data[0] == MksCommands.EMERGENCY_STOP_COMMAND.value]
+
+    def moves_after(self, start):
+        """Returns the motion frames sent after start, a speed mode setpoint of 0 only decelerates."""
+        moves = []
+        for timestamp, data in self.frames:
+            if timestamp <= start:
+                continue
+            if data[0] in MOTION_COMMANDS:
+                moves.append(data)
+            elif data[0] == MksCommands.RUN_MOTOR_SPEED_MODE_COMMAND.value and ((data[1] & 0x0F) << 8 | data[2]):
+                moves.append(data)
+        return moves
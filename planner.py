@@ -0,0 +1,149 @@
+# planner.py
+import math
+from bisect import bisect_right
+from typing import NamedTuple
+from core.can_motor import acceleration_to_rpm_per_second
+
+# A speed of 1 RPM is 360 degrees per minute
+DEGREES_PER_SECOND_PER_RPM = 6
+
+class ProfileSegment(NamedTuple):
+    """A move, or a dwell when its distance is 0, of a blended motion profile.
+
+    The move accelerates from start_speed to peak_speed, cruises and decelerates to end_speed.
+    Speeds are unsigned, in degrees per second, and the direction is the sign of the distance.
+    """
+    row: int
+    label: str
+    start_time: float
+    start_degrees: float
+    end_degrees: float
+    start_speed: float
+    peak_speed: float
+    end_speed: float
+    accel_time: float
+    cruise_time: float
+    decel_time: float
+    acceleration: float
+
+    @property
+    def duration(self):
+        return self.accel_time + self.cruise_time + self.decel_time
+
+    @property
+    def direction(self):
+        return (self.end_degrees > self.start_degrees) - (self.end_degrees < self.start_degrees)
+
+    def speed_at(self, t):
+        """Unsigned speed in degrees per second, t seconds after the start of the segment."""
+        if t < self.accel_time:
+            return self.start_speed + self.acceleration * t
+        t -= self.accel_time
+        if t < self.cruise_time:
+            return self.peak_speed
+        t -= self.cruise_time
+        return max(self.end_speed, self.peak_speed - self.acceleration * t) if t < self.decel_time else self.end_speed
+
+class MotionProfile:
+    """A velocity profile through the targets of a sequence, see plan_profile."""
+    def __init__(self, segments):
+        self.segments = tuple(segments)
+        self._start_times = [segment.start_time for segment in self.segments]
+
+    @property
+    def duration(self):
+        """Number of seconds of the whole profile."""
+        return self.segments[-1].start_time + self.segments[-1].duration if self.segments else 0.0
+
+    def starts_at(self, degrees):
+        """Returns True if the profile starts from the position degrees, an empty profile starts anywhere."""
+        return not self.segments or self.segments[0].start_degrees == degrees
+
+    @property
+    def end_degrees(self):
+        """The position at the end of the profile."""
+        return self.segments[-1].end_degrees if self.segments else None
+
+    def segment_at(self, t):
+        """Index of the segment running t seconds after the start of the profile."""
+        return max(0, bisect_right(self._start_times, t) - 1)
+
+    def speed_at(self, t):
+        """Signed speed in RPM, t seconds after the start of the profile. Positive increases the position."""
+        if not self.segments or t < 0 or t >= self.duration:
+            return 0
+        segment = self.segments[self.segment_at(t)]
+        return segment.direction * segment.speed_at(t - segment.start_time) / DEGREES_PER_SECOND_PER_RPM
+
+def _trapezoid(distance, start_speed, end_speed, max_speed, acceleration):
+    # Highest speed reachable before decelerating to end_speed within the distance
+    peak_speed = min(max_speed, math.sqrt((2 * acceleration * distance + start_speed ** 2 + end_speed ** 2) / 2))
+    peak_speed = max(peak_speed, start_speed, end_speed)
+    accel_time = (peak_speed - start_speed) / acceleration
+    decel_time = (peak_speed - end_speed) / acceleration
+    accel_distance = (peak_speed ** 2 - start_speed ** 2) / (2 * acceleration)
+    decel_distance = (peak_speed ** 2 - end_speed ** 2) / (2 * acceleration)
+    cruise_time = max(0.0, distance - accel_distance - decel_distance) / peak_speed
+    return peak_speed, accel_time, cruise_time, decel_time
+
+def plan_profile(steps, start_degrees, speed_max, acceleration_max):
+    """Blend the steps of a sequence into a continuous velocity profile.
+
+    Consecutive moves in the same direction are joined without stopping, at the lowest of their
+    speeds when reachable within the acceleration limit, so there is no dead time at the
+    waypoints. The motor only stops to reverse, and for the steps that do not move (same target
+    or speed 0), which become dwells of the step duration. The other durations are not used.
+
+    Args:
+        steps (list of SequenceStep): The steps, see controller.load_sequence.
+        start_degrees (float): The position of the motor at the start of the profile.
+        speed_max (int): Maximum speed in RPM, the speed of the steps is clamped to it.
+        acceleration_max (int): Acceleration parameter (0 to 255) of the servo commands used for
+            all the speed changes. 0 means no acceleration ramp.
+
+    Returns:
+        MotionProfile: The profile.
+    """
+    acceleration = acceleration_to_rpm_per_second(acceleration_max) * DEGREES_PER_SECOND_PER_RPM
+
+    # (step, start, end, max speed) of each segment, the max speed of a dwell is 0
+    moves = []
+    position = start_degrees
+    for step in steps:
+        speed = min(step.speed, speed_max) * DEGREES_PER_SECOND_PER_RPM
+        if step.degrees == position or speed <= 0:
+            moves.append((step, position, position, 0))
+        else:
+            moves.append((step, position, step.degrees, speed))
+            position = step.degrees
+
+    # Speed at the end of each segment: the lowest cruise speed when the next one goes the same way, else a stop
+    end_speeds = [0.0] * len(moves)
+    for i in range(len(moves) - 1):
+        (_, start, end, speed), (_, next_start, next_end, next_speed) = moves[i], moves[i + 1]
+        if speed and next_speed and (end - start) * (next_end - next_start) > 0:
+            end_speeds[i] = min(speed, next_speed)
+
+    def reachable(speed, distance):
+        return math.sqrt(speed ** 2 + 2 * acceleration * distance) if distance else speed
+
+    # Limit the junction speeds to what can be braked, then reached, within each segment
+    for i in reversed(range(1, len(moves))):
+        _, start, end, _ = moves[i]
+        end_speeds[i - 1] = min(end_speeds[i - 1], reachable(end_speeds[i], abs(end - start)))
+    for i, (_, start, end, _) in enumerate(moves):
+        start_speed = end_speeds[i - 1] if i > 0 else 0.0
+        end_speeds[i] = min(end_speeds[i], reachable(start_speed, abs(end - start)))
+
+    segments = []
+    time = 0.0
+    for i, (step, start, end, speed) in enumerate(moves):
+        if speed == 0:
+            segments.append(ProfileSegment(step.row, step.label, time, start, end, 0.0, 0.0, 0.0, 0.0, step.duration, 0.0, acceleration))
+        else:
+            start_speed = end_speeds[i - 1] if i > 0 else 0.0
+            peak_speed, accel_time, cruise_time, decel_time = _trapezoid(abs(end - start), start_speed, end_speeds[i], speed, acceleration)
+            segments.append(ProfileSegment(step.row, step.label, time, start, end, start_speed, peak_speed, end_speeds[i],
+                accel_time, cruise_time, decel_time, acceleration))
+        time += segments[-1].duration
+    return MotionProfile(segments)
@@ -1,12 +1,19 @@
 # server.py
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import StreamingResponse, PlainTextResponse
 from pydantic import BaseModel
 from typing import Optional
 import uvicorn
 import os
-import pandas as pd
-from controller import ServoController
+from controller import ServoController, MOTOR_IDLE_TIMEOUT
+from core.cancellation import CancellationToken
+from core.async_mks_servo import AsyncMksServo
+from telemetry import TelemetryPoller, StateBroadcaster
+from core.can_metrics import format_prometheus
+from planner import DEGREES_PER_SECOND_PER_RPM
+import asyncio
 import threading
+import json
 import time
 from datetime import datetime
 from contextlib import asynccontextmanager
@@ -17,31 +24,67 @@ async def lifespan(app: FastAPI):
     global execution_thread, stop_event
 
     # Code to run during startup
-    stop_event.clear()  # Ensure the stop event is cleared
+    telemetry.start()
     file_path = "instructions/sequence.csv"
 
     if os.path.exists(file_path):
-        execution_thread = threading.Thread(target=loop_sequence, args=(file_path,))
-        execution_thread.start()
+        start_sequence(file_path)
     else:
         print("sequence.csv not found. Please ensure the file exists in the 'instructions' directory.")
     
     yield  # Run the app
 
     # Code to run during shutdown
-    stop_event.set()  # Signal to stop any ongoing sequence
-    if execution_thread and execution_thread.is_alive():
-        execution_thread.join()  # Wait for the thread to finish
+    with sequence_lock:
+        stop_event.set()  # Signal to stop any ongoing sequence
+        thread = execution_thread
+    if thread and thread.is_alive():
+        thread.join(SHUTDOWN_JOIN_TIMEOUT)
+        if thread.is_alive():
+            print(f"The sequence did not stop within {SHUTDOWN_JOIN_TIMEOUT} seconds, shutting down anyway.")
+    telemetry.stop()
     servo_controller.shutdown()
 
 app = FastAPI(lifespan=lifespan)
 
-# Initialize the ServoController
-servo_controller = ServoController()
+# Initialize the ServoController, set OWL_SIMULATOR=1 to run against a simulated servo on a virtual CAN bus
+if os.environ.get("OWL_SIMULATOR"):
+    from core.mks_simulator import SimulatedMksServo
+    simulator = SimulatedMksServo(channel="owl_simulator", can_id=1)
+    simulator.start()
+    servo_controller = ServoController(can_interface="virtual", channel="owl_simulator")
+else:
+    servo_controller = ServoController()
+# Async client sharing the servo, the /servo_health reads wait on the event loop instead of a worker thread
+async_servo = AsyncMksServo(servo_controller.servo)
+# Pushes the state to the /state_stream subscribers when it changes
+state_broadcaster = StateBroadcaster()
+
+def publish_state(*args):
+    """Publish the current state to the stream subscribers if it changed. Called from the worker threads."""
+    state = get_current_state()
+    previous = state_broadcaster.state
+    # The elapsed time changes on every call, it is not a change of the state by itself
+    if previous is None or {**previous, "elapsed_time": None} != {**state, "elapsed_time": None}:
+        state_broadcaster.publish(state)
+
+# Single background sampler of the servo state, shared by all the HTTP readers
+telemetry = TelemetryPoller(servo_controller, servo_controller.config.get('telemetry_rate_hz', 10), on_sample=publish_state)
 
-# Shared state to manage the execution thread and stopping
-stop_event = threading.Event()
+# Shared state to manage the execution thread and stopping, each sequence run has its own token
+stop_event = CancellationToken()
 execution_thread = None
+# Guards the swap of stop_event and execution_thread, the endpoints run in a thread pool
+sequence_lock = threading.Lock()
+
+# Maximum number of seconds the emergency stop waits for the sequence thread, after the stop frame is sent
+EMERGENCY_STOP_JOIN_TIMEOUT = 0.5
+
+# Maximum number of seconds the shutdown waits for the sequence thread
+SHUTDOWN_JOIN_TIMEOUT = 2
+
+# Number of seconds a looping sequence waits after an error before restarting
+SEQUENCE_RETRY_DELAY = 1
 
 # Global variable to store the last executed step information
 last_step_info = {
@@ -55,6 +98,9 @@ last_step_info = {
     "sequence_file": None,
     "step_number": None,
     "warning": None,  # New field to store warnings
+    "jitter": None,  # Delay in seconds between the scheduled and the actual start of the step
+    "motor_speed": None,  # Sampled motor speed in RPM
+    "motor_status": None,  # Sampled motor status
 }
 
 class PositionCommand(BaseModel):
@@ -67,66 +113,109 @@ class PositionCommand(BaseModel):
 class SequenceCommand(BaseModel):
     file_path: str
 
-def loop_sequence(file_path: str):
-    global stop_event, last_step_info
-    sequence_df = pd.read_csv(file_path)
+def start_sequence(file_path: str):
+    """Cancel the running sequence and loop over a new one in the background, without waiting for the previous one to end."""
+    global execution_thread, stop_event
+    with sequence_lock:
+        previous_thread = execution_thread if execution_thread and execution_thread.is_alive() else None
+        stop_event.set()
+        # The cancelled token stays set while the previous thread winds down
+        stop_event = CancellationToken()
+        execution_thread = threading.Thread(target=loop_sequence, args=(file_path, stop_event, previous_thread), daemon=True)
+        execution_thread.start()
+
+def loop_blended_sequence(file_path: str, cancel: CancellationToken):
+    """Loop over a sequence as a blended motion profile, without stopping at the waypoints."""
+    global last_step_info
+
+    def on_segment(index, segment):
+        last_step_info.update({
+            "degrees": segment.end_degrees,
+            "speed": round(segment.peak_speed / DEGREES_PER_SECOND_PER_RPM),
+            "acceleration": servo_controller.config['acceleration_max'],
+            "duration": segment.duration,
+            "label": segment.label,
+            "start_time": datetime.now(),
+            "step_number": segment.row + 1,  # Step number is 1-based index
+            "warning": None,
+            "elapsed_time": None,
+            "jitter": None,
+        })
+        publish_state()
 
-    print(sequence_df)
-    while not stop_event.is_set():
+    start_degrees = None
+    while not cancel.is_set():
         try:
-            for i, row in sequence_df.iterrows():
-                if stop_event.is_set():
-                    break
-                
-                print(f"Processing row {i}: {row}")
-
-                if not row.empty:
-                    try:
-                        # Extract row values with checks for None
-                        degrees = row['Degrees']
-                        speed = row['Speed']
-                        acceleration = row['Acceleration']
-                        duration = row['Duration']
-                        label = row['Label']
-
-                        # Check if any required field is None
-                        if any(x is None for x in [degrees, speed, acceleration, duration, label]):
-                            print(f"One or more required fields are None in row {i}. Skipping this row.")
-                            continue
-
-                        # Debugging information
-                        print(f"Executing instruction: Degrees={degrees}, Speed={speed}, Acceleration={acceleration}, Duration={duration}, Label={label}")
-                        
-                        # Execute the instruction and get the result
-                        elapsed_time, warning_msg = servo_controller.execute_instruction(degrees, speed, acceleration, duration, label)
-
-                        # Update last step information
-                        last_step_info.update({
-                            "degrees": degrees,
-                            "speed": speed,
-                            "acceleration": acceleration,
-                            "duration": duration,
-                            "label": label,
-                            "start_time": datetime.now(),
-                            "step_number": i + 1,  # Step number is 1-based index
-                            "warning": warning_msg,
-                            "elapsed_time": elapsed_time
-                        })
-
-                    except TypeError as e:
-                        print(f"Error accessing row data at step {i}: {e}")
-                        break
-                    except Exception as e:
-                        print(f"Unexpected error at step {i}: {e}")
-                        break
-                else:
-                    print(f"Skipping empty row {i}")
+            profile = servo_controller.plan_sequence(file_path, start_degrees)
+            if not profile.segments:
+                print("Sequence is empty. Nothing to execute.")
+                return
+            servo_controller.execute_profile(profile, cancel, on_segment)
+        except Exception as e:
+            # The show goes on, the next pass starts from the current position
+            print(f"Error executing sequence: {e}. Restarting...")
+            start_degrees = None
+            cancel.wait(SEQUENCE_RETRY_DELAY)
+            continue
+        # The next loop starts where this one ends
+        start_degrees = profile.end_degrees
+
+        if not cancel.is_set():
+            print("Sequence completed. Restarting...")
+
+def loop_sequence(file_path: str, cancel: CancellationToken, previous_thread: Optional[threading.Thread] = None):
+    global last_step_info
+    # Let the cancelled sequence wind down and its last motion complete
+    if previous_thread is not None:
+        previous_thread.join()
+    while servo_controller.wait_for_motor_idle(MOTOR_IDLE_TIMEOUT, cancel) and not cancel.is_set():
+        pass
+    if cancel.is_set():
+        return
+
+    if servo_controller.config.get('blend_sequences', False):
+        loop_blended_sequence(file_path, cancel)
+        return
+
+    try:
+        program = servo_controller.compile_sequence(file_path)
+    except Exception as e:
+        print(f"Error compiling sequence: {e}")
+        return
+
+    if not program:
+        print("Sequence is empty. Nothing to execute.")
+        return
 
+    def on_step(index, step, elapsed_time, warning_msg, jitter):
+        # Update last step information
+        last_step_info.update({
+            "degrees": step.degrees,
+            "speed": step.speed,
+            "acceleration": step.acceleration,
+            "duration": step.duration,
+            "label": step.label,
+            "start_time": datetime.now(),
+            "step_number": step.row + 1,  # Step number is 1-based index
+            "warning": warning_msg,
+            "elapsed_time": elapsed_time,
+            "jitter": jitter,
+        })
+        publish_state()
+
+    # Every loop starts at the end of the previous one on the same absolute timeline, so it does not drift
+    timeline_start = None
+    while not cancel.is_set():
+        try:
+            timeline_start = servo_controller.execute_timeline(program, timeline_start, cancel, on_step)
         except Exception as e:
-            print(f"Error executing sequence: {e}")
-            break
+            # The show goes on, the next pass starts on a new timeline
+            print(f"Error executing sequence: {e}. Restarting...")
+            timeline_start = None
+            cancel.wait(SEQUENCE_RETRY_DELAY)
+            continue
 
-        if not stop_event.is_set():
+        if not cancel.is_set():
             print("Sequence completed. Restarting...")
 
 @app.get("/execute_position")
@@ -143,55 +232,92 @@ def execute_position(degrees: int, speed: int, acceleration: int, duration: floa
             "start_time": datetime.now(),
             "elapsed_time": elapsed_time,
             "warning": warning_msg,
+            "jitter": None,  # Only measured against the schedule of a sequence
             "step_number": None,  # Not part of a sequence, so no step number
             "sequence_file": None,  # Not part of a sequence, so no sequence file
         })
+        publish_state()
         return {"status": "success", "message": f"Executed {label} to {degrees} degrees at speed {speed} with acceleration {acceleration}"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/run_sequence")
 def run_sequence(file_path: str):
-    global execution_thread, stop_event
-
     if not os.path.exists(file_path):
         raise HTTPException(status_code=404, detail="File not found")
 
-    # Ensure any previous sequence is stopped before starting a new one
-    if execution_thread and execution_thread.is_alive():
-        stop_event.set()  # Signal the thread to stop
-        execution_thread.join()  # Wait for the thread to finish
-
-    stop_event.clear()  # Reset the stop event for the new sequence
-
-    execution_thread = threading.Thread(target=loop_sequence, args=(file_path,))
-    execution_thread.start()
+    # The previous sequence is cancelled, the new one starts once its last motion completes
+    start_sequence(file_path)
 
     return {"status": "success", "message": f"Started executing sequence from {file_path}"}
 
 @app.get("/emergency_stop")
 def emergency_stop():
-    global stop_event
-
     try:
-        stop_event.set()  # Signal the sequence execution to stop
-        if execution_thread and execution_thread.is_alive():
-            execution_thread.join()  # Wait for the thread to finish
-        servo_controller.servo.emergency_stop_motor()
+        # Setting the event does not delay the stop frame, and the sequence thread starts no new step after it.
+        # Under the lock, so it is the token of the running sequence and not one being replaced
+        with sequence_lock:
+            stop_event.set()
+            thread = execution_thread
+        servo_controller.emergency_stop()
+        if thread and thread.is_alive():
+            thread.join(EMERGENCY_STOP_JOIN_TIMEOUT)
+        # A move sent by the sequence thread just before it saw the stop event
+        if servo_controller.is_motor_busy():
+            servo_controller.emergency_stop()
         return {"status": "success", "message": "Servo motor stopped successfully"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.get("/last_step_info")
-def get_last_step_info():
-    global last_step_info
+def get_current_state():
+    """Return the last step information with the elapsed time and the sampled servo state."""
+    state = dict(last_step_info)
 
-    if last_step_info['start_time']:
-        last_step_info['elapsed_time'] = (datetime.now() - last_step_info['start_time']).total_seconds()
+    if state['start_time']:
+        state['elapsed_time'] = (datetime.now() - state['start_time']).total_seconds()
     
-    last_step_info['degrees'] = servo_controller.get_motor_degrees()
+    # Served from the telemetry snapshot, so the number of viewers does not add bus traffic
+    snapshot = telemetry.snapshot
+    if snapshot.degrees is not None:
+        state['degrees'] = snapshot.degrees
+    state['motor_speed'] = snapshot.speed
+    state['motor_status'] = snapshot.status
         
-    return last_step_info
+    return state
+
+@app.get("/last_step_info")
+async def get_last_step_info():
+    return get_current_state()
+
+@app.get("/state_stream")
+async def state_stream(request: Request):
+    """Server-Sent Events stream of the state, pushed when it changes."""
+    async def events():
+        subscription = state_broadcaster.subscribe()
+        try:
+            state = get_current_state()
+            while not await request.is_disconnected():
+                yield f"data: {json.dumps(state, default=str)}\n\n"
+                state = await subscription.get()
+        finally:
+            state_broadcaster.unsubscribe(subscription)
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+@app.get("/servo_health")
+async def servo_health():
+    """Enable pin, locked-rotor protection and power-on homing states, read concurrently on the event loop."""
+    try:
+        en_pins, protection, go_back_to_zero = await asyncio.gather(async_servo.read_en_pins_status(),
+            async_servo.read_motor_shaft_protection_state(), async_servo.read_go_back_to_zero_status_when_power_on())
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    return {"en_pins": en_pins.name, "shaft_protection": protection.name, "go_back_to_zero": go_back_to_zero.name}
+
+@app.get("/metrics")
+async def metrics():
+    """Per op code request counters and response latency of the servo, in the Prometheus text format."""
+    return PlainTextResponse(format_prometheus([servo_controller.servo]), media_type="text/plain; version=0.0.4")
 
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=9120)
\ No newline at end of file
@@ -0,0 +1,119 @@
+# telemetry.py
+import asyncio
+import logging
+import threading
+import time
+from typing import NamedTuple, Optional
+from core.mks_enums import MksCommands
+
+class TelemetrySnapshot(NamedTuple):
+    """Servo state sampled by the TelemetryPoller."""
+    timestamp: Optional[float] = None
+    position_units: Optional[int] = None
+    degrees: Optional[int] = None
+    speed: Optional[int] = None
+    status: Optional[str] = None
+
+class TelemetryPoller:
+    """Samples the position, speed and status of the servo in a background thread.
+
+    Readers get the latest snapshot without touching the bus, so the bus load is constant
+    regardless of the number of readers. The snapshot is an immutable tuple replaced as a
+    whole, so reading it needs no lock.
+    """
+    TELEMETRY_COMMANDS = (
+        MksCommands.READ_ENCODED_VALUE_ADDITION,
+        MksCommands.READ_MOTOR_SPEED,
+        MksCommands.QUERY_MOTOR_STATUS_COMMAND,
+    )
+
+    def __init__(self, controller, rate_hz=10, on_sample=None):
+        self.controller = controller
+        self.period = 1 / rate_hz
+        # Called from the sampling thread with every new snapshot
+        self.on_sample = on_sample
+        self.snapshot = TelemetrySnapshot()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start sampling in a background thread."""
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="telemetry", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop sampling and wait for the background thread to finish."""
+        self._stop_event.set()
+        if self._thread and self._thread.is_alive():
+            self._thread.join()
+
+    def sample(self):
+        """Read the servo state and publish a new snapshot."""
+        results = self.controller.servo.read_batch(self.TELEMETRY_COMMANDS)
+        position_units = results[MksCommands.READ_ENCODED_VALUE_ADDITION]
+        status = results[MksCommands.QUERY_MOTOR_STATUS_COMMAND]
+        self.snapshot = TelemetrySnapshot(
+            timestamp=time.time(),
+            position_units=position_units,
+            degrees=self.controller.units_to_degrees(position_units) if position_units is not None else self.snapshot.degrees,
+            speed=results[MksCommands.READ_MOTOR_SPEED],
+            status=status.name if status is not None else None,
+        )
+        if self.on_sample is not None:
+            self.on_sample(self.snapshot)
+
+    def _run(self):
+        next_sample = time.monotonic()
+        while not self._stop_event.is_set():
+            try:
+                self.sample()
+            except Exception as e:
+                logging.warning(f"Telemetry sample failed: {e}")
+            next_sample += self.period
+            # Skip the samples that are already late instead of bursting to catch up
+            next_sample = max(next_sample, time.monotonic())
+            self._stop_event.wait(next_sample - time.monotonic())
+
+def _put_latest(queue, state):
+    # Slow subscribers only need the latest state, drop the one they have not read yet
+    if queue.full():
+        queue.get_nowait()
+    queue.put_nowait(state)
+
+class StateSubscription:
+    """Queue of the states published to an asyncio subscriber."""
+    def __init__(self, loop):
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=1)
+
+    async def get(self):
+        """Wait for the next published state."""
+        return await self.queue.get()
+
+class StateBroadcaster:
+    """Pushes state updates from any thread to the asyncio subscribers, i.e. streaming HTTP responses."""
+    def __init__(self):
+        self.state = None
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    def publish(self, state):
+        """Publish a new state to all the subscribers. It can be called from any thread."""
+        with self._lock:
+            self.state = state
+            subscribers = list(self._subscribers)
+        for subscription in subscribers:
+            subscription.loop.call_soon_threadsafe(_put_latest, subscription.queue, state)
+
+    def subscribe(self):
+        """Subscribe the running event loop to the published states."""
+        subscription = StateSubscription(asyncio.get_running_loop())
+        with self._lock:
+            self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """Stop publishing states to a subscription."""
+        with self._lock:
+            self._subscribers.discard(subscription)
@@ -0,0 +1,40 @@
+import os
+import sys
+import itertools
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import can
+import pytest
+from core.mks_servo import MksServo
+from core.mks_simulator import SimulatedMksServo
+
+_channels = itertools.count()
+
+@pytest.fixture
+def simulator():
+    """A simulated servo with CAN ID 1 on its own virtual bus."""
+    with SimulatedMksServo(channel=f"pytest_{next(_channels)}", can_id=1) as simulator:
+        yield simulator
+
+@pytest.fixture
+def servo(simulator):
+    """An MksServo driving the simulated servo, with a short response timeout."""
+    bus = can.interface.Bus(interface='virtual', channel=simulator.channel)
+    notifier = can.Notifier(bus, [], timeout=0.1)
+    servo = MksServo(bus, notifier, simulator.can_id)
+    servo.timeout = 0.2
+    yield servo
+    notifier.stop()
+    bus.shutdown()
+
+# Group ID of the axes fixture, not the CAN ID of any of them
+GROUP_ID = 0x50
+
+@pytest.fixture
+def axes():
+    """Two simulated servos, head with CAN ID 1 and wing with CAN ID 2, sharing a virtual bus and GROUP_ID."""
+    channel = f"pytest_{next(_channels)}"
+    with SimulatedMksServo(channel=channel, can_id=1, group_id=GROUP_ID) as head, \
+            SimulatedMksServo(channel=channel, can_id=2, group_id=GROUP_ID) as wing:
+        yield {'head': head, 'wing': wing}
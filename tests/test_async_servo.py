@@ -0,0 +1,23 @@
+import asyncio
+
+import pytest
+
+from core.async_mks_servo import AsyncMksServo
+from core.mks_enums import MksCommands
+
+def test_async_reads_resolve_from_the_receive_path(simulator, servo):
+    simulator.position = 1234
+    async_servo = AsyncMksServo(servo)
+    async def read():
+        return await asyncio.gather(async_servo.read_encoder_value_addition(), async_servo.query_motor_status())
+    position, _ = asyncio.run(read())
+    assert position == 1234
+
+def test_async_read_timing_out_abandons_its_request(simulator, servo):
+    simulator.stop()
+    assert asyncio.run(AsyncMksServo(servo).read_encoder_value_addition()) is None
+    assert servo.get_metrics()[MksCommands.READ_ENCODED_VALUE_ADDITION.value]['timeouts'] == 1
+
+def test_unimplemented_command_raises(servo):
+    with pytest.raises(NotImplementedError):
+        asyncio.run(AsyncMksServo(servo).set_slave_respond_active(1, 1))
@@ -0,0 +1,82 @@
+import can
+import pytest
+
+from core import can_cache
+from core.can_cache import CACHE_INVALIDATIONS, DEFAULT_CACHE_TTLS, ResponseCache
+from core.mks_enums import Enable, EnableStatus, MksCommands
+from core.mks_servo import MksServo
+
+EN_PINS = MksCommands.READ_EN_PINS_STATUS.value
+PROTECTION = MksCommands.READ_MOTOR_SHAFT_PROTECTION_STATE.value
+ZERO = MksCommands.READ_GO_BACK_TO_ZERO_STATUS_WHEN_POWER_ON.value
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(can_cache.time, 'monotonic', clock)
+    return clock
+
+@pytest.fixture
+def cache(clock):
+    return ResponseCache(DEFAULT_CACHE_TTLS)
+
+def put(cache, op_code, data=b'\x01'):
+    cache.put(op_code, (op_code,), data, cache.generation(op_code))
+
+def test_entry_expires_after_its_time_to_live(cache, clock):
+    put(cache, EN_PINS)
+    clock.now += DEFAULT_CACHE_TTLS[MksCommands.READ_EN_PINS_STATUS] - 0.01
+    assert cache.get(EN_PINS, (EN_PINS,)) == b'\x01'
+    clock.now += 0.01
+    assert cache.get(EN_PINS, (EN_PINS,)) is None
+
+def test_only_the_reads_with_a_time_to_live_are_cached(cache):
+    assert cache.caches(EN_PINS)
+    assert not cache.caches(MksCommands.READ_ENCODED_VALUE_ADDITION.value)
+
+def test_response_of_a_read_sent_before_a_write_is_not_cached(cache):
+    generation = cache.generation(EN_PINS)
+    cache.write_completed(MksCommands.ENABLE_MOTOR_COMMAND.value)
+    assert cache.generation(EN_PINS) == generation + 1
+    cache.put(EN_PINS, (EN_PINS,), b'\x01', generation)
+    assert cache.get(EN_PINS, (EN_PINS,)) is None
+
+@pytest.mark.parametrize('write, stale', [(write, reads) for write, reads in CACHE_INVALIDATIONS.items()])
+def test_write_invalidates_the_matching_reads(cache, write, stale):
+    for op_code in (EN_PINS, PROTECTION, ZERO):
+        put(cache, op_code)
+    cache.write_completed(write)
+    stale = set(cache.ttls) if stale is None else set(stale)
+    for op_code in (EN_PINS, PROTECTION, ZERO):
+        assert (cache.get(op_code, (op_code,)) is None) == (op_code in stale)
+
+def test_other_writes_keep_the_cache(cache):
+    put(cache, EN_PINS)
+    cache.write_completed(MksCommands.SET_WORK_MODE_COMMAND.value)
+    assert cache.get(EN_PINS, (EN_PINS,)) == b'\x01'
+
+def test_cached_servo_read_is_not_served_after_a_write(simulator):
+    bus = can.interface.Bus(interface='virtual', channel=simulator.channel)
+    notifier = can.Notifier(bus, [], timeout=0.1)
+    servo = MksServo(bus, notifier, simulator.can_id, cache_ttls=DEFAULT_CACHE_TTLS)
+    try:
+        assert servo.read_en_pins_status() == EnableStatus.Enabled
+        assert servo.read_en_pins_status() == EnableStatus.Enabled
+        assert servo.get_metrics()[EN_PINS]['sent'] == 1
+
+        servo.enable_motor(Enable.Disable)
+        assert servo.read_en_pins_status() == EnableStatus.Disabled
+        assert servo.get_metrics()[EN_PINS]['sent'] == 2
+        # A read bypassing the cache is always sent
+        assert servo.read_en_pins_status(use_cache=False) == EnableStatus.Disabled
+        assert servo.get_metrics()[EN_PINS]['sent'] == 3
+    finally:
+        notifier.stop()
+        bus.shutdown()
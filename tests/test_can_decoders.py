@@ -0,0 +1,50 @@
+import pytest
+
+from core.can_decoders import GENERIC_RESPONSE_LENGTH, RESPONSE_DECODERS, decode_response
+from core.mks_enums import (MksCommands, EnableStatus, GoBackToZeroStatus, MotorShaftProtectionStatus, MotorStatus,
+    RunMotorResult, SuccessStatus)
+
+def response(command, payload):
+    # The CRC byte is not decoded
+    return bytearray([command.value] + payload + [0])
+
+@pytest.mark.parametrize('command, payload, expected', [
+    (MksCommands.READ_ENCODER_VALUE_CARRY, [0xFF, 0xFF, 0xFF, 0xFF, 0x10, 0x00], {'carry': -1, 'value': 0x1000}),
+    (MksCommands.READ_ENCODED_VALUE_ADDITION, list((-70000).to_bytes(6, 'big', signed=True)), -70000),
+    (MksCommands.READ_MOTOR_SPEED, list((-120).to_bytes(2, 'big', signed=True)), -120),
+    (MksCommands.READ_NUM_PULSES_RECEIVED, list((3200).to_bytes(4, 'big', signed=True)), 3200),
+    (MksCommands.READ_IO_PORT_STATUS, [0b0101], 0b0101),
+    (MksCommands.READ_MOTOR_SHAFT_ANGLE_ERROR, list((-15).to_bytes(4, 'big', signed=True)), -15),
+    (MksCommands.READ_EN_PINS_STATUS, [1], EnableStatus.Enabled),
+    (MksCommands.READ_GO_BACK_TO_ZERO_STATUS_WHEN_POWER_ON, [2], GoBackToZeroStatus.GoBackToZeroFail),
+    (MksCommands.READ_MOTOR_SHAFT_PROTECTION_STATE, [1], MotorShaftProtectionStatus.Protected),
+    (MksCommands.QUERY_MOTOR_STATUS_COMMAND, [MotorStatus.MotorStop.value], MotorStatus.MotorStop),
+    (MksCommands.RUN_MOTOR_ABSOLUTE_MOTION_BY_AXIS_COMMAND, [RunMotorResult.RunComplete.value], RunMotorResult.RunComplete),
+    (MksCommands.SET_WORK_MODE_COMMAND, [1], SuccessStatus.Success),
+])
+def test_decode_response(command, payload, expected):
+    response_length, _ = RESPONSE_DECODERS[command.value]
+    data = response(command, payload)
+    assert len(data) == response_length
+    assert decode_response(data) == expected
+
+def test_every_command_has_a_decoder():
+    assert set(RESPONSE_DECODERS) == {command.value for command in MksCommands}
+    assert RESPONSE_DECODERS[MksCommands.ENABLE_MOTOR_COMMAND.value][0] == GENERIC_RESPONSE_LENGTH
+
+def test_status_out_of_its_enum_raises():
+    with pytest.raises(ValueError):
+        decode_response(response(MksCommands.READ_EN_PINS_STATUS, [7]))
+    with pytest.raises(KeyError):
+        decode_response(bytearray([0xEE, 0, 0]))
+
+def test_reads_decoded_from_the_simulator(simulator, servo):
+    simulator.position = simulator.AXIS_PER_TURN * 2 + 100
+    assert servo.read_encoder_value_addition() == simulator.AXIS_PER_TURN * 2 + 100
+    assert servo.read_encoder_value_carry() == {'carry': 2, 'value': 100}
+    assert servo.read_motor_speed() == 0
+    assert servo.read_num_pulses_received() == 0
+    assert servo.read_motor_shaft_angle_error() == 0
+    assert servo.read_en_pins_status() == EnableStatus.Enabled
+    assert servo.read_motor_shaft_protection_state() == MotorShaftProtectionStatus.NotProtected
+    assert servo.query_motor_status() == MotorStatus.MotorStop
@@ -0,0 +1,102 @@
+import itertools
+import time
+
+import can
+import pytest
+
+from core.can_dispatcher import CanDispatcher
+from core.mks_enums import MksCommands
+from core.mks_servo import MksServo
+
+_channels = itertools.count()
+
+READ_ADDITION = MksCommands.READ_ENCODED_VALUE_ADDITION.value
+
+@pytest.fixture
+def bus():
+    """A servo side bus injecting frames, and the host bus and notifier receiving them."""
+    channel = f"pytest_dispatcher_{next(_channels)}"
+    servo_bus = can.interface.Bus(interface='virtual', channel=channel)
+    host_bus = can.interface.Bus(interface='virtual', channel=channel)
+    notifier = can.Notifier(host_bus, [], timeout=0.1)
+    yield servo_bus, host_bus, notifier
+    notifier.stop()
+    host_bus.shutdown()
+    servo_bus.shutdown()
+
+def frame(can_id, data, crc=None):
+    crc = (can_id + sum(data)) & 0xFF if crc is None else crc
+    return can.Message(arbitration_id=can_id, data=bytes(data) + bytes([crc]), is_extended_id=False)
+
+def addition_response(can_id, value, crc=None):
+    return frame(can_id, [READ_ADDITION] + list(value.to_bytes(6, 'big', signed=True)), crc)
+
+def test_dispatcher_is_shared_per_notifier(bus):
+    _, _, notifier = bus
+    assert CanDispatcher.for_notifier(notifier) is CanDispatcher.for_notifier(notifier)
+
+def test_responses_are_routed_by_can_id_and_op_code(bus):
+    servo_bus, _, notifier = bus
+    dispatcher = CanDispatcher.for_notifier(notifier)
+    for can_id in (1, 2):
+        dispatcher.register(can_id, lambda message: True)
+    first, second = dispatcher.expect(1, READ_ADDITION, 8), dispatcher.expect(1, READ_ADDITION, 8)
+    other_servo = dispatcher.expect(2, READ_ADDITION, 8)
+    other_command = dispatcher.expect(1, MksCommands.READ_MOTOR_SPEED.value, 4)
+
+    servo_bus.send(addition_response(2, 20))
+    assert other_servo.wait(1)[1:7] == (20).to_bytes(6, 'big')
+    # The oldest request of the same servo and op code is resolved first
+    servo_bus.send(addition_response(1, 10))
+    servo_bus.send(addition_response(1, 11))
+    assert first.wait(1)[6] == 10 and second.wait(1)[6] == 11
+    assert not other_command.done()
+
+def test_frames_of_unregistered_servos_and_discarded_requests_are_ignored(bus):
+    servo_bus, _, notifier = bus
+    dispatcher = CanDispatcher.for_notifier(notifier)
+    unregistered = dispatcher.expect(3, READ_ADDITION, 8)
+    dispatcher.register(4, lambda message: True)
+    discarded = dispatcher.expect(4, READ_ADDITION, 8)
+    dispatcher.discard(discarded)
+    kept = dispatcher.expect(4, READ_ADDITION, 8)
+
+    servo_bus.send(addition_response(3, 1))
+    servo_bus.send(addition_response(4, 2))
+    assert kept.wait(1) is not None
+    assert unregistered.wait(0.1) is None and not discarded.done()
+
+@pytest.fixture
+def servo(bus):
+    _, host_bus, notifier = bus
+    servo = MksServo(host_bus, notifier, 1)
+    servo.timeout = 0.2
+    return servo
+
+def test_frame_with_a_bad_crc_does_not_resolve_the_request(bus, servo):
+    servo_bus, _, _ = bus
+    pending = servo.dispatcher.expect(1, READ_ADDITION, 8)
+    servo_bus.send(addition_response(1, 5, crc=0))
+    assert pending.wait(0.1) is None
+    servo_bus.send(addition_response(1, 5))
+    assert pending.wait(1) is not None
+
+    metrics = servo.get_metrics()[READ_ADDITION]
+    assert (metrics['crc_failures'], metrics['received']) == (1, 1)
+
+def test_response_of_unexpected_length_is_counted(bus, servo):
+    servo_bus, _, _ = bus
+    pending = servo.dispatcher.expect(1, READ_ADDITION, 8)
+    servo_bus.send(frame(1, [READ_ADDITION, 0, 5]))
+    assert pending.wait(1) is not None
+    metrics = servo.get_metrics()[READ_ADDITION]
+    assert (metrics['unexpected_lengths'], metrics['received']) == (1, 1)
+    assert sum(metrics['latency_buckets'].values()) == 1
+
+def test_frame_with_an_unknown_op_code_is_counted(bus, servo):
+    servo_bus, _, _ = bus
+    servo_bus.send(frame(1, [0xEE, 0]))
+    deadline = time.monotonic() + 1
+    while not servo.metrics.unknown_frames and time.monotonic() < deadline:
+        time.sleep(0.001)
+    assert servo.metrics.unknown_frames == 1
@@ -0,0 +1,35 @@
+import threading
+
+from core.mks_enums import MksCommands
+
+def test_coalesced_reads_timing_out_count_one_timeout(simulator, servo):
+    simulator.stop()
+    callers = 3
+    barrier = threading.Barrier(callers)
+    results = []
+
+    def read():
+        barrier.wait()
+        results.append(servo.read_encoder_value_addition())
+
+    threads = [threading.Thread(target=read) for _ in range(callers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    metrics = servo.get_metrics()[MksCommands.READ_ENCODED_VALUE_ADDITION.value]
+    assert results == [None] * callers
+    # Every caller either sent its read or shared one in flight, and each read sent timed out once
+    assert metrics['sent'] + metrics['coalesced'] == callers
+    assert metrics['timeouts'] == metrics['sent']
+    assert not servo._in_flight_reads
+
+def test_fire_and_forget_requests_are_counted_apart(simulator, servo):
+    op_code = MksCommands.QUERY_MOTOR_STATUS_COMMAND.value
+    servo.wait_response(servo.send_can_msg(servo.create_can_msg([op_code]), servo.GENERIC_RESPONSE_LENGTH))
+    assert servo.send_can_msg(servo.create_can_msg([op_code]), None) is None
+
+    metrics = servo.get_metrics()[op_code]
+    assert (metrics['sent'], metrics['sent_without_response']) == (1, 1)
+    assert metrics['received'] + metrics['timeouts'] == metrics['sent']
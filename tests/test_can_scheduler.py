@@ -0,0 +1,73 @@
+import threading
+import time
+
+from core.can_scheduler import BusScheduler, TransmitPriority, command_priority
+from core.mks_enums import MksCommands
+
+def wait_for_waiters(scheduler, count, timeout=1):
+    deadline = time.monotonic() + timeout
+    while len(scheduler._waiting) < count:
+        assert time.monotonic() < deadline, "the waiters did not queue in time"
+        time.sleep(0.001)
+
+def queue(scheduler, priorities, order):
+    """Starts a thread per (name, priority), each one queued behind the previous one."""
+    threads = []
+    for name, priority in priorities:
+        def send(name=name, priority=priority):
+            with scheduler.hold(priority):
+                order.append(name)
+        thread = threading.Thread(target=send)
+        thread.start()
+        threads.append(thread)
+        wait_for_waiters(scheduler, len(threads))
+    return threads
+
+def test_safety_goes_ahead_of_the_waiting_frames():
+    scheduler = BusScheduler()
+    order = []
+    scheduler.acquire(TransmitPriority.CONFIGURATION)
+    threads = queue(scheduler, [
+        ('configuration', TransmitPriority.CONFIGURATION),
+        ('telemetry 1', TransmitPriority.TELEMETRY),
+        ('telemetry 2', TransmitPriority.TELEMETRY),
+        ('motion', TransmitPriority.MOTION),
+        ('safety', TransmitPriority.SAFETY),
+    ], order)
+    scheduler.release()
+    for thread in threads:
+        thread.join(1)
+
+    # By priority class, in arrival order within a class
+    assert order == ['safety', 'motion', 'telemetry 1', 'telemetry 2', 'configuration']
+    snapshot = scheduler.snapshot()
+    assert snapshot['TELEMETRY']['holds'] == 2 and snapshot['SAFETY']['wait_max'] > 0
+
+def test_hold_is_reentrant():
+    scheduler = BusScheduler()
+    order = []
+    with scheduler.hold(TransmitPriority.MOTION):
+        threads = queue(scheduler, [('safety', TransmitPriority.SAFETY)], order)
+        # A nested hold of the owner is granted at once, ahead of the waiting safety frame
+        with scheduler.hold(TransmitPriority.CONFIGURATION):
+            order.append('nested')
+        order.append('outer')
+    for thread in threads:
+        thread.join(1)
+    assert order == ['nested', 'outer', 'safety']
+    # The nested hold is not a hold of its own class
+    assert scheduler.snapshot()['CONFIGURATION']['holds'] == 0
+
+class Bus:
+    pass
+
+def test_scheduler_is_shared_per_bus():
+    bus, other_bus = Bus(), Bus()
+    assert BusScheduler.for_bus(bus) is BusScheduler.for_bus(bus)
+    assert BusScheduler.for_bus(bus) is not BusScheduler.for_bus(other_bus)
+
+def test_command_priorities():
+    assert command_priority(MksCommands.EMERGENCY_STOP_COMMAND.value) == TransmitPriority.SAFETY
+    assert command_priority(MksCommands.RUN_MOTOR_SPEED_MODE_COMMAND.value) == TransmitPriority.MOTION
+    assert command_priority(MksCommands.READ_ENCODED_VALUE_ADDITION.value) == TransmitPriority.TELEMETRY
+    assert command_priority(MksCommands.SET_WORK_MODE_COMMAND.value) == TransmitPriority.CONFIGURATION
@@ -0,0 +1,92 @@
+import os
+import threading
+import time
+
+import can
+import pytest
+
+from controller import ServoController
+from core.cancellation import CancellationToken
+from core.mks_enums import SuccessStatus
+from core.stop_check import STOP_CHECK_SEQUENCE, BusRecorder
+
+CONFIG_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'config.json'))
+
+# The stop frame only waits for the frame being sent
+STOP_FRAME_BOUND = 0.05
+# The execution ends as soon as the token is set
+THREAD_END_BOUND = 0.5
+
+@pytest.fixture
+def controller(simulator):
+    controller = ServoController(config_path=CONFIG_PATH, can_interface='virtual', channel=simulator.channel)
+    yield controller
+    controller.shutdown()
+
+@pytest.fixture
+def recorder(simulator):
+    bus = can.interface.Bus(interface='virtual', channel=simulator.channel)
+    recorder = BusRecorder(simulator.can_id)
+    notifier = can.Notifier(bus, [recorder], timeout=0.1)
+    yield recorder
+    notifier.stop()
+    bus.shutdown()
+
+@pytest.fixture
+def sequence_file(tmp_path):
+    path = tmp_path / 'sequence.csv'
+    path.write_text(STOP_CHECK_SEQUENCE)
+    return str(path)
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "condition not met in time"
+        time.sleep(0.001)
+
+def emergency_stop(controller, cancel, thread, recorder):
+    start = time.perf_counter()
+    cancel.set()
+    assert controller.emergency_stop() == SuccessStatus.Success
+    thread.join(THREAD_END_BOUND)
+    assert not thread.is_alive()
+    stop_time = recorder.stop_times()[0]
+    assert stop_time - start < STOP_FRAME_BOUND
+    return stop_time
+
+@pytest.mark.parametrize('during_motion', [True, False], ids=['moving', 'holding'])
+def test_emergency_stop_during_a_step(simulator, controller, recorder, sequence_file, during_motion):
+    program = controller.compile_sequence(sequence_file)
+    cancel = CancellationToken()
+    thread = threading.Thread(target=controller.execute_timeline, args=(program, None, cancel))
+    thread.start()
+
+    # Stopped while the first step moves, or while it holds until the end of its duration
+    wait_until(simulator.is_moving)
+    if not during_motion:
+        wait_until(lambda: not simulator.is_moving())
+
+    stop_time = emergency_stop(controller, cancel, thread, recorder)
+    assert not recorder.moves_after(stop_time)
+    assert not simulator.is_moving()
+
+def test_emergency_stop_during_a_blended_segment(simulator, controller, recorder, sequence_file):
+    profile = controller.plan_sequence(sequence_file, 0)
+    cancel = CancellationToken()
+    thread = threading.Thread(target=controller.execute_profile, args=(profile, cancel))
+    thread.start()
+
+    # Stopped while the first segment streams its setpoints
+    wait_until(lambda: simulator.speed != 0)
+    stop_time = emergency_stop(controller, cancel, thread, recorder)
+    assert not recorder.moves_after(stop_time)
+    wait_until(lambda: not simulator.is_moving(), timeout=1)
+
+def test_profile_cancelled_before_it_starts_streaming(simulator, controller, recorder, sequence_file):
+    profile = controller.plan_sequence(sequence_file, 0)
+    cancel = CancellationToken()
+    cancel.set()
+    assert controller.emergency_stop() == SuccessStatus.Success
+    controller.execute_profile(profile, cancel)
+    assert not recorder.moves_after(recorder.stop_times()[0])
+    assert not simulator.is_moving()
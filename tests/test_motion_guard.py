@@ -0,0 +1,29 @@
+import pytest
+
+from core.can_motor import motor_already_running_error
+from core.mks_enums import Direction, GoHomeResult, CalibrationResult, SuccessStatus
+
+def test_moves_are_refused_while_going_home(simulator, servo):
+    simulator.position = simulator.AXIS_PER_TURN
+    assert servo.nb_go_home() == GoHomeResult.Start
+    assert servo.is_motor_busy()
+    with pytest.raises(motor_already_running_error):
+        servo.run_motor_absolute_motion_by_axis(600, 0, 0)
+    assert not servo.wait_for_motor_idle(20)
+    assert servo._homing_status == GoHomeResult.Success
+
+def test_moves_are_refused_while_calibrating(simulator, servo):
+    assert servo.nb_calibrate_encoder() == CalibrationResult.Calibrating
+    assert servo.is_motor_busy()
+    with pytest.raises(motor_already_running_error):
+        servo.run_motor_relative_motion_by_axis(600, 0, 1000)
+    assert not servo.wait_for_motor_idle(5)
+    assert servo._calibration_status == CalibrationResult.CalibratedSuccess
+
+def test_moves_are_refused_in_speed_mode(simulator, servo):
+    assert servo.run_motor_in_speed_mode(Direction.CCW, 100, 0) == SuccessStatus.Success
+    assert servo._speed_mode_speed == 100
+    with pytest.raises(motor_already_running_error):
+        servo.run_motor_absolute_motion_by_axis(600, 0, 0)
+    assert servo.emergency_stop_motor() == SuccessStatus.Success
+    assert not servo.is_motor_busy()
@@ -0,0 +1,53 @@
+import os
+
+import pytest
+
+from conftest import GROUP_ID
+from controller import MultiAxisController
+from core.mks_enums import SuccessStatus
+
+CONFIG_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'config.json'))
+
+SEQUENCE = """head_Degrees,head_Speed,head_Acceleration,wing_Degrees,wing_Speed,wing_Acceleration,Duration,Label
+10,300,0,10,300,0,0.1,together
+20,300,0,5,300,0,0.1,apart
+,,,0,300,0,0.1,wing only
+"""
+
+@pytest.fixture
+def controller(axes):
+    channel = axes['head'].channel
+    controller = MultiAxisController({axis: simulator.can_id for axis, simulator in axes.items()},
+        config_path=CONFIG_PATH, can_interface='virtual', channel=channel, group_id=GROUP_ID)
+    yield controller
+    controller.shutdown()
+
+def test_multi_axis_sequence_on_the_simulator(axes, controller, tmp_path):
+    path = tmp_path / 'sequence.csv'
+    path.write_text(SEQUENCE)
+    program = controller.compile_sequence(str(path))
+    # Only the step moving every axis to the same target is addressed to the group
+    assert [step.group_frame is not None for step in program] == [True, False, False]
+
+    positions = []
+    controller.execute_timeline(program, on_step=lambda *args: positions.append(
+        {axis: round(simulator.position) for axis, simulator in axes.items()}))
+    units = controller.degrees_to_units
+    assert positions == [
+        {'head': round(units(10)), 'wing': round(units(10))},
+        {'head': round(units(20)), 'wing': round(units(5))},
+        {'head': round(units(20)), 'wing': 0},
+    ]
+    assert controller.get_motor_degrees() == {'head': controller.units_to_degrees(round(units(20))), 'wing': 0}
+    assert not controller.is_motor_busy()
+
+def test_multi_axis_emergency_stop(axes, controller):
+    assert controller.emergency_stop() == {'head': SuccessStatus.Success, 'wing': SuccessStatus.Success}
+
+def test_blended_profiles_are_refused(controller, tmp_path):
+    path = tmp_path / 'sequence.csv'
+    path.write_text(SEQUENCE)
+    with pytest.raises(NotImplementedError):
+        controller.plan_sequence(str(path), {'head': 0, 'wing': 0})
+    with pytest.raises(NotImplementedError):
+        controller.execute_profile(None)
@@ -0,0 +1,71 @@
+import math
+
+import pytest
+
+from controller import SequenceStep
+from planner import DEGREES_PER_SECOND_PER_RPM, MotionProfile, plan_profile
+
+# 400 RPM per second, 2400 degrees per second squared
+ACCELERATION = 206
+DEGREES_PER_SECOND_SQUARED = 2400
+SPEED_MAX = 600
+
+def step(degrees, speed=100, duration=1.0, row=0):
+    return SequenceStep(row, degrees, speed, 0, duration, f"step {row}")
+
+def plan(*steps, start_degrees=0):
+    return plan_profile([step._replace(row=i) for i, step in enumerate(steps)], start_degrees, SPEED_MAX, ACCELERATION)
+
+def test_long_move_is_a_trapezoid():
+    # 75 degrees to reach 600 degrees per second, and as many to stop
+    segment, = plan(step(180)).segments
+    assert segment.peak_speed == pytest.approx(600)
+    assert (segment.accel_time, segment.cruise_time, segment.decel_time) == pytest.approx((0.25, 0.05, 0.25))
+    assert (segment.start_speed, segment.end_speed) == (0, 0)
+
+def test_short_move_is_a_triangle():
+    segment, = plan(step(90)).segments
+    assert segment.peak_speed == pytest.approx(math.sqrt(DEGREES_PER_SECOND_SQUARED * 90))
+    assert segment.cruise_time == 0
+    assert segment.accel_time == pytest.approx(segment.decel_time)
+
+def test_moves_in_the_same_direction_are_joined_at_the_lowest_speed():
+    first, second = plan(step(150), step(300, speed=50)).segments
+    assert first.end_speed == second.start_speed == pytest.approx(300)
+    assert second.start_time == pytest.approx(first.duration)
+    profile = MotionProfile([first, second])
+    assert profile.speed_at(second.start_time) == pytest.approx(50)
+
+def test_junction_speed_is_limited_by_the_braking_distance():
+    # Stopping from 600 degrees per second takes 75 degrees, the last move only has 10
+    first, second = plan(step(170), step(180)).segments
+    assert first.end_speed == pytest.approx(math.sqrt(2 * DEGREES_PER_SECOND_SQUARED * 10))
+    assert second.end_speed == 0
+
+def test_reversal_stops_at_the_waypoint():
+    out, back = plan(step(90), step(0)).segments
+    assert out.end_speed == back.start_speed == 0
+    assert (out.direction, back.direction) == (1, -1)
+    profile = plan(step(90), step(0))
+    assert profile.speed_at(out.duration / 2) > 0 > profile.speed_at(back.start_time + back.duration / 2)
+    assert profile.end_degrees == 0
+
+@pytest.mark.parametrize('hold', [step(90, duration=2.0), step(180, speed=0, duration=2.0)], ids=['same target', 'speed 0'])
+def test_step_without_motion_is_a_dwell(hold):
+    move, dwell, last = plan(step(90), hold, step(180)).segments
+    assert (dwell.start_degrees, dwell.end_degrees, dwell.cruise_time) == (90, 90, 2.0)
+    assert dwell.peak_speed == 0
+    # The motor stops for the dwell instead of blending through it
+    assert move.end_speed == last.start_speed == 0
+    assert last.start_time == pytest.approx(move.duration + 2.0)
+
+def test_speed_is_clamped_to_speed_max():
+    segment, = plan_profile([step(3600, speed=1000)], 0, 100, ACCELERATION).segments
+    assert segment.peak_speed == pytest.approx(100 * DEGREES_PER_SECOND_PER_RPM)
+
+def test_profile_is_anchored_to_its_start():
+    profile = plan(step(90), start_degrees=30)
+    assert profile.segments[0].start_degrees == 30
+    assert profile.starts_at(30) and not profile.starts_at(0)
+    assert MotionProfile([]).starts_at(0)
+    assert MotionProfile([]).speed_at(0) == 0 and MotionProfile([]).end_degrees is None
@@ -0,0 +1,45 @@
+import os
+
+import pytest
+
+from controller import ServoController
+
+CONFIG_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'config.json'))
+
+SEQUENCE = """Degrees,Speed,Acceleration,Duration,Label
+{degrees},100,5,1,out
+0,100,5,1,back
+"""
+
+@pytest.fixture
+def controller(simulator):
+    controller = ServoController(config_path=CONFIG_PATH, can_interface='virtual', channel=simulator.channel)
+    yield controller
+    controller.shutdown()
+
+def write_sequence(path, degrees, mtime):
+    # The modification time is set explicitly, a rewrite within the resolution of the filesystem keeps it
+    path.write_text(SEQUENCE.format(degrees=degrees))
+    os.utime(path, (mtime, mtime))
+
+def test_rewritten_sequence_replaces_its_compiled_entry(controller, tmp_path):
+    path = tmp_path / 'temp.csv'
+    for i, degrees in enumerate((30, 60, 90)):
+        write_sequence(path, degrees, 1_000_000 + i)
+        program = controller.compile_sequence(str(path))
+        assert program[0].degrees == degrees and controller.compile_sequence(str(path)) is program
+    assert len(controller._compiled_sequences) == 1
+
+def test_planned_profile_is_anchored_to_the_start_position(controller, tmp_path):
+    path = tmp_path / 'temp.csv'
+    write_sequence(path, 90, 1_000_000)
+    profile = controller.plan_sequence(str(path), 0)
+    assert controller.plan_sequence(str(path), 0) is profile
+
+    # Planned again from the cached steps, replacing the profile starting from 0
+    for start_degrees in (10, 20, 30):
+        profile = controller.plan_sequence(str(path), start_degrees)
+        assert profile.segments[0].start_degrees == start_degrees and profile.end_degrees == 0
+    write_sequence(path, 60, 1_000_001)
+    assert controller.plan_sequence(str(path), 30).segments[0].end_degrees == 60
+    assert len(controller._planned_sequences) == 1
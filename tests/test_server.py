@@ -0,0 +1,151 @@
+import asyncio
+import os
+import threading
+import time
+
+import can
+import pytest
+
+from core.stop_check import STOP_CHECK_SEQUENCE, BusRecorder
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+SEQUENCE = """Degrees,Speed,Acceleration,Duration,Label
+30,100,5,5,out
+0,100,5,5,back
+"""
+
+@pytest.fixture(scope='module')
+def server():
+    # The server loads config.json from the working directory and drives the simulated servo
+    cwd = os.getcwd()
+    os.chdir(ROOT)
+    os.environ['OWL_SIMULATOR'] = '1'
+    import server
+    yield server
+    with server.sequence_lock:
+        server.stop_event.set()
+        thread = server.execution_thread
+    if thread is not None:
+        thread.join(5)
+    server.servo_controller.shutdown()
+    server.simulator.stop()
+    os.chdir(cwd)
+
+@pytest.fixture
+def recorder(server):
+    bus = can.interface.Bus(interface='virtual', channel=server.simulator.channel)
+    recorder = BusRecorder(server.simulator.can_id)
+    notifier = can.Notifier(bus, [recorder], timeout=0.1)
+    yield recorder
+    notifier.stop()
+    bus.shutdown()
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "condition not met in time"
+        time.sleep(0.001)
+
+@pytest.fixture
+def sequence_file(tmp_path):
+    path = tmp_path / 'sequence.csv'
+    path.write_text(SEQUENCE)
+    return str(path)
+
+def test_concurrent_run_sequence_leaves_a_single_running_sequence(server, sequence_file, monkeypatch):
+    tokens = []
+    class RecordedToken(server.CancellationToken):
+        def __init__(self):
+            super().__init__()
+            tokens.append(self)
+            # Widens the window between reading the current token and replacing it
+            time.sleep(0.005)
+    monkeypatch.setattr(server, 'CancellationToken', RecordedToken)
+
+    barrier = threading.Barrier(8)
+    def run():
+        barrier.wait()
+        server.run_sequence(sequence_file)
+    threads = [threading.Thread(target=run) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(tokens) == 8
+    assert [token for token in tokens if not token.is_set()] == [server.stop_event]
+
+    server.emergency_stop()
+    assert all(token.is_set() for token in tokens)
+
+def test_execute_position_clears_the_jitter_of_the_last_sequence_step(server, monkeypatch):
+    monkeypatch.setitem(server.last_step_info, 'jitter', 0.004)
+    server.execute_position(degrees=0, speed=100, acceleration=5, duration=0, label='home')
+    assert server.last_step_info['jitter'] is None
+
+@pytest.mark.parametrize('blend', [False, True], ids=['steps', 'blended'])
+def test_looping_sequence_restarts_after_an_error(server, sequence_file, monkeypatch, blend):
+    monkeypatch.setitem(server.servo_controller.config, 'blend_sequences', blend)
+    monkeypatch.setattr(server, 'SEQUENCE_RETRY_DELAY', 0)
+    cancel = server.CancellationToken()
+    calls = []
+    def execute(*args):
+        calls.append(args)
+        if len(calls) == 3:
+            cancel.set()
+        raise RuntimeError("no response")
+    monkeypatch.setattr(server.servo_controller, 'execute_profile' if blend else 'execute_timeline', execute)
+
+    server.loop_sequence(sequence_file, cancel)
+    assert len(calls) == 3
+    if not blend:
+        # Every pass after an error starts on a new timeline
+        assert [timeline_start for _, timeline_start, _, _ in calls] == [None, None, None]
+
+def test_servo_health_reads_concurrently_on_the_event_loop(server):
+    async def read():
+        return await asyncio.gather(*(server.servo_health() for _ in range(4)))
+    health = asyncio.run(read())
+    assert health == [{"en_pins": "Enabled", "shaft_protection": "NotProtected", "go_back_to_zero": "GoBackToZeroSuccess"}] * 4
+
+@pytest.mark.parametrize('blend', [False, True], ids=['steps', 'blended'])
+def test_emergency_stop_handler_stops_the_running_sequence(server, recorder, tmp_path, monkeypatch, blend):
+    monkeypatch.setitem(server.servo_controller.config, 'blend_sequences', blend)
+    path = tmp_path / 'stop.csv'
+    path.write_text(STOP_CHECK_SEQUENCE)
+    server.simulator.position = 0
+    server.run_sequence(str(path))
+    thread = server.execution_thread
+
+    # Stopped while the first step moves, or while the first blended segment streams its setpoints
+    wait_until(lambda: server.simulator.speed != 0)
+    start = time.perf_counter()
+    server.emergency_stop()
+    handler_latency = time.perf_counter() - start
+
+    assert handler_latency < 2 * server.servo_controller.servo.timeout + server.EMERGENCY_STOP_JOIN_TIMEOUT
+    assert not thread.is_alive()
+    stop_times = recorder.stop_times()
+    assert stop_times and stop_times[0] - start < 0.05
+    assert not recorder.moves_after(stop_times[0])
+
+def test_emergency_stop_handler_does_not_wait_for_a_hung_sequence(server, recorder, monkeypatch):
+    release = threading.Event()
+    hung = threading.Thread(target=release.wait, daemon=True)
+    hung.start()
+    monkeypatch.setattr(server, 'execution_thread', hung)
+    try:
+        start = time.perf_counter()
+        server.emergency_stop()
+        assert time.perf_counter() - start < server.EMERGENCY_STOP_JOIN_TIMEOUT + server.servo_controller.servo.timeout
+        assert hung.is_alive() and recorder.stop_times()
+    finally:
+        release.set()
+        hung.join()
+
+def test_emergency_stop_handler_stops_again_a_motion_sent_before_the_stop(server, recorder, monkeypatch):
+    # The sequence thread sent a move just before it saw the stop event
+    monkeypatch.setattr(server.servo_controller, 'is_motor_busy', lambda: True)
+    server.emergency_stop()
+    assert len(recorder.stop_times()) == 2
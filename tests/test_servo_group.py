@@ -0,0 +1,83 @@
+import time
+
+import can
+import pytest
+
+from conftest import GROUP_ID
+from core.mks_enums import MksCommands, RunMotorResult, SuccessStatus
+from core.mks_group import MksServoGroup, group_member_error
+from core.mks_servo import MksServo
+
+MOTION = MksCommands.RUN_MOTOR_ABSOLUTE_MOTION_BY_AXIS_COMMAND.value
+
+class FrameRecorder(can.Listener):
+    def __init__(self):
+        self.frames = []
+
+    def on_message_received(self, msg):
+        self.frames.append(msg)
+
+@pytest.fixture
+def rig(axes):
+    """The MksServo of each simulated axis, sharing a bus and notifier, and a recorder of the frames."""
+    bus = can.interface.Bus(interface='virtual', channel=axes['head'].channel)
+    notifier = can.Notifier(bus, [], timeout=0.1)
+    servos = [MksServo(bus, notifier, simulator.can_id) for simulator in axes.values()]
+    for servo in servos:
+        servo.timeout = 0.2
+    # A bus does not receive its own frames, the recorder has its own
+    recorder_bus = can.interface.Bus(interface='virtual', channel=axes['head'].channel)
+    recorder = FrameRecorder()
+    recorder_notifier = can.Notifier(recorder_bus, [recorder], timeout=0.1)
+    yield servos, recorder
+    recorder_notifier.stop()
+    recorder_bus.shutdown()
+    notifier.stop()
+    bus.shutdown()
+
+def test_single_group_frame_moves_every_axis(axes, rig):
+    servos, recorder = rig
+    group = MksServoGroup(GROUP_ID, servos)
+    target = 2 * axes['head'].AXIS_PER_TURN
+
+    # Every member replies to the group frame with its own CAN ID
+    assert group.run_motor_absolute_motion_by_axis(600, 0, target) == {1: RunMotorResult.RunStarting, 2: RunMotorResult.RunStarting}
+    assert group.is_motor_busy()
+    assert group.wait_for_motor_idle(2) == {1: False, 2: False}
+    assert [round(simulator.position) for simulator in axes.values()] == [target, target]
+
+    # A single motion frame was sent, addressed to the group with the CRC of the group ID
+    motion_frames = [frame for frame in recorder.frames if frame.data[0] == MOTION and len(frame.data) > 3]
+    assert [frame.arbitration_id for frame in motion_frames] == [GROUP_ID]
+    data = motion_frames[0].data
+    assert data[-1] == (GROUP_ID + sum(data[:-1])) & 0xFF
+    # The responses of the members, the acknowledgement then the completion of the motion
+    def responses():
+        return sorted(frame.arbitration_id for frame in recorder.frames if frame.data[0] == MOTION and len(frame.data) == 3)
+    deadline = time.monotonic() + 1
+    while responses() != [1, 1, 2, 2] and time.monotonic() < deadline:
+        time.sleep(0.001)
+    assert responses() == [1, 1, 2, 2]
+    for servo in servos:
+        assert servo.get_metrics()[MOTION]['sent'] == 1
+
+def test_member_without_response(axes, rig):
+    servos, _ = rig
+    axes['wing'].stop()
+    results = MksServoGroup(GROUP_ID, servos).run_motor_relative_motion_by_axis(600, 0, 1000)
+    assert results == {1: RunMotorResult.RunStarting, 2: None}
+    assert servos[1].get_metrics()[MksCommands.RUN_MOTOR_RELATIVE_MOTION_BY_AXIS_COMMAND.value]['timeouts'] == 1
+
+def test_assign_sets_the_group_id_of_every_member(axes, rig):
+    servos, _ = rig
+    assert MksServoGroup(0x60, servos).assign() == {1: SuccessStatus.Success, 2: SuccessStatus.Success}
+    assert [simulator.group_id for simulator in axes.values()] == [0x60, 0x60]
+
+def test_invalid_groups_are_refused(rig, servo):
+    servos, _ = rig
+    with pytest.raises(group_member_error):
+        MksServoGroup(GROUP_ID, [])
+    with pytest.raises(group_member_error):
+        MksServoGroup(servos[0].can_id, servos)
+    with pytest.raises(group_member_error):
+        MksServoGroup(GROUP_ID, [servos[0], servo])
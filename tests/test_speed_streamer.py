@@ -0,0 +1,76 @@
+import time
+
+import can
+import pytest
+
+from core.can_motor import motor_already_running_error
+from core.mks_enums import MksCommands
+from core.mks_streamer import SpeedStreamer
+from core.stop_check import BusRecorder
+
+SPEED_MODE = MksCommands.RUN_MOTOR_SPEED_MODE_COMMAND.value
+
+@pytest.fixture
+def recorder(simulator):
+    bus = can.interface.Bus(interface='virtual', channel=simulator.channel)
+    recorder = BusRecorder(simulator.can_id)
+    notifier = can.Notifier(bus, [recorder], timeout=0.1)
+    yield recorder
+    notifier.stop()
+    bus.shutdown()
+
+def wait_until(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "condition not met in time"
+        time.sleep(0.001)
+
+def setpoint(data):
+    """Signed speed in RPM of a speed mode frame, positive runs CCW."""
+    speed = (data[1] & 0x0F) << 8 | data[2]
+    return -speed if data[1] & 0x80 else speed
+
+def test_setpoints_are_acknowledged_asynchronously(simulator, servo, recorder):
+    streamer = SpeedStreamer(servo, rate_hz=100, trajectory=lambda t: 60)
+    streamer.start()
+    wait_until(lambda: streamer.stats()['acked'] >= 10)
+    assert simulator.speed == pytest.approx(60)
+    streamer.stop()
+
+    stats = streamer.stats()
+    assert stats['acked'] == stats['sent'] >= 10
+    assert (stats['dropped'], stats['failed'], stats['late'], stats['in_flight']) == (0, 0, 0, 0)
+
+    # The last frame is the zero setpoint sent by stop, and the motor decelerates to a stop
+    def setpoints():
+        return [setpoint(data) for _, data in recorder.frames if data[0] == SPEED_MODE]
+    # The recorder receives the frames on its own notifier thread
+    wait_until(lambda: setpoints() and setpoints()[-1] == 0)
+    assert set(setpoints()[:-1]) == {60}
+    assert streamer.wait_for_stop(1) is False
+    assert simulator.speed == 0
+
+def test_setpoints_not_acknowledged_in_time_are_dropped(simulator, servo):
+    simulator.stop()
+    streamer = SpeedStreamer(servo, rate_hz=100, trajectory=lambda t: 60, ack_timeout=0.02)
+    streamer.start()
+    wait_until(lambda: streamer.stats()['dropped'] >= 5)
+    # The zero setpoint of stop is not acknowledged either
+    assert streamer.stop() is None
+
+    stats = streamer.stats()
+    assert stats['dropped'] == stats['sent'] and stats['acked'] == 0
+
+def test_streaming_keeps_the_motor_busy(simulator, servo):
+    streamer = SpeedStreamer(servo, rate_hz=100)
+    streamer.set_speed(30)
+    streamer.start()
+    try:
+        with pytest.raises(motor_already_running_error):
+            servo.run_motor_absolute_motion_by_axis(100, 0, 1000)
+        with pytest.raises(motor_already_running_error):
+            SpeedStreamer(servo).start()
+    finally:
+        streamer.stop()
+    streamer.wait_for_stop(1)
+    assert not servo.is_motor_busy()